@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import sys
 
@@ -31,11 +32,18 @@ _add_path(_hooks)
 _add_path(_root)
 
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+    config,
+)
+from cinder_profile import profile_report
 from cinder_utils import (
     pause_unit_helper,
     register_configs,
     resume_unit_helper,
+    volume_cache_stats,
 )
 import cinder_manage
 
@@ -53,11 +61,26 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def hook_profile(args):
+    """Return a summary of the profiled hook runs as JSON."""
+    limit = action_get(key="limit") or 10
+    action_set({'profile': json.dumps(profile_report(limit=limit),
+                                      sort_keys=True)})
+
+
+def cache_stats(args):
+    """Return the statistics of the volume group caches as JSON."""
+    action_set({'stats': json.dumps(
+        volume_cache_stats(config('volume-group')), sort_keys=True)})
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
 ACTIONS = {
     "pause": pause,
     "resume": resume,
+    "hook-profile": hook_profile,
+    "cache-stats": cache_stats,
     "remove-services": cinder_manage.remove_services,
     "rename-volume-host": cinder_manage.rename_volume_host,
     "volume-host-add-driver": cinder_manage.volume_host_add_driver,
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
+import tempfile
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
     log,
+    on_inputs_changed,
     ERROR,
     INFO,
     TRACE
@@ -89,7 +92,8 @@ class OSConfigTemplate(object):
     Responsible for constructing a template context based on those generators.
     """
 
-    def __init__(self, config_file, contexts, config_template=None):
+    def __init__(self, config_file, contexts, config_template=None,
+                 context_cache=None):
         self.config_file = config_file
 
         if hasattr(contexts, '__call__'):
@@ -101,10 +105,25 @@ class OSConfigTemplate(object):
 
         self.config_template = config_template
 
+        # Optional dict, shared between templates, of context generator
+        # results keyed by generator.
+        self.context_cache = context_cache
+
+    def _evaluate(self, context):
+        if self.context_cache is None:
+            return context()
+        try:
+            if context not in self.context_cache:
+                self.context_cache[context] = context()
+        except TypeError:
+            # unhashable generators are evaluated on every render.
+            return context()
+        return self.context_cache[context]
+
     def context(self):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = self._evaluate(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -204,6 +223,24 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    **Change tracking**
+
+    Templates are rendered in memory and compared with a digest of the file
+    currently on disk (cached while the file's inode, size and mtime are
+    unchanged), so files whose content is unchanged are not rewritten.
+    Changed files are replaced atomically and appended to ``changed_files``,
+    which restart helpers may consult instead of re-hashing every file in
+    their restart map.
+
+    **Context caching**
+
+    Each context generator is evaluated at most once per renderer, however
+    many registered files use it, so generators shared between files should
+    be registered as the same instance.  Cached results are discarded
+    whenever relation_set(), leader_set() or a value stored in the charm
+    config changes the inputs of the generators; call invalidate_contexts()
+    for other changes, e.g. of the OpenStack release.
     """
     def __init__(self, templates_dir, openstack_release):
         if not os.path.isdir(templates_dir):
@@ -215,6 +252,11 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        # ordered log of config files whose content changed on write.
+        self.changed_files = []
+        self._digests = {}
+        self._context_cache = {}
+        on_inputs_changed(self.invalidate_contexts)
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -235,7 +277,8 @@ class OSConfigRenderer(object):
         self.templates[config_file] = OSConfigTemplate(
             config_file=config_file,
             contexts=contexts,
-            config_template=config_template
+            config_template=config_template,
+            context_cache=self._context_cache
         )
         log('Registered config file: {}'.format(config_file),
             level=INFO)
@@ -302,27 +345,114 @@ class OSConfigRenderer(object):
                 level=INFO)
         return template.render(ctxt)
 
+    @staticmethod
+    def _file_signature(config_file):
+        """Return the inode, size and mtime of config_file, or None if it
+        does not exist."""
+        try:
+            stat = os.stat(config_file)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _current_digest(self, config_file):
+        """Return the digest of the content of config_file on disk.
+
+        Digests are cached together with the file's inode, size and mtime,
+        and only trusted while those are unchanged, so that files replaced
+        by another writer during the hook (dpkg, another renderer) are
+        hashed again.
+        """
+        signature = self._file_signature(config_file)
+        if signature is None:
+            return None
+        cached = self._digests.get(config_file)
+        if cached is not None and cached[1] == signature:
+            return cached[0]
+        try:
+            with open(config_file, 'rb') as current:
+                digest = hashlib.sha256(current.read()).hexdigest()
+        except IOError:
+            return None
+        self._digests[config_file] = (digest, signature)
+        return digest
+
+    @staticmethod
+    def _replace_file(config_file, content):
+        """Atomically replace config_file with content, preserving the mode
+        and ownership of any existing file."""
+        try:
+            stat = os.stat(config_file)
+        except OSError:
+            stat = None
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(config_file) or '.',
+            prefix='.{}.'.format(os.path.basename(config_file)))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(content)
+                out.flush()
+                os.fsync(out.fileno())
+            if stat is not None:
+                os.chmod(tmp_path, stat.st_mode & 0o7777)
+                os.chown(tmp_path, stat.st_uid, stat.st_gid)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_path, 0o666 & ~umask)
+            os.rename(tmp_path, config_file)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is only replaced if the rendered content differs from the
+        content currently on disk.
+
+        :returns: True if the file content changed, False otherwise.
+        :rtype: bool
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
         _out = self.render(config_file).encode('UTF-8')
+        digest = hashlib.sha256(_out).hexdigest()
+
+        if digest == self._current_digest(config_file):
+            log('Template %s unchanged, not writing.' % config_file,
+                level=INFO)
+            return False
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        self._replace_file(config_file, _out)
+        signature = self._file_signature(config_file)
+        if signature is not None:
+            self._digests[config_file] = (digest, signature)
+        self.changed_files.append(config_file)
 
         log('Wrote template %s.' % config_file, level=INFO)
+        return True
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        :returns: the set of config files whose content changed.
+        :rtype: Set[str]
+        """
+        return {k for k in self.templates.keys() if self.write(k)}
+
+    def invalidate_contexts(self):
+        """
+        Discard cached context generator results so that they are evaluated
+        again on the next render.
         """
-        for k in self.templates.keys():
-            self.write(k)
+        self._context_cache.clear()
+        for ostmpl in self.templates.values():
+            ostmpl._complete_contexts = []
 
     def set_release(self, openstack_release):
         """
@@ -331,6 +461,7 @@ class OSConfigRenderer(object):
         """
         self._tmpl_env = None
         self.openstack_release = openstack_release
+        self.invalidate_contexts()
         self._get_tmpl_env()
 
     def complete_contexts(self):
@@ -24,8 +24,9 @@ except ImportError:
     from looseversion import LooseVersion
 from enum import Enum
 from functools import wraps
-from collections import namedtuple, UserDict
+from collections import defaultdict, namedtuple, OrderedDict, UserDict
 import glob
+import hashlib
 import os
 import json
 import yaml
@@ -34,6 +35,7 @@ import subprocess
 import sys
 import errno
 import tempfile
+import weakref
 from subprocess import CalledProcessError
 
 from charmhelpers import deprecate
@@ -61,7 +63,119 @@ class WORKLOAD_STATES(Enum):
     WAITING = 'waiting'
 
 
-cache = {}
+def _freeze(value):
+    """Convert value into a hashable equivalent for use in a cache key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+class HookCache(object):
+    """Bounded LRU cache of function results for the running hook.
+
+    Entries are keyed by (function, args, kwargs) tuples and indexed by the
+    function and by every string argument (unit names, relation ids,
+    attributes) so that flush() drops matching entries without scanning the
+    whole cache.  Hit, miss and eviction counters are kept per function and
+    can be dumped with stats().
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._index = defaultdict(set)
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(func, args, kwargs):
+        return (func, _freeze(args), _freeze(kwargs))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        """Return the cached value for key, counting a hit or a miss.
+
+        :raises: KeyError if key is not cached.
+        """
+        func = key[0]
+        try:
+            value = self._entries[key][0]
+        except KeyError:
+            self._misses[func] += 1
+            raise
+        self._entries.move_to_end(key)
+        self._hits[func] += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._entries:
+            self._remove(key)
+        func, args, kwargs = key
+        tokens = {func}
+        tokens.update(a for a in args if isinstance(a, str))
+        tokens.update(v for _, v in kwargs if isinstance(v, str))
+        self._entries[key] = (value, tokens)
+        for token in tokens:
+            self._index[token].add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        self._remove(key)
+
+    def _remove(self, key):
+        _, tokens = self._entries.pop(key)
+        for token in tokens:
+            keys = self._index[token]
+            keys.discard(key)
+            if not keys:
+                del self._index[token]
+
+    def flush(self, token):
+        """Drop all entries for the function or string argument token."""
+        for key in list(self._index.get(token, ())):
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._index.clear()
+
+    def stats(self):
+        """Return cache counters, suitable for serialising as JSON.
+
+        :rtype: Dict[str, Any]
+        """
+        funcs = set(self._hits) | set(self._misses)
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': sum(self._hits.values()),
+            'misses': sum(self._misses.values()),
+            'evictions': self.evictions,
+            'functions': {
+                '{}.{}'.format(f.__module__, f.__name__): {
+                    'hits': self._hits[f], 'misses': self._misses[f]}
+                for f in funcs},
+        }
+
+
+cache = HookCache()
 
 
 def cached(func):
@@ -79,8 +193,7 @@ def cached(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
+        key = cache.make_key(func, args, kwargs)
         try:
             return cache[key]
         except KeyError:
@@ -93,14 +206,17 @@ def cached(func):
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache where key is one of the
+    string arguments of the cached call, or the cached function itself."""
+    cache.flush(getattr(key, '_wrapped', key))
+
+
+def cache_stats():
+    """Hit, miss and eviction counters of the function cache.
+
+    :rtype: Dict[str, Any]
+    """
+    return cache.stats()
 
 
 def log(message, level=None):
@@ -386,6 +502,12 @@ class Config(dict):
             if k not in self:
                 self[k] = v
 
+    def __setitem__(self, key, value):
+        changed = key not in self or self[key] != value
+        super(Config, self).__setitem__(key, value)
+        if changed:
+            _notify_inputs_changed()
+
     def changed(self, key):
         """Return True if the current value for this key is different from
         the previous value.
@@ -459,6 +581,15 @@ def config(scope=None):
 @cached
 def relation_get(attribute=None, unit=None, rid=None, app=None):
     """Get relation information"""
+    if _relation_snapshot is not None:
+        if app is None:
+            found, value = _relation_snapshot.get(attribute, unit, rid)
+        elif unit is None:
+            found, value = _relation_snapshot.get_app(attribute, app, rid)
+        else:
+            found = False
+        if found:
+            return value
     _args = ['relation-get', '--format=json']
     if app is not None:
         if unit is not None:
@@ -531,6 +662,13 @@ def relation_set(relation_id=None, relation_settings=None, app=False, **kwargs):
         subprocess.check_call(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
+    if _relation_snapshot is not None:
+        rid = relation_id or os.environ.get('JUJU_RELATION_ID')
+        if app:
+            _relation_snapshot.invalidate_app(rid)
+        else:
+            _relation_snapshot.invalidate(rid, local_unit(), settings.keys())
+    _notify_inputs_changed()
 
 
 def relation_clear(r_id=None):
@@ -550,6 +688,9 @@ def relation_ids(reltype=None):
     reltype = reltype or relation_type()
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
+        if (_relation_snapshot is not None and
+                reltype in _relation_snapshot.relation_ids):
+            return list(_relation_snapshot.relation_ids[reltype])
         relid_cmd_line.append(reltype)
         return json.loads(
             subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
@@ -560,6 +701,9 @@ def relation_ids(reltype=None):
 def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
+    if (_relation_snapshot is not None and
+            relid in _relation_snapshot.related_units):
+        return list(_relation_snapshot.related_units[relid])
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
@@ -567,6 +711,246 @@ def related_units(relid=None):
         subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
 
 
+class RelationSnapshot(object):
+    """In-memory copy of the relation data visible to the running hook.
+
+    The snapshot is gathered in a single pass (one relation-ids call per
+    relation type, one relation-list call per relation id, one relation-get
+    call per unit and one for the application data of the remote
+    application of each relation id with units) so that subsequent lookups
+    for individual attributes do not each spawn a hook tool.
+
+    Keys written with relation_set() are marked stale for the local unit so
+    that later reads of those keys go back to the hook tools; application
+    data written on a relation id is dropped from the snapshot.
+
+    If persist is True the snapshot is also stored in unitdata at the end of
+    a successful hook, together with a fingerprint of each relation's
+    membership.  The next hook then only reads units of the relation that
+    triggered it, relations whose membership changed and local unit data
+    written with relation_set(); everything else is served from the stored
+    copy.  Data changed on a relation whose hook has not yet run is
+    therefore only seen once that hook runs.
+    """
+
+    KV_KEY = 'charmhelpers.relation-snapshot'
+
+    def __init__(self, persist=False):
+        self.relation_ids = {}
+        self.related_units = {}
+        self.persist = persist
+        self._data = {}
+        self._stale = {}
+        self._fingerprints = {}
+        self._apps = {}
+        self._app_data = {}
+
+    @staticmethod
+    def fingerprint(units):
+        """Fingerprint of a relation's membership."""
+        return hashlib.sha256(
+            json.dumps(sorted(units)).encode('UTF-8')).hexdigest()
+
+    def load(self, reltypes=None):
+        """Gather relation data for the given relation types.
+
+        :param reltypes: Relation types to load, defaults to all relation
+                         types declared in the charm metadata.
+        :type reltypes: Optional[List[str]]
+        """
+        if reltypes is None:
+            reltypes = relation_types()
+        _local_unit = local_unit()
+        stored = {}
+        if self.persist:
+            from charmhelpers.core import unitdata
+            stored = unitdata.kv().get(self.KV_KEY) or {}
+        trigger = os.environ.get('JUJU_RELATION_ID')
+        for reltype in reltypes:
+            rids = json.loads(subprocess.check_output(
+                ['relation-ids', '--format=json', reltype]
+            ).decode('UTF-8')) or []
+            self.relation_ids[reltype] = rids
+            for rid in rids:
+                units = json.loads(subprocess.check_output(
+                    ['relation-list', '--format=json', '-r', rid]
+                ).decode('UTF-8')) or []
+                self.related_units[rid] = units
+                fingerprint = self.fingerprint(units)
+                self._fingerprints[rid] = fingerprint
+                cached = {}
+                if (rid != trigger and rid in stored and
+                        stored[rid]['fingerprint'] == fingerprint):
+                    cached = stored[rid]['data']
+                cached_app = {}
+                if cached:
+                    cached_app = stored[rid].get('app') or {}
+                for unit in units + [_local_unit]:
+                    if unit in cached:
+                        self._data[(rid, unit)] = cached[unit]
+                    else:
+                        self._data[(rid, unit)] = self._fetch(rid, unit)
+                if not units:
+                    continue
+                # all units of a relation id belong to the same application.
+                app = units[0].split('/')[0]
+                self._apps[rid] = app
+                if 'data' in cached_app:
+                    self._app_data[rid] = cached_app['data']
+                else:
+                    self._app_data[rid] = self._fetch(rid, app, app=True)
+
+    def digest(self, exclude_units=None):
+        """Digest of the relation ids, units, unit data and remote
+        application data in the snapshot.
+
+        :param exclude_units: Units whose data is left out of the digest,
+                              e.g. the local unit whose data is written by
+                              the charm itself.
+        :type exclude_units: Optional[List[str]]
+        :rtype: str
+        """
+        exclude_units = exclude_units or []
+        data = sorted(
+            [rid, unit, value]
+            for (rid, unit), value in self._data.items()
+            if unit not in exclude_units)
+        app_data = sorted(
+            [rid, self._apps[rid], value]
+            for rid, value in self._app_data.items())
+        return hashlib.sha256(json.dumps(
+            [sorted(self.relation_ids.items()), data, app_data],
+            sort_keys=True).encode('UTF-8')).hexdigest()
+
+    def save(self):
+        """Store the snapshot in unitdata for use by subsequent hooks.
+
+        Units with keys written during this hook are left out so that they
+        are read again by the next hook.
+        """
+        from charmhelpers.core import unitdata
+        stored = {}
+        for rid, fingerprint in self._fingerprints.items():
+            stored[rid] = {
+                'fingerprint': fingerprint,
+                'data': {unit: data
+                         for (_rid, unit), data in self._data.items()
+                         if _rid == rid and not self._stale.get((rid, unit))},
+                'app': ({'data': self._app_data[rid]}
+                        if rid in self._app_data else {}),
+            }
+        db = unitdata.kv()
+        db.set(self.KV_KEY, stored)
+        db.flush()
+
+    @staticmethod
+    def _fetch(rid, unit, app=False):
+        cmd = ['relation-get', '--format=json', '-r', rid, '-', unit]
+        if app:
+            cmd.insert(2, '--app')
+        try:
+            return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+        except ValueError:
+            return None
+        except CalledProcessError as e:
+            if e.returncode == 2:
+                return None
+            raise
+
+    def get(self, attribute=None, unit=None, rid=None):
+        """Look up relation data in the snapshot.
+
+        :returns: (found, value) where found is False if the lookup must be
+                  answered by the relation-get hook tool instead.
+        :rtype: Tuple[bool, Any]
+        """
+        rid = rid or os.environ.get('JUJU_RELATION_ID')
+        unit = unit or remote_unit()
+        key = (rid, unit)
+        if rid is None or unit is None or key not in self._data:
+            return False, None
+        stale = self._stale.get(key, ())
+        data = self._data[key]
+        if attribute is None:
+            if stale:
+                return False, None
+            return True, copy.deepcopy(data)
+        if attribute in stale:
+            return False, None
+        if data is None:
+            return True, None
+        return True, data.get(attribute)
+
+    def invalidate(self, rid, unit, keys):
+        """Mark keys written for unit on rid as stale."""
+        if rid is None:
+            return
+        self._stale.setdefault((rid, unit), set()).update(keys)
+
+    def get_app(self, attribute, app, rid=None):
+        """Look up application data in the snapshot.
+
+        :returns: (found, value) where found is False if the lookup must be
+                  answered by the relation-get hook tool instead.
+        :rtype: Tuple[bool, Any]
+        """
+        rid = rid or os.environ.get('JUJU_RELATION_ID')
+        if rid not in self._app_data or self._apps.get(rid) != app:
+            return False, None
+        data = self._app_data[rid]
+        if attribute is None:
+            return True, copy.deepcopy(data)
+        if data is None:
+            return True, None
+        return True, data.get(attribute)
+
+    def invalidate_app(self, rid):
+        """Drop application data of rid, which the charm has written."""
+        self._app_data.pop(rid, None)
+
+
+_relation_snapshot = None
+
+
+def prefetch_relations(reltypes=None, persist=False):
+    """Gather relation data in one pass and serve lookups from memory.
+
+    Once called, relation_get(), relation_ids() and related_units() are
+    answered from the snapshot for the remainder of the hook.
+
+    :param reltypes: Relation types to load, defaults to all relation types
+                     declared in the charm metadata.
+    :type reltypes: Optional[List[str]]
+    :param persist: Reuse relation data stored by previous hooks, and store
+                    the snapshot on successful completion of this hook.  See
+                    RelationSnapshot for the consistency trade-off.
+    :type persist: bool
+    :returns: The loaded snapshot.
+    :rtype: RelationSnapshot
+    """
+    global _relation_snapshot
+    snapshot = RelationSnapshot(persist=persist)
+    snapshot.load(reltypes)
+    _relation_snapshot = snapshot
+    if persist:
+        atexit(snapshot.save)
+    return snapshot
+
+
+def relation_snapshot():
+    """The relation snapshot loaded for this hook, if any.
+
+    :rtype: Optional[RelationSnapshot]
+    """
+    return _relation_snapshot
+
+
+def clear_relation_snapshot():
+    """Discard the relation snapshot, reverting to per-call hook tools."""
+    global _relation_snapshot
+    _relation_snapshot = None
+
+
 def expected_peer_units():
     """Get a generator for units we expect to join peer relation based on
     goal-state.
@@ -1242,6 +1626,7 @@ def leader_set(settings=None, **kwargs):
         else:
             cmd.append('{}={}'.format(k, v))
     subprocess.check_call(cmd)
+    _notify_inputs_changed()
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1344,6 +1729,33 @@ def atexit(callback, *args, **kwargs):
     _atexit.append((callback, args, kwargs))
 
 
+_inputs_changed = []
+
+
+def on_inputs_changed(callback):
+    """Call callback whenever the hook changes data that is read back by
+    context generators: relation data written with relation_set(), leader
+    settings written with leader_set() and values stored in the charm's
+    Config.
+
+    Bound methods are held by weak reference, so registering does not keep
+    their object alive.
+    """
+    if hasattr(callback, '__self__'):
+        _inputs_changed.append(weakref.WeakMethod(callback))
+    else:
+        _inputs_changed.append(lambda: callback)
+
+
+def _notify_inputs_changed():
+    for ref in list(_inputs_changed):
+        callback = ref()
+        if callback is None:
+            _inputs_changed.remove(ref)
+        else:
+            callback()
+
+
 def _run_atstart():
     '''Hook frameworks must invoke this before running the main hook body.'''
     global _atstart
@@ -821,7 +821,8 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
                              restart_functions=None,
                              can_restart_now_f=None,
                              post_svc_restart_f=None,
-                             pre_restarts_wait_f=None):
+                             pre_restarts_wait_f=None,
+                             changed_files_f=None):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
@@ -847,6 +848,12 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     occur. The use case for this is an application which wants to try and
     stagger restarts between units.
 
+    `changed_files_f` is a function returning the ordered list of files
+    written with changed content so far, e.g. the ``changed_files`` attribute
+    of an OSConfigRenderer.  When provided, the files in the restart map are
+    not hashed before and after lambda_f(); the entries appended to the list
+    during the call are used as the set of changed files instead.
+
     :param lambda_f: function to call.
     :type lambda_f: Callable[[], ANY]
     :param restart_map: {file: [service, ...]}
@@ -864,9 +871,24 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     :type post_svc_restart_f: Callable[[str], None]
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
+    :param changed_files_f: A function returning the files changed so far.
+    :type changed_files_f: Callable[[], List[str]]
     :returns: result of lambda_f()
     :rtype: ANY
     """
+    if changed_files_f is not None:
+        start = len(changed_files_f())
+        r = lambda_f()
+        changed = set(changed_files_f()[start:])
+        _restart_changed_services(
+            [path for path in restart_map if path in changed],
+            restart_map,
+            stopstart,
+            restart_functions,
+            can_restart_now_f,
+            post_svc_restart_f,
+            pre_restarts_wait_f)
+        return r
     checksums = _pre_restart_on_change_helper(restart_map)
     r = lambda_f()
     _post_restart_on_change_helper(checksums,
@@ -917,16 +939,43 @@ def _post_restart_on_change_helper(checksums,
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
     """
+    _restart_changed_services(
+        [path for path in restart_map
+         if path_hash(path) != checksums[path]],
+        restart_map,
+        stopstart,
+        restart_functions,
+        can_restart_now_f,
+        post_svc_restart_f,
+        pre_restarts_wait_f)
+
+
+def _restart_changed_services(changed_paths,
+                              restart_map,
+                              stopstart=False,
+                              restart_functions=None,
+                              can_restart_now_f=None,
+                              post_svc_restart_f=None,
+                              pre_restarts_wait_f=None):
+    """Restart the services associated with changed files.
+
+    :param changed_paths: Paths from the restart_map that have changed.
+    :type changed_paths: List[str]
+    :param restart_map: {file: [service, ...]}
+    :type restart_map: Dict[str, List[str,]]
+
+    The remaining parameters are as for _post_restart_on_change_helper().
+    """
     if restart_functions is None:
         restart_functions = {}
     changed_files = defaultdict(list)
     restarts = []
     # create a list of lists of the services to restart
-    for path, services in restart_map.items():
-        if path_hash(path) != checksums[path]:
-            restarts.append(services)
-            for svc in services:
-                changed_files[svc].append(path)
+    for path in changed_paths:
+        services = restart_map[path]
+        restarts.append(services)
+        for svc in services:
+            changed_files[svc].append(path)
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
     if services_list:
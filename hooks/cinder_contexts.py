@@ -12,6 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+from collections import OrderedDict
+from subprocess import CalledProcessError
+
+import yaml
+
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     config,
     relation_ids,
@@ -19,6 +26,8 @@ from charmhelpers.core.hookenv import (
     related_units,
     relation_get,
     log,
+    network_get,
+    unit_get,
     WARNING,
 )
 
@@ -33,6 +42,14 @@ from charmhelpers.contrib.openstack.utils import (
     CompareOpenStackReleases,
 )
 
+from charmhelpers.core.host import cmp_pkgrevno
+from charmhelpers.core.strutils import bytes_from_string
+
+from charmhelpers.contrib.network.ip import (
+    get_relation_ip,
+    is_ipv6,
+)
+
 from charmhelpers.contrib.hahelpers.cluster import (
     determine_apache_port,
     determine_api_port,
@@ -41,6 +58,66 @@ from charmhelpers.contrib.hahelpers.cluster import (
 
 CHARM_CEPH_CONF = '/var/lib/charm/{}/ceph.conf'
 
+LVM_GROUP_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+# RBD driver options: charm option -> (cinder.conf key, first release the
+# key is supported by).
+RBD_OPTIONS = OrderedDict([
+    ('rbd-exclusive-cinder-pool', ('rbd_exclusive_cinder_pool', 'queens')),
+    ('rbd-flatten-volume-from-snapshot',
+     ('rbd_flatten_volume_from_snapshot', 'icehouse')),
+    ('rbd-max-clone-depth', ('rbd_max_clone_depth', 'icehouse')),
+    ('rbd-store-chunk-size', ('rbd_store_chunk_size', 'icehouse')),
+    ('report-dynamic-total-capacity',
+     ('report_dynamic_total_capacity', 'queens')),
+    ('rados-connect-timeout', ('rados_connect_timeout', 'juno')),
+])
+
+# unitdata key holding the type the volumes pool was created with.
+CEPH_POOL_TYPE_KEY = 'cinder-ceph-pool-type'
+# Supported values of the pool-type and ec-profile-plugin options.
+POOL_TYPES = ('replicated', 'erasure-coded')
+EC_PLUGINS = ('jerasure', 'isa')
+# Settings of each backend of the ceph-backends option; the integer ones must
+# be positive.
+CEPH_BACKEND_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+CEPH_BACKEND_KEYS = ('pool', 'backend-name', 'pool-type', 'replicas',
+                     'device-class', 'crush-rule', 'ec-profile-k',
+                     'ec-profile-m', 'weight')
+CEPH_BACKEND_INT_KEYS = ('replicas', 'ec-profile-k', 'ec-profile-m')
+
+# Settings of the ceph-client-tuning option: setting -> (kind of value,
+# first ceph-common version supporting it).
+CEPH_CLIENT_TUNING = OrderedDict([
+    ('rbd cache', ('bool', None)),
+    ('rbd cache size', ('size', None)),
+    ('rbd cache max dirty', ('size', None)),
+    ('rbd cache target dirty', ('size', None)),
+    ('rbd cache policy', ('policy', '15.2.0')),
+    ('objecter inflight ops', ('int', None)),
+    ('objecter inflight op bytes', ('size', None)),
+    ('ms async op threads', ('int', None)),
+])
+RBD_CACHE_POLICIES = ('writethrough', 'writeback', 'writearound')
+
+# Binding of the network carrying volume I/O between targets and initiators.
+STORAGE_DATA_BINDING = 'storage-data'
+
+# Supported values of the target-helper option and the target-protocol
+# values each of them supports.
+TARGET_HELPERS = OrderedDict([
+    ('tgtadm', ('iscsi',)),
+    ('lioadm', ('iscsi',)),
+    ('nvmet', ('nvmet_tcp', 'nvmet_rdma')),
+])
+# Kernel modules needed by a target helper or protocol.
+TARGET_KERNEL_MODULES = {
+    'lioadm': ('target_core_mod', 'iscsi_target_mod'),
+    'nvmet': ('nvmet',),
+    'nvmet_tcp': ('nvmet_tcp',),
+    'nvmet_rdma': ('nvmet_rdma',),
+}
+
 
 def enable_lvm():
     """Check whether the LVM backend should be configured
@@ -50,6 +127,369 @@ def enable_lvm():
     return block_device.lower() != 'none'
 
 
+def parse_lvm_device_groups(value):
+    """Parse the lvm-device-groups option.
+
+    :param value: YAML mapping of group name to a space separated string, or
+                  list, of block devices or glob patterns
+    :type value: Optional[str]
+    :returns: group name -> list of devices, in configured order
+    :rtype: OrderedDict[str, List[str]]
+    :raises: ValueError if value is not a valid mapping
+    """
+    groups = OrderedDict()
+    if not value:
+        return groups
+    if not isinstance(value, str):
+        raise ValueError('lvm-device-groups must be a string')
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise ValueError('lvm-device-groups is not valid YAML: {}'.format(e))
+    if not isinstance(parsed, dict):
+        raise ValueError('lvm-device-groups must be a mapping of group name '
+                         'to block devices')
+    for name, devices in parsed.items():
+        if not LVM_GROUP_NAME.match(str(name)):
+            raise ValueError('Invalid lvm-device-groups group name {}'.format(
+                name))
+        if isinstance(devices, str):
+            devices = devices.split()
+        if not isinstance(devices, list) or not devices:
+            raise ValueError('lvm-device-groups group {} has no devices'
+                             .format(name))
+        groups[str(name)] = [str(d) for d in devices]
+    return groups
+
+
+def lvm_device_groups():
+    """Return the configured LVM device groups; none if the option is
+    invalid, which check_lvm_config() reports.
+
+    :rtype: OrderedDict[str, List[str]]
+    """
+    try:
+        return parse_lvm_device_groups(config('lvm-device-groups'))
+    except ValueError as e:
+        log(str(e), level=WARNING)
+        return OrderedDict()
+
+
+def lvm_group_backend_name(group):
+    """Return the cinder backend, and section, of an LVM device group."""
+    return 'LVM-{}'.format(group)
+
+
+def lvm_group_volume_group(group):
+    """Return the volume group of an LVM device group."""
+    return '{}-{}'.format(config('volume-group'), group)
+
+
+def target_kernel_modules(helper, protocol):
+    """Return the kernel modules needed to export volumes with helper over
+    protocol."""
+    return list(TARGET_KERNEL_MODULES.get(helper, ()) +
+                TARGET_KERNEL_MODULES.get(protocol, ()))
+
+
+def unsupported_rbd_options(release):
+    """Return the RBD driver options set in config which release does not
+    support."""
+    cmp_release = CompareOpenStackReleases(release)
+    return [option for option, (_, since) in RBD_OPTIONS.items()
+            if config(option) is not None and cmp_release < since]
+
+
+def rbd_options(release):
+    """Return the RBD driver options set in config as (key, value) pairs,
+    skipping those release does not support.
+
+    :rtype: List[Tuple[str, Any]]
+    """
+    unsupported = unsupported_rbd_options(release)
+    for option in unsupported:
+        log('{} is not supported by {}, ignoring'.format(option, release),
+            level=WARNING)
+    return [(key, config(option))
+            for option, (key, _) in RBD_OPTIONS.items()
+            if config(option) is not None and option not in unsupported]
+
+
+def storage_data_addresses():
+    """Return the addresses targets listen on for volume I/O: the primary
+    address of the storage-data binding, and any other addresses of the same
+    family bound to it for multipath.
+
+    An unbound storage-data binding resolves to the unit's private address;
+    targets are then left on cinder's own default (my_ip) rather than moved
+    onto that address.
+
+    :returns: the primary address and the secondary addresses, or None and
+              no addresses if storage-data is not bound to its own space
+    :rtype: Tuple[Optional[str], List[str]]
+    """
+    primary = get_relation_ip(STORAGE_DATA_BINDING)
+    if not primary or primary == unit_get('private-address'):
+        return None, []
+    try:
+        bindings = network_get(STORAGE_DATA_BINDING).get('bind-addresses')
+    except (NotImplementedError, CalledProcessError) as e:
+        log('Unable to get the {} bind addresses: {}'.format(
+            STORAGE_DATA_BINDING, e), level=WARNING)
+        bindings = None
+    secondary = []
+    for binding in bindings or []:
+        for address in binding.get('addresses') or []:
+            value = address.get('value')
+            if (value and value != primary and value not in secondary and
+                    is_ipv6(value) == is_ipv6(primary)):
+                secondary.append(value)
+    return primary, secondary
+
+
+def ceph_pool_weight():
+    """Return the percentage of the cluster's data the cinder pools are
+    expected to hold, from which Ceph derives their placement group count
+    and autoscaler target_size_ratio.
+
+    :rtype: float
+    """
+    if config('ceph-target-size-ratio') is not None:
+        return config('ceph-target-size-ratio') * 100.0
+    return float(config('ceph-pool-weight'))
+
+
+def _ceph_pool_share(parsed):
+    # ceph-pool-weight is shared by the CEPH backend's pool and the
+    # ceph-backends that do not set a weight of their own.
+    return ceph_pool_weight() / (
+        1 + sum(1 for settings in parsed.values()
+                if settings.get('weight') is None))
+
+
+def volume_pool_weight():
+    """Return the weight of the pool of the CEPH backend: its share of
+    ceph_pool_weight() with the ceph-backends that do not set a weight.
+
+    :rtype: float
+    """
+    try:
+        parsed = parse_ceph_backends(config('ceph-backends'))
+    except ValueError:
+        parsed = {}
+    return _ceph_pool_share(parsed)
+
+
+def pool_type():
+    """Return the type of the volumes pool: the type it was created with
+    once the Ceph broker has completed the request, the pool-type option
+    until then.
+    """
+    return unitdata.kv().get(CEPH_POOL_TYPE_KEY) or config('pool-type')
+
+
+def erasure_coded_pool():
+    """Whether volume data is stored in an erasure-coded pool."""
+    return pool_type() == 'erasure-coded'
+
+
+def rbd_pool_name():
+    """Return the pool Cinder creates volumes in.
+
+    With an erasure-coded pool this is the replicated metadata pool; the
+    data pool named after the application is set as the default data pool
+    in ceph.conf.
+    """
+    if erasure_coded_pool():
+        return '{}-metadata'.format(service_name())
+    return service_name()
+
+
+def _ceph_client_value(setting, kind, value):
+    if kind == 'bool':
+        if not isinstance(value, bool):
+            raise ValueError('ceph-client-tuning {} must be true or '
+                             'false'.format(setting))
+        return str(value).lower()
+    if kind == 'policy':
+        if value not in RBD_CACHE_POLICIES:
+            raise ValueError('ceph-client-tuning {} must be one of: '
+                             '{}'.format(setting,
+                                         ', '.join(RBD_CACHE_POLICIES)))
+        return value
+    if kind == 'size' and isinstance(value, str):
+        try:
+            value = bytes_from_string(value)
+        except (KeyError, ValueError):
+            pass
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError('ceph-client-tuning {} must be a non-negative '
+                         '{}'.format(setting, 'size' if kind == 'size'
+                                     else 'integer'))
+    return value
+
+
+def parse_ceph_client_tuning(value):
+    """Parse the ceph-client-tuning option.
+
+    Setting names may be written with spaces, underscores or dashes, and
+    sizes with a K, M or G suffix.
+
+    :param value: YAML mapping of client setting to value
+    :type value: Optional[str]
+    :returns: setting, as named in ceph.conf -> value, in configured order
+    :rtype: OrderedDict[str, Any]
+    :raises: ValueError if value is not a valid mapping
+    """
+    settings = OrderedDict()
+    if not value:
+        return settings
+    if not isinstance(value, str):
+        raise ValueError('ceph-client-tuning must be a string')
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise ValueError('ceph-client-tuning is not valid YAML: {}'.format(e))
+    if not isinstance(parsed, dict):
+        raise ValueError('ceph-client-tuning must be a mapping of client '
+                         'setting to value')
+    for name, setting_value in parsed.items():
+        setting = re.sub(r'[_-]', ' ', str(name)).strip()
+        if setting not in CEPH_CLIENT_TUNING:
+            raise ValueError('Unknown ceph-client-tuning setting {}, '
+                             'expected one of: {}'.format(
+                                 name, ', '.join(CEPH_CLIENT_TUNING)))
+        kind, _ = CEPH_CLIENT_TUNING[setting]
+        settings[setting] = _ceph_client_value(setting, kind, setting_value)
+    size = settings.get('rbd cache size')
+    for dirty in ('rbd cache max dirty', 'rbd cache target dirty'):
+        if size is not None and settings.get(dirty, 0) > size:
+            raise ValueError('ceph-client-tuning {} must not exceed rbd '
+                             'cache size'.format(dirty))
+    return settings
+
+
+def unsupported_ceph_client_tuning(settings):
+    """Return the settings the installed Ceph client does not support."""
+    return [setting for setting in settings
+            if CEPH_CLIENT_TUNING[setting][1] and
+            cmp_pkgrevno('ceph-common', CEPH_CLIENT_TUNING[setting][1]) < 0]
+
+
+def ceph_client_tuning():
+    """Return the ceph-client-tuning settings supported by the installed
+    Ceph client; none if the option is invalid, which check_ceph_config()
+    reports. Settings left unset keep the defaults of the Ceph release.
+
+    :rtype: OrderedDict[str, Any]
+    """
+    try:
+        settings = parse_ceph_client_tuning(config('ceph-client-tuning'))
+    except ValueError as e:
+        log(str(e), level=WARNING)
+        return OrderedDict()
+    for setting in unsupported_ceph_client_tuning(settings):
+        log('{} is not supported by the installed Ceph client, '
+            'ignoring'.format(setting), level=WARNING)
+        settings.pop(setting)
+    return settings
+
+
+def parse_ceph_backends(value):
+    """Parse the ceph-backends option.
+
+    :param value: YAML mapping of backend name to a mapping of its settings
+    :type value: Optional[str]
+    :returns: backend name -> settings, in configured order
+    :rtype: OrderedDict[str, Dict[str, Any]]
+    :raises: ValueError if value is not a valid mapping
+    """
+    backends = OrderedDict()
+    if not value:
+        return backends
+    if not isinstance(value, str):
+        raise ValueError('ceph-backends must be a string')
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise ValueError('ceph-backends is not valid YAML: {}'.format(e))
+    if not isinstance(parsed, dict):
+        raise ValueError('ceph-backends must be a mapping of backend name '
+                         'to settings')
+    for name, settings in parsed.items():
+        if not CEPH_BACKEND_NAME.match(str(name)):
+            raise ValueError('Invalid ceph-backends backend name {}'.format(
+                name))
+        settings = settings or {}
+        if not isinstance(settings, dict):
+            raise ValueError('ceph-backends backend {} settings must be a '
+                             'mapping'.format(name))
+        unknown = sorted(set(settings) - set(CEPH_BACKEND_KEYS))
+        if unknown:
+            raise ValueError('Unknown ceph-backends setting {} for backend '
+                             '{}'.format(', '.join(unknown), name))
+        if settings.get('pool-type', 'replicated') not in POOL_TYPES:
+            raise ValueError('Invalid ceph-backends pool-type {} for '
+                             'backend {}'.format(settings['pool-type'], name))
+        for key in CEPH_BACKEND_INT_KEYS:
+            if key in settings and not (
+                    isinstance(settings[key], int) and settings[key] > 0):
+                raise ValueError('ceph-backends {} of backend {} must be a '
+                                 'positive integer'.format(key, name))
+        weight = settings.get('weight')
+        if weight is not None and not (
+                isinstance(weight, (int, float)) and 0 < weight <= 100):
+            raise ValueError('ceph-backends weight of backend {} must be '
+                             'between 1 and 100'.format(name))
+        backends[str(name)] = settings
+    return backends
+
+
+def ceph_backends():
+    """Return the RBD backends configured in addition to the CEPH one;
+    none if the option is invalid, which check_ceph_config() reports.
+
+    An erasure-coded backend keeps the data of its volumes in pool and their
+    metadata in rbd_pool; otherwise both are the same replicated pool, which
+    crush_rule places on device_class when set.
+
+    :rtype: List[Dict[str, Any]]
+    """
+    try:
+        parsed = parse_ceph_backends(config('ceph-backends'))
+    except ValueError as e:
+        log(str(e), level=WARNING)
+        return []
+    share = _ceph_pool_share(parsed)
+    backends = []
+    for name, settings in parsed.items():
+        pool = settings.get('pool') or '{}-{}'.format(service_name(), name)
+        erasure_coded = settings.get('pool-type') == 'erasure-coded'
+        device_class = settings.get('device-class')
+        crush_rule = settings.get('crush-rule')
+        if not crush_rule and device_class and not erasure_coded:
+            crush_rule = 'replicated_{}'.format(device_class)
+        backends.append({
+            'name': name,
+            'backend_name': (settings.get('backend-name') or
+                             'CEPH-{}'.format(name)),
+            'pool': pool,
+            'rbd_pool': ('{}-metadata'.format(pool) if erasure_coded
+                         else pool),
+            'erasure_coded': erasure_coded,
+            'replicas': (settings.get('replicas') or
+                         config('ceph-osd-replication-count')),
+            'device_class': device_class,
+            'crush_rule': crush_rule,
+            'ec_profile_k': (settings.get('ec-profile-k') or
+                             config('ec-profile-k')),
+            'ec_profile_m': (settings.get('ec-profile-m') or
+                             config('ec-profile-m')),
+            'weight': float(settings.get('weight') or share),
+        })
+    return backends
+
+
 def ceph_config_file():
     return CHARM_CEPH_CONF.format(service_name())
 
@@ -74,7 +514,8 @@ class CephContext(OSContextGenerator):
         if not relation_ids('ceph'):
             return {}
         service = service_name()
-        cmp_os_release = CompareOpenStackReleases(os_release('cinder-common'))
+        release = os_release('cinder-common')
+        cmp_os_release = CompareOpenStackReleases(release)
         if cmp_os_release >= "icehouse":
             volume_driver = 'cinder.volume.drivers.rbd.RBDDriver'
         else:
@@ -85,14 +526,34 @@ class CephContext(OSContextGenerator):
             driver_key = 'volume_driver'
         return {
             driver_key: volume_driver,
-            # ensure_ceph_pool() creates pool based on service name.
-            'rbd_pool': service,
+            # get_ceph_request() creates pools based on service name.
+            'rbd_pool': rbd_pool_name(),
             'rbd_user': service,
             'host': service,
-            'rbd_ceph_conf': ceph_config_file()
+            'rbd_ceph_conf': ceph_config_file(),
+            'rbd_options': rbd_options(release),
+            'ceph_backends': ceph_backends(),
         }
 
 
+class CephClientContext(OSContextGenerator):
+    """Context for the [client] section of the charm-managed ceph.conf
+
+    @returns dict - Context describing the client tuning settings and the
+                    default data pool
+    """
+    interfaces = ['ceph-client']
+
+    def __call__(self):
+        if not relation_ids('ceph'):
+            return {}
+        # follow the pool type the pools were created with rather than the
+        # pool-type option read by the charmhelpers CephContext.
+        return {'rbd_client_cache_settings': ceph_client_tuning(),
+                'rbd_default_data_pool': (service_name()
+                                          if erasure_coded_pool() else None)}
+
+
 class HAProxyContext(OSContextGenerator):
     interfaces = ['cinder-haproxy']
 
@@ -153,8 +614,11 @@ class StorageBackendContext(OSContextGenerator):
         if CompareOpenStackReleases(os_release('cinder-common')) >= "ocata":
             if relation_ids('ceph'):
                 backends.append('CEPH')
+                backends.extend(b['backend_name'] for b in ceph_backends())
             if enable_lvm():
                 backends.append('LVM')
+            backends.extend(lvm_group_backend_name(group)
+                            for group in lvm_device_groups())
             # Use the package default backend to stop the service flapping.
             if not backends:
                 backends = ['LVM']
@@ -169,7 +633,10 @@ class StorageBackendContext(OSContextGenerator):
             'image_volume_cache_max_size_gb': config(
                 'image-volume-cache-max-size-gb'),
             'image_volume_cache_max_count': config(
-                'image-volume-cache-max-count')}
+                'image-volume-cache-max-count'),
+            'volume_copy_bps_limit': config('volume-copy-bps-limit'),
+            'volume_copy_blkio_cgroup_name': config(
+                'volume-copy-blkio-cgroup-name')}
 
 
 class LoggingConfigContext(OSContextGenerator):
@@ -249,22 +716,75 @@ class SectionalConfigContext(OSContextGenerator):
 
 
 class LVMContext(OSContextGenerator):
-    """Context describing the configuration of the LVM backend
+    """Context describing the configuration of the LVM backends
+
+    The backend on block-device is described at the top level, and it and
+    one backend per LVM device group in lvm_backends. Targets of all the
+    backends listen on the storage-data binding.
 
     @returns dict - Context describing LVM config
     """
+    @staticmethod
+    def backend(backend_name, volume_group, target_addresses):
+        ctxt = {
+            'volumes_dir': '/var/lib/cinder/volumes',
+            'volume_name_template': 'volume-%s',
+            'volume_group': volume_group,
+            'volume_driver': 'cinder.volume.drivers.lvm.LVMVolumeDriver',
+            'volume_backend_name': backend_name,
+            'lvm_type': config('lvm-type'),
+            'max_over_subscription_ratio': config(
+                'max-over-subscription-ratio'),
+            'reserved_percentage': config('reserved-percentage'),
+            'lvm_mirrors': 0,
+            'volume_clear': config('volume-clear'),
+            'volume_clear_size': config('volume-clear-size'),
+            'volume_clear_ionice': config('volume-clear-ionice'),
+            'target_helper': config('target-helper'),
+            'target_protocol': config('target-protocol')}
+        if target_addresses[0]:
+            ctxt['target_ip_address'] = target_addresses[0]
+            ctxt['target_secondary_ip_addresses'] = ','.join(
+                target_addresses[1])
+        # Thin volumes are laid out by their pool; cinder only mirrors
+        # thick volumes.
+        if (config('lvm-type') == 'default' and
+                config('lvm-raid-level') == 'raid1'):
+            ctxt['lvm_mirrors'] = config('lvm-stripes') - 1
+        return ctxt
+
     def __call__(self):
         ctxt = {}
+        backends = []
+        groups = lvm_device_groups()
+        if not enable_lvm() and not groups:
+            return ctxt
+        addresses = storage_data_addresses()
         if enable_lvm():
-            ctxt = {
-                'volumes_dir': '/var/lib/cinder/volumes',
-                'volume_name_template': 'volume-%s',
-                'volume_group': config('volume-group'),
-                'volume_driver': 'cinder.volume.drivers.lvm.LVMVolumeDriver',
-                'volume_backend_name': 'LVM'}
+            ctxt = self.backend('LVM', config('volume-group'), addresses)
+            backends.append(dict(ctxt))
+        for group in groups:
+            backends.append(self.backend(lvm_group_backend_name(group),
+                                         lvm_group_volume_group(group),
+                                         addresses))
+        if backends:
+            ctxt['lvm_backends'] = backends
         return ctxt
 
 
+class TargetContext(OSContextGenerator):
+    """Context listing the kernel modules loaded at boot for the volume
+    target helper
+
+    @returns dict - Context describing the target kernel modules
+    """
+    def __call__(self):
+        return {
+            'target_modules': target_kernel_modules(
+                config('target-helper'), config('target-protocol'))
+        }
+
+
 class VolumeUsageAuditContext(OSContextGenerator):
     """This context provides the configuration directive
     volume_usage_audit_period and also creates a crontab entry
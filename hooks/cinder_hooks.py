@@ -42,7 +42,11 @@ from cinder_utils import (
     do_openstack_upgrade,
     juju_log,
     migrate_database,
+    clear_ceph_pool_type,
     configure_lvm_storage,
+    configure_rbd_data_pools,
+    configure_target_helper,
+    expand_block_devices,
     register_configs,
     restart_map,
     run_in_apache,
@@ -52,18 +56,32 @@ from cinder_utils import (
     CLUSTER_RES,
     CINDER_CONF,
     CINDER_API_CONF,
+    VOLUME_THROTTLE_PACKAGES,
     CEPH_CONF,
     setup_ipv6,
     check_local_db_actions_complete,
+    check_lvm_config,
     filesystem_mounted,
     assess_status,
+    hook_inputs_unchanged,
+    record_ceph_pool_type,
+    record_hook_inputs,
     scrub_old_style_ceph,
     pause_unit_helper,
     resume_unit_helper,
     remove_old_packages,
 )
 
-from cinder_contexts import ceph_config_file
+from cinder_contexts import (
+    ceph_backends,
+    ceph_config_file,
+    erasure_coded_pool,
+    lvm_device_groups,
+    lvm_group_volume_group,
+    rbd_pool_name,
+    volume_pool_weight,
+)
+from cinder_profile import hook_profile
 
 from charmhelpers.core.hookenv import (
     config,
@@ -72,6 +90,7 @@ from charmhelpers.core.hookenv import (
     local_unit,
     log,
     open_port,
+    prefetch_relations,
     related_units,
     relation_get,
     relation_ids,
@@ -103,7 +122,7 @@ from charmhelpers.contrib.openstack.utils import (
     sync_db_with_multi_ipv6_addresses,
     os_release,
     is_unit_paused_set,
-    pausable_restart_on_change as restart_on_change,
+    pausable_restart_on_change,
     CompareOpenStackReleases,
     series_upgrade_prepare,
     series_upgrade_complete,
@@ -161,6 +180,16 @@ hooks = Hooks()
 CONFIGS = register_configs()
 
 
+def restart_on_change(restart_map, stopstart=False):
+    """Restart services for files CONFIGS rewrote with changed content,
+    rather than hashing every file in the restart map before and after the
+    decorated function.
+    """
+    return pausable_restart_on_change(
+        restart_map, stopstart=stopstart,
+        changed_files_f=lambda: CONFIGS.changed_files)
+
+
 @hooks.hook('install.real')
 @harden()
 def install():
@@ -195,6 +224,7 @@ def install():
     # and invoking /lib/open-iscsi/startup-checks.sh indirectly as
     # ExecStartPre script of it
     service_start('iscsid')
+    record_existing_ceph_pool_type()
 
 
 @hooks.hook('config-changed')
@@ -222,6 +252,12 @@ def config_changed():
     # configure block devices either local or from juju storage
     _configure_block_devices()
 
+    if service_enabled('volume'):
+        if conf['volume-copy-bps-limit']:
+            apt_install(filter_installed_packages(VOLUME_THROTTLE_PACKAGES),
+                        fatal=True)
+        configure_target_helper()
+
     if not config('action-managed-upgrade'):
         if openstack_upgrade_available('cinder-common'):
             status_set('maintenance', 'Running openstack upgrade')
@@ -234,6 +270,8 @@ def config_changed():
             for rid in relation_ids('backup-backend'):
                 relation_set(relation_id=rid,
                              upgrade_nonce=uuid.uuid4())
+            # contexts depend on the release just upgraded to
+            CONFIGS.invalidate_contexts()
 
     # overwrite config is not in conf file. so We can't use restart_on_change
     if config_value_changed('overwrite') and not is_unit_paused_set():
@@ -283,6 +321,13 @@ def _configure_block_devices():
     device configured in the config.
     """
     if service_enabled('volume'):
+        # An invalid configuration could act on the wrong volume group, e.g.
+        # a device in both block-device and lvm-device-groups; leave LVM
+        # alone and let assess_status() block the unit instead.
+        message = check_lvm_config()
+        if message:
+            juju_log('Not configuring lvm storage: {}'.format(message))
+            return
         block_devices = []
         # first see if a specified block device is configured
         conf = config()
@@ -295,14 +340,39 @@ def _configure_block_devices():
         block_devices.extend(storage_devs)
         if block_devices:
             status_set('maintenance', 'Checking configuration of lvm storage')
+        overwrite = conf['overwrite'] in ['true', 'True', True]
+        options = {
+            'wipe_method': conf['wipe-method'],
+            'lvm_type': conf['lvm-type'],
+            'thin_pool_chunk_size': conf['lvm-thin-pool-chunk-size'],
+            'thin_pool_metadata_size': conf['lvm-thin-pool-metadata-size'],
+            'lvm_stripes': conf['lvm-stripes'],
+            'lvm_stripe_size': conf['lvm-stripe-size'],
+            'lvm_raid_level': conf['lvm-raid-level'] or None,
+        }
         # Note that there may be None now, and remove-missing is set to true,
         # so we still have to run the function regardless of whether
         # block_devices is an empty list or not.
         configure_lvm_storage(block_devices,
                               conf['volume-group'],
-                              conf['overwrite'] in ['true', 'True', True],
+                              overwrite,
                               conf['remove-missing'],
-                              conf['remove-missing-force'])
+                              conf['remove-missing-force'],
+                              cache_devices=(conf['cache-devices'] or
+                                             '').split(),
+                              cache_mode=conf['cache-mode'],
+                              **options)
+        # Each device group is a volume group of its own.
+        for group, devices in lvm_device_groups().items():
+            status_set('maintenance',
+                       'Checking configuration of lvm storage for {}'
+                       .format(group))
+            configure_lvm_storage(expand_block_devices(devices),
+                                  lvm_group_volume_group(group),
+                                  overwrite,
+                                  conf['remove-missing'],
+                                  conf['remove-missing-force'],
+                                  **options)
 
 
 @hooks.hook('shared-db-relation-joined')
@@ -491,13 +561,75 @@ def ceph_joined():
     apt_install('ceph-common', fatal=True)
 
 
+def add_volume_pool_ops(rq, pool, rbd_pool, replicas, weight,
+                        erasure_profile=None, crush_rule=None):
+    """Add the broker ops creating the pools of an RBD backend to rq.
+
+    An erasure-coded backend, with erasure_profile settings, keeps the data
+    of its volumes in pool and their metadata in the replicated rbd_pool;
+    otherwise pool holds both and crush_rule, if any, places it.
+    """
+    if erasure_profile:
+        # Volume metadata is kept replicated, only data is erasure-coded.
+        # Metadata takes about 1% of the space of the data, driven by the
+        # number of volumes rather than their size.
+        metadata_weight = weight * 0.01
+        weight -= metadata_weight
+        profile = '{}-profile'.format(pool)
+        rq.add_op_create_pool(name=rbd_pool,
+                              replica_count=replicas,
+                              weight=metadata_weight,
+                              group="volumes",
+                              app_name='rbd')
+        rq.add_op_create_erasure_profile(
+            name=profile,
+            erasure_type=config('ec-profile-plugin'),
+            erasure_technique=config('ec-profile-technique'),
+            **erasure_profile)
+        rq.add_op_create_erasure_pool(name=pool,
+                                      erasure_profile=profile,
+                                      weight=weight,
+                                      group="volumes",
+                                      app_name='rbd',
+                                      allow_ec_overwrites=True)
+    elif crush_rule:
+        rq.add_op_create_replicated_pool(name=pool,
+                                         replica_count=replicas,
+                                         weight=weight,
+                                         group="volumes",
+                                         app_name='rbd',
+                                         crush_profile=crush_rule)
+    else:
+        rq.add_op_create_pool(name=pool,
+                              replica_count=replicas,
+                              weight=weight,
+                              group="volumes")
+
+
 def get_ceph_request():
     service = service_name()
     rq = CephBrokerRq()
-    replicas = config('ceph-osd-replication-count')
-    rq.add_op_create_pool(name=service,
-                          replica_count=replicas,
-                          group="volumes")
+    erasure_profile = None
+    if erasure_coded_pool():
+        erasure_profile = {
+            'k': config('ec-profile-k'),
+            'm': config('ec-profile-m'),
+            'device_class': config('ec-profile-device-class')}
+    add_volume_pool_ops(rq, service, rbd_pool_name(),
+                        config('ceph-osd-replication-count'),
+                        volume_pool_weight(), erasure_profile=erasure_profile)
+    # All the pools are requested at once, in the volumes group.
+    for backend in ceph_backends():
+        erasure_profile = None
+        if backend['erasure_coded']:
+            erasure_profile = {
+                'k': backend['ec_profile_k'],
+                'm': backend['ec_profile_m'],
+                'device_class': backend['device_class']}
+        add_volume_pool_ops(rq, backend['pool'], backend['rbd_pool'],
+                            backend['replicas'], backend['weight'],
+                            erasure_profile=erasure_profile,
+                            crush_rule=backend['crush_rule'])
     if config('restrict-ceph-pools'):
         rq.add_op_request_access_to_group(
             name="volumes",
@@ -514,6 +646,16 @@ def get_ceph_request():
     return rq
 
 
+def record_existing_ceph_pool_type():
+    """Record the pool type of Ceph pools created before the charm recorded
+    it, e.g. by a version of the charm this unit was upgraded from, so that
+    changing pool-type afterwards blocks the unit.
+    """
+    if (relation_ids('ceph') and
+            is_request_complete(get_ceph_request())):
+        record_ceph_pool_type()
+
+
 @hooks.hook('ceph-relation-changed')
 @restart_on_change(restart_map())
 def ceph_changed(relation_id=None):
@@ -529,8 +671,10 @@ def ceph_changed(relation_id=None):
 
     if is_request_complete(get_ceph_request()):
         log('Request complete')
+        record_ceph_pool_type()
         CONFIGS.write(CINDER_CONF)
         CONFIGS.write(ceph_config_file())
+        configure_rbd_data_pools()
         # Ensure that cinder-volume is restarted since only now can we
         # guarantee that ceph resources are ready.
         if not is_unit_paused_set():
@@ -543,6 +687,7 @@ def ceph_changed(relation_id=None):
 def ceph_broken():
     service = service_name()
     delete_keyring(service=service)
+    clear_ceph_pool_type()
     CONFIGS.write_all()
     remove_alternative(os.path.basename(CEPH_CONF), ceph_config_file())
 
@@ -660,6 +805,7 @@ def upgrade_charm():
     # and invoking /lib/open-iscsi/startup-checks.sh indirectly as
     # ExecStartPre script of it
     service_start('iscsid')
+    record_existing_ceph_pool_type()
 
 
 @hooks.hook('storage-backend-relation-changed')
@@ -735,9 +881,24 @@ def post_series_upgrade():
         resume_unit_helper, CONFIGS)
 
 
+def main(args):
+    hook = os.path.basename(args[0])
+    with hook_profile(hook, enabled=config('profile-hooks')):
+        # NOTE: the storage-backend, cluster and other relations are walked
+        # unit by unit by several contexts; load their data once per hook
+        # rather than once per lookup.
+        prefetch_relations(persist=config('relation-data-cache'))
+        try:
+            if config('skip-idle-hooks') and hook_inputs_unchanged(hook):
+                log('Inputs unchanged since last successful run, skipping {}'
+                    .format(hook), level=DEBUG)
+            else:
+                hooks.execute(args)
+                record_hook_inputs(hook)
+        except UnregisteredHookError as e:
+            juju_log('Unknown hook {} - skipping.'.format(e))
+        assess_status(CONFIGS)
+
+
 if __name__ == '__main__':
-    try:
-        hooks.execute(sys.argv)
-    except UnregisteredHookError as e:
-        juju_log('Unknown hook {} - skipping.'.format(e))
-    assess_status(CONFIGS)
+    main(sys.argv)
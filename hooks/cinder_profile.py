@@ -0,0 +1,300 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight hook profiler.
+
+While a hook runs, calls to the subprocess helpers used by hookenv, fetch,
+host and the storage helpers are timed along with context generation and
+template rendering. Each successful run is appended to a bounded ring buffer
+in the unit's kv store, which the hook-profile action summarises.
+"""
+
+import functools
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from charmhelpers.contrib.openstack.templating import (
+    OSConfigRenderer,
+    OSConfigTemplate,
+)
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    cache_stats,
+    log,
+    DEBUG,
+)
+
+PROFILE_KEY = 'cinder-hook-profile'
+# Number of hook runs kept in the ring buffer, and raw spans kept per run.
+# Per-command totals are kept for every span, including those dropped.
+MAX_RUNS = 64
+MAX_SPANS = 256
+# Long argument lists (e.g. relation-set payloads) are truncated.
+MAX_ARG_LENGTH = 128
+
+SUBPROCESS_FUNCTIONS = ('call', 'check_call', 'check_output', 'run')
+# Modules holding their own reference to the subprocess functions, i.e.
+# "from subprocess import check_call", that need rebinding too.
+INSTRUMENTED_MODULES = ('charmhelpers.', 'cinder_')
+
+SPAN_EXEC = 'exec'
+SPAN_CONTEXT = 'context'
+SPAN_RENDER = 'render'
+
+
+def _command(cmd):
+    if isinstance(cmd, (list, tuple)):
+        return [str(c) for c in cmd]
+    return str(cmd).split()
+
+
+def _add_span(totals, span):
+    entry = totals.setdefault(span['name'], {'calls': 0, 'total': 0.0,
+                                             'max': 0.0, 'failures': 0})
+    entry['calls'] += 1
+    entry['total'] += span['duration']
+    entry['max'] = max(entry['max'], span['duration'])
+    if span['rc']:
+        entry['failures'] += 1
+
+
+def _returncode(result):
+    if isinstance(result, int):
+        return result
+    return getattr(result, 'returncode', 0)
+
+
+class HookProfiler(object):
+    """Record spans for a single hook execution.
+
+    :param hook: name of the hook being profiled
+    :type hook: str
+    """
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.spans = []
+        self.dropped = 0
+        # {kind: {name: {'calls', 'total', 'max', 'failures'}}}
+        self.totals = defaultdict(dict)
+        self.started = None
+        self._patches = []
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, kind, name, args=None):
+        """Time the enclosed block as a span of the given kind.
+
+        The yielded dict may be updated with an 'rc' for the span.
+        """
+        record = {'kind': kind, 'name': name, 'args': args or [],
+                  'rc': None}
+        t0 = time.time()
+        try:
+            yield record
+        except subprocess.CalledProcessError as e:
+            record['rc'] = e.returncode
+            raise
+        except OSError as e:
+            record['rc'] = -(e.errno or 1)
+            raise
+        finally:
+            record['duration'] = round(time.time() - t0, 6)
+            _add_span(self.totals[kind], record)
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(record)
+            else:
+                self.dropped += 1
+
+    def _patch(self, owner, attr, replacement):
+        self._patches.append((owner, attr, getattr(owner, attr)))
+        setattr(owner, attr, replacement)
+
+    def _wrap_subprocess(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # check_call() and check_output() are implemented on top of
+            # call() and run(); only the outermost call is a span.
+            if getattr(self._local, 'active', False):
+                return func(*args, **kwargs)
+            cmd = _command(args[0] if args else kwargs.get('args', ''))
+            name = os.path.basename(cmd[0]) if cmd else ''
+            args_ = [a[:MAX_ARG_LENGTH] for a in cmd[1:]]
+            self._local.active = True
+            try:
+                with self.span(SPAN_EXEC, name, args_) as record:
+                    result = func(*args, **kwargs)
+                    record['rc'] = (_returncode(result)
+                                    if func.__name__ in ('call', 'run')
+                                    else 0)
+                    return result
+            finally:
+                self._local.active = False
+        return wrapper
+
+    def _wrap_evaluate(self, func):
+        @functools.wraps(func)
+        def wrapper(template, context):
+            # Only time real evaluations, not per-hook cache hits.
+            try:
+                cached = (template.context_cache is not None and
+                          context in template.context_cache)
+            except TypeError:
+                cached = False
+            if cached:
+                return func(template, context)
+            with self.span(SPAN_CONTEXT, type(context).__name__):
+                return func(template, context)
+        return wrapper
+
+    def _wrap_render(self, func):
+        @functools.wraps(func)
+        def wrapper(renderer, config_file):
+            with self.span(SPAN_RENDER, config_file):
+                return func(renderer, config_file)
+        return wrapper
+
+    def install(self):
+        """Start timing and instrument the helpers."""
+        self.started = time.time()
+        # keyed by id() as module attributes need not be hashable.
+        replacements = {}
+        for name in SUBPROCESS_FUNCTIONS:
+            func = getattr(subprocess, name)
+            replacements[id(func)] = self._wrap_subprocess(func)
+            self._patch(subprocess, name, replacements[id(func)])
+        for modname, module in list(sys.modules.items()):
+            if not modname.startswith(INSTRUMENTED_MODULES) or not module:
+                continue
+            for attr, value in list(vars(module).items()):
+                if id(value) in replacements:
+                    self._patch(module, attr, replacements[id(value)])
+        self._patch(OSConfigTemplate, '_evaluate',
+                    self._wrap_evaluate(OSConfigTemplate._evaluate))
+        self._patch(OSConfigRenderer, 'render',
+                    self._wrap_render(OSConfigRenderer.render))
+
+    def uninstall(self):
+        """Restore the original helpers."""
+        while self._patches:
+            owner, attr, original = self._patches.pop()
+            setattr(owner, attr, original)
+
+    def record(self):
+        """Return this run as a JSON serialisable dict.
+
+        :rtype: Dict[str, Any]
+        """
+        stats = cache_stats()
+        return {
+            'hook': self.hook,
+            'started': self.started,
+            'duration': round(time.time() - self.started, 6),
+            'spans': self.spans,
+            'dropped-spans': self.dropped,
+            'totals': self.totals,
+            'cache': {k: stats[k] for k in ('hits', 'misses', 'evictions')},
+        }
+
+    def save(self):
+        """Append this run to the ring buffer in the kv store."""
+        db = unitdata.kv()
+        runs = db.get(PROFILE_KEY, [])
+        runs.append(self.record())
+        db.set(PROFILE_KEY, runs[-MAX_RUNS:])
+        db.flush()
+
+
+@contextmanager
+def hook_profile(hook, enabled=True):
+    """Profile the enclosed block as a run of hook when enabled; the run is
+    only stored if the block succeeds."""
+    if not enabled:
+        yield None
+        return
+    profiler = HookProfiler(hook)
+    profiler.install()
+    succeeded = False
+    try:
+        yield profiler
+        succeeded = True
+    except SystemExit as e:
+        succeeded = e.code in (None, 0)
+        raise
+    finally:
+        profiler.uninstall()
+        # Flushing the kv store would also commit the partial writes of a
+        # failed hook, which are otherwise discarded.
+        if succeeded:
+            try:
+                profiler.save()
+            except Exception as e:
+                # Never fail a hook because its profile could not be stored.
+                log('Unable to save hook profile: {}'.format(e), level=DEBUG)
+
+
+def profile_runs():
+    """Return the profiled hook runs, oldest first.
+
+    :rtype: List[Dict[str, Any]]
+    """
+    return unitdata.kv().get(PROFILE_KEY, [])
+
+
+def _top_spans(runs, kind, limit):
+    totals = defaultdict(lambda: {'calls': 0, 'total': 0.0, 'max': 0.0,
+                                  'failures': 0})
+    for run in runs:
+        for name, run_entry in run['totals'].get(kind, {}).items():
+            entry = totals[name]
+            entry['calls'] += run_entry['calls']
+            entry['total'] += run_entry['total']
+            entry['max'] = max(entry['max'], run_entry['max'])
+            entry['failures'] += run_entry['failures']
+    top = sorted(totals.items(), key=lambda kv: kv[1]['total'],
+                 reverse=True)[:limit]
+    return [dict(name=name, total=round(entry['total'], 6), **{
+        k: entry[k] for k in ('calls', 'max', 'failures')})
+        for name, entry in top]
+
+
+def profile_report(limit=10):
+    """Summarise the profiled runs.
+
+    :param limit: number of entries to return in each list
+    :type limit: int
+    :returns: the slowest hook runs and the most expensive subprocesses,
+              context generators and templates by total time. Totals
+              include spans dropped from the raw span list of a run.
+    :rtype: Dict[str, Any]
+    """
+    runs = profile_runs()
+    slowest = sorted(runs, key=lambda r: r['duration'], reverse=True)
+    return {
+        'runs': len(runs),
+        'slowest-hooks': [
+            {'hook': r['hook'], 'started': r['started'],
+             'duration': r['duration'],
+             'spans': len(r['spans']) + r['dropped-spans'],
+             'dropped-spans': r['dropped-spans']}
+            for r in slowest[:limit]],
+        'top-subprocesses': _top_spans(runs, SPAN_EXEC, limit),
+        'top-contexts': _top_spans(runs, SPAN_CONTEXT, limit),
+        'top-templates': _top_spans(runs, SPAN_RENDER, limit),
+    }
@@ -14,15 +14,19 @@
 
 from __future__ import print_function
 
+import glob
+import hashlib
+import json
 import os
 import re
 import subprocess
 import uuid
 
-from copy import deepcopy
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import copy
 from tempfile import NamedTemporaryFile
+from types import MappingProxyType
 
 from charmhelpers.core.strutils import (
     bytes_from_string
@@ -40,8 +44,16 @@ from charmhelpers.core.hookenv import (
     INFO,
     ERROR,
     hook_name,
+    is_leader,
+    relation_snapshot,
+    service_name,
+    status_set,
+    storage_get,
+    storage_list,
 )
 
+from charmhelpers.core import unitdata
+
 from charmhelpers.fetch import (
     apt_upgrade,
     apt_update,
@@ -49,6 +61,7 @@ from charmhelpers.fetch import (
     add_source,
     apt_purge,
     apt_autoremove,
+    filter_installed_packages,
     filter_missing_packages,
 )
 
@@ -58,10 +71,13 @@ from charmhelpers.core.host import (
     mkdir,
     mounts,
     umount,
+    service_pause,
     service_restart,
+    service_resume,
     service_stop,
     service_start,
 )
+from charmhelpers.core.kernel import modprobe
 
 from charmhelpers.contrib.openstack.alternatives import install_alternative
 from charmhelpers.contrib.hahelpers.cluster import (
@@ -79,11 +95,7 @@ from charmhelpers.contrib.storage.linux.utils import (
 from charmhelpers.contrib.storage.linux.lvm import (
     create_lvm_physical_volume,
     create_lvm_volume_group,
-    deactivate_lvm_volume_group,
     extend_logical_volume_by_device,
-    is_lvm_physical_volume,
-    list_lvm_volume_group,
-    list_thin_logical_volume_pools,
     remove_lvm_physical_volume,
 )
 
@@ -148,9 +160,48 @@ API_PACKAGES = [
     'haproxy',
 ]
 VOLUME_PACKAGES = ['cinder-volume']
+# cgcreate and cgset, used by cinder to throttle volume copies.
+VOLUME_THROTTLE_PACKAGES = ['cgroup-tools']
+# Packages and the service providing each target helper other than tgtadm,
+# whose tgt daemon is installed with cinder-volume.
+TARGET_HELPER_PACKAGES = {
+    'lioadm': ['python3-rtslib-fb'],
+    'nvmet': ['nvmetcli'],
+}
+TARGET_HELPER_SERVICES = {
+    'lioadm': 'rtslib-fb-targetctl',
+    'nvmet': 'nvmet',
+}
 SCHEDULER_PACKAGES = ['cinder-scheduler']
 
 DEFAULT_LOOPBACK_SIZE = '5G'
+# Upper bound on block devices wiped and initialised concurrently.
+PREPARE_VOLUME_WORKERS = 8
+# Supported values of the wipe-method option; the first is the default.
+WIPE_METHODS = ('zap', 'blkdiscard', 'blkdiscard-secure', 'wipefs')
+# Supported values of the lvm-type option, and those using a thin pool.
+LVM_TYPES = ('default', 'thin', 'auto')
+THIN_LVM_TYPES = ('thin', 'auto')
+# Supported values of the volume-clear option; unset uses cinder's default.
+VOLUME_CLEAR_METHODS = (None, 'none', 'zero')
+# Supported values of the lvm-raid-level option, and the fewest physical
+# volumes (lvm-stripes) a volume can span with each.
+LVM_RAID_LEVELS = ('raid0', 'raid1', 'raid5', 'raid6', 'raid10')
+MIN_LVM_STRIPES = {None: 1, 'raid0': 2, 'raid1': 2, 'raid5': 3,
+                   'raid6': 5, 'raid10': 4}
+# Sizes, in megabytes, of the RADOS objects RBD volumes can be divided into.
+RBD_STORE_CHUNK_SIZES = (1, 2, 4, 8, 16, 32)
+# Supported values of the cache-mode option: lvmcache modes, and dm-writecache.
+CACHE_MODES = ('writethrough', 'writeback', 'writecache')
+CACHE_SEGTYPES = ('cache', 'writecache')
+# lvs fields reported by volume_cache_stats() for each cache type.
+CACHE_STATS_FIELDS = {
+    'cache': ('cache_total_blocks', 'cache_used_blocks',
+              'cache_dirty_blocks', 'cache_read_hits', 'cache_read_misses',
+              'cache_write_hits', 'cache_write_misses'),
+    'writecache': ('writecache_total_blocks', 'writecache_free_blocks',
+                   'writecache_writeback_blocks', 'writecache_error'),
+}
 
 # Cluster resource used to determine leadership when hacluster'd
 CLUSTER_RES = 'grp_cinder_vips'
@@ -158,6 +209,15 @@ CLUSTER_RES = 'grp_cinder_vips'
 CINDER_DB_INIT_RKEY = 'cinder-db-initialised'
 CINDER_DB_INIT_ECHO_RKEY = 'cinder-db-initialised-echo'
 
+# unitdata key holding, per hook eligible for the idle fast path, the
+# fingerprint of the inputs of its last successful run.
+HOOK_INPUTS_KEY = 'cinder-hook-inputs'
+# unitdata key set while tgt is stopped in favour of another target helper.
+TGT_PAUSED_KEY = 'cinder-tgt-paused'
+# unitdata key listing the ceph-backends whose data pool could not be set.
+RBD_DATA_POOL_FAILURES_KEY = 'cinder-rbd-data-pool-failures'
+IDLE_FAST_PATH_HOOKS = ('config-changed', 'update-status')
+
 
 class CinderCharmError(Exception):
     pass
@@ -176,6 +236,7 @@ APACHE_SITE_CONF = '/etc/apache2/sites-available/openstack_https_frontend'
 APACHE_SITE_24_CONF = '/etc/apache2/sites-available/' \
     'openstack_https_frontend.conf'
 MEMCACHED_CONF = '/etc/memcached.conf'
+TARGET_MODULES_CONF = '/etc/modules-load.d/cinder-target.conf'
 WSGI_CINDER_API_CONF = '/etc/apache2/sites-enabled/wsgi-openstack-api.conf'
 PACKAGE_CINDER_API_CONF = '/etc/apache2/conf-enabled/cinder-wsgi.conf'
 
@@ -207,6 +268,13 @@ def required_interfaces():
     return _interfaces
 
 
+# Context generators used by more than one config file are shared so that
+# OSConfigRenderer evaluates them once per hook.
+_HAPROXY_CONTEXT = cinder_contexts.HAProxyContext()
+_AUDIT_MIDDLEWARE_CONTEXT = context.KeystoneAuditMiddleware(service='cinder')
+_MEMCACHE_CONTEXT = context.MemcacheContext()
+_APACHE_SSL_CONTEXT = cinder_contexts.ApacheSSLContext()
+
 # Map config files to hook contexts and services that will be associated
 # with file in restart_on_changes()'s service map.
 BASE_RESOURCE_MAP = OrderedDict([
@@ -217,7 +285,7 @@ BASE_RESOURCE_MAP = OrderedDict([
                      context.OSConfigFlagContext(),
                      context.SyslogContext(),
                      cinder_contexts.CephContext(),
-                     cinder_contexts.HAProxyContext(),
+                     _HAPROXY_CONTEXT,
                      cinder_contexts.ImageServiceContext(),
                      cinder_contexts.CinderSubordinateConfigContext(
                          interface=['storage-backend', 'backup-backend'],
@@ -236,16 +304,16 @@ BASE_RESOURCE_MAP = OrderedDict([
                      cinder_contexts.RegionContext(),
                      context.InternalEndpointContext(),
                      cinder_contexts.VolumeUsageAuditContext(),
-                     context.MemcacheContext(),
+                     _MEMCACHE_CONTEXT,
                      cinder_contexts.SectionalConfigContext(),
                      cinder_contexts.LVMContext(),
-                     context.KeystoneAuditMiddleware(service='cinder')],
+                     _AUDIT_MIDDLEWARE_CONTEXT],
         'services': ['cinder-api', 'cinder-volume', 'cinder-scheduler',
                      'haproxy']
     }),
     (CINDER_API_CONF, {
         'contexts': [context.IdentityServiceContext(),
-                     context.KeystoneAuditMiddleware(service='cinder')],
+                     _AUDIT_MIDDLEWARE_CONTEXT],
         'services': ['cinder-api'],
     }),
     (CINDER_POLICY_JSON, {
@@ -253,24 +321,25 @@ BASE_RESOURCE_MAP = OrderedDict([
         'services': ['cinder-api']
     }),
     (CINDER_AUDIT_MAP, {
-        'contexts': [context.KeystoneAuditMiddleware(service='cinder')],
+        'contexts': [_AUDIT_MIDDLEWARE_CONTEXT],
         'services': ['cinder-api']
     }),
     (ceph_config_file(), {
-        'contexts': [context.CephContext()],
+        'contexts': [context.CephContext(),
+                     cinder_contexts.CephClientContext()],
         'services': ['cinder-volume']
     }),
     (HAPROXY_CONF, {
         'contexts': [context.HAProxyContext(singlenode_mode=True),
-                     cinder_contexts.HAProxyContext()],
+                     _HAPROXY_CONTEXT],
         'services': ['haproxy'],
     }),
     (APACHE_SITE_CONF, {
-        'contexts': [cinder_contexts.ApacheSSLContext()],
+        'contexts': [_APACHE_SSL_CONTEXT],
         'services': ['apache2'],
     }),
     (APACHE_SITE_24_CONF, {
-        'contexts': [cinder_contexts.ApacheSSLContext()],
+        'contexts': [_APACHE_SSL_CONTEXT],
         'services': ['apache2'],
     }),
     (APACHE_PORTS_CONF, {
@@ -291,39 +360,110 @@ def register_configs(release=None):
     release = release or os_release('cinder-common', base='icehouse')
     configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
                                           openstack_release=release)
-    for cfg, rscs in resource_map().items():
-        configs.register(cfg, rscs['contexts'])
+    if ceph_config_enabled():
+        install_ceph_config_alternative()
+    for cfg, rscs in resource_map(release).items():
+        configs.register(cfg, list(rscs['contexts']))
     return configs
 
 
+def ceph_config_enabled():
+    """Determine whether the charm managed ceph.conf should be rendered.
+
+    :returns: True if a ceph relation exists and is not being removed.
+    """
+    return bool(relation_ids('ceph')) and hook_name() != 'ceph-relation-broken'
+
+
+def install_ceph_config_alternative():
+    """Ensure the charm managed ceph.conf exists and is the ceph.conf
+    alternative.
+    """
+    # need to create this early, new peers will have a relation during
+    # registration before they've run the ceph hooks to create the
+    # directory.
+    mkdir(os.path.dirname(CEPH_CONF))
+    mkdir(os.path.dirname(ceph_config_file()))
+
+    # Install ceph config as an alternative for co-location with
+    # ceph and ceph-osd charm - cinder ceph.conf will be
+    # lower priority than both of these but thats OK
+    if not os.path.exists(ceph_config_file()):
+        # touch file for pre-templated generation
+        open(ceph_config_file(), 'w').close()
+    install_alternative(os.path.basename(CEPH_CONF),
+                        CEPH_CONF, ceph_config_file())
+
+
+# Resource maps computed during this hook execution, keyed by their inputs.
+_resource_maps = {}
+
+
+def reset_resource_map():
+    """Discard any resource map computed during this hook execution."""
+    _resource_maps.clear()
+
+
+def _resource_map_inputs(release):
+    """Return the inputs _build_resource_map() derives the map from.
+
+    These change during some hooks: apache2 is installed by the install
+    hook, enabled-services and target-helper are changed by config-changed,
+    the installed release by an upgrade and relations by their hooks.
+    """
+    conf = config()
+    return (release,
+            os_release('cinder-common'),
+            tuple(relation_ids('backup-backend')),
+            ceph_config_enabled(),
+            os.path.exists('/etc/apache2/conf-available'),
+            conf['enabled-services'],
+            conf['target-helper'],
+            conf['openstack-origin'])
+
+
 def resource_map(release=None):
     """
-    Dynamically generate a map of resources that will be managed for a single
-    hook execution.
+    Generate a map of resources that will be managed for a single hook
+    execution.
+
+    The map is computed once per set of inputs for the lifetime of the hook
+    and returned as a read-only mapping, so that a change of its inputs
+    during the hook yields a new map.
+
+    :param release: OpenStack release codename, defaults to the installed
+                    release.
+    :returns: MappingProxyType of config file to 'contexts' and 'services'
+              tuples.
     """
-    resource_map = deepcopy(BASE_RESOURCE_MAP)
     release = release or os_release('cinder-common', base='icehouse')
+    key = _resource_map_inputs(release)
+    if key not in _resource_maps:
+        _resource_maps[key] = _freeze_resource_map(
+            _build_resource_map(release))
+    return _resource_maps[key]
+
+
+def _freeze_resource_map(rmap):
+    return MappingProxyType(OrderedDict(
+        (cfg, MappingProxyType({
+            'contexts': tuple(rscs['contexts']),
+            'services': tuple(rscs['services'])}))
+        for cfg, rscs in rmap.items()))
+
+
+def _build_resource_map(release):
+    # NOTE: context generator instances are deliberately not copied so that
+    # generators shared between files remain shared.
+    resource_map = OrderedDict(
+        (cfg, {'contexts': list(rscs['contexts']),
+               'services': list(rscs['services'])})
+        for cfg, rscs in BASE_RESOURCE_MAP.items())
     if relation_ids('backup-backend'):
         resource_map[CINDER_CONF]['services'].append('cinder-backup')
         resource_map[ceph_config_file()]['services'].append('cinder-backup')
 
-    if relation_ids('ceph') and hook_name() != 'ceph-relation-broken':
-        # need to create this early, new peers will have a relation during
-        # registration # before they've run the ceph hooks to create the
-        # directory.
-        # !!! FIX: These side effects seem inappropriate for this method
-        mkdir(os.path.dirname(CEPH_CONF))
-        mkdir(os.path.dirname(ceph_config_file()))
-
-        # Install ceph config as an alternative for co-location with
-        # ceph and ceph-osd charm - cinder ceph.conf will be
-        # lower priority than both of these but thats OK
-        if not os.path.exists(ceph_config_file()):
-            # touch file for pre-templated generation
-            open(ceph_config_file(), 'w').close()
-        install_alternative(os.path.basename(CEPH_CONF),
-                            CEPH_CONF, ceph_config_file())
-    else:
+    if not ceph_config_enabled():
         resource_map.pop(ceph_config_file())
 
     if os.path.exists('/etc/apache2/conf-available'):
@@ -336,9 +476,15 @@ def resource_map(release=None):
         resource_map[cfg]['services'] = \
             filter_services(resource_map[cfg]['services'])
 
+    target_service = TARGET_HELPER_SERVICES.get(config()['target-helper'])
+    if target_service and service_enabled('volume'):
+        resource_map[TARGET_MODULES_CONF] = {
+            'contexts': [cinder_contexts.TargetContext()],
+            'services': [target_service]}
+
     if enable_memcache(source=config()['openstack-origin']):
         resource_map[MEMCACHED_CONF] = {
-            'contexts': [context.MemcacheContext()],
+            'contexts': [_MEMCACHE_CONTEXT],
             'services': ['memcached']}
 
     if not service_enabled('api'):
@@ -363,7 +509,7 @@ def resource_map(release=None):
         resource_map[WSGI_CINDER_API_CONF] = {
             'contexts': [context.WSGIWorkerConfigContext(name="cinder",
                                                          script=wsgi_script),
-                         cinder_contexts.HAProxyContext()],
+                         _HAPROXY_CONTEXT],
             'services': ['apache2']
         }
 
@@ -392,6 +538,78 @@ def juju_log(msg):
     log('[cinder] %s' % msg)
 
 
+def idle_fast_path_hook(hook):
+    """Whether hook only converges the unit on its inputs, and so may be
+    skipped when those inputs have not changed.
+
+    :param hook: str: name of the hook
+    :returns: bool
+    """
+    return (hook in IDLE_FAST_PATH_HOOKS or
+            hook.endswith('-relation-changed'))
+
+
+def hook_inputs_fingerprint():
+    """Fingerprint the inputs that drive configuration of the unit: charm
+    config, remote unit and application relation data, Juju storage, the
+    installed release and the paused and leadership state.
+
+    :returns: str digest, or None if relation data has not been prefetched.
+    """
+    snapshot = relation_snapshot()
+    if snapshot is None:
+        return None
+    inputs = {
+        'config': dict(config()),
+        # local unit data is written by the charm, not an input to it.
+        'relations': snapshot.digest(exclude_units=[local_unit()]),
+        'storage': sorted(storage_get('location', s)
+                          for s in storage_list('block-devices')),
+        'release': os_release('cinder-common', base='icehouse'),
+        'paused': is_unit_paused_set(),
+        'leader': is_leader(),
+    }
+    return hashlib.sha256(json.dumps(
+        inputs, sort_keys=True, default=str).encode('UTF-8')).hexdigest()
+
+
+def hook_inputs_unchanged(hook):
+    """Determine whether hook can take the idle fast path because its inputs
+    match those of its own last successful run.
+
+    The inputs are recorded per hook so that, for example, an update-status
+    run after a config change cannot make the following config-changed hook
+    skip applying it.
+
+    :param hook: str: name of the hook
+    :returns: bool
+    """
+    if not idle_fast_path_hook(hook):
+        return False
+    fingerprint = hook_inputs_fingerprint()
+    return (fingerprint is not None and
+            (unitdata.kv().get(HOOK_INPUTS_KEY) or {}).get(hook) ==
+            fingerprint)
+
+
+def record_hook_inputs(hook):
+    """Record the inputs of a successful hook run.
+
+    Hooks not eligible for the idle fast path (install, upgrade-charm, ...)
+    clear the records so that the next eligible hooks always run in full.
+
+    :param hook: str: name of the hook
+    """
+    db = unitdata.kv()
+    if idle_fast_path_hook(hook):
+        inputs = db.get(HOOK_INPUTS_KEY) or {}
+        inputs[hook] = hook_inputs_fingerprint()
+        db.set(HOOK_INPUTS_KEY, inputs)
+    else:
+        db.unset(HOOK_INPUTS_KEY)
+    db.flush()
+
+
 def determine_packages():
     '''Determine list of packages required for the currently enabled services.
 
@@ -403,6 +621,10 @@ def determine_packages():
                  ('scheduler', SCHEDULER_PACKAGES)]:
         if service_enabled(s):
             pkgs += p
+    if service_enabled('volume'):
+        if config()['volume-copy-bps-limit']:
+            pkgs += VOLUME_THROTTLE_PACKAGES
+        pkgs += TARGET_HELPER_PACKAGES.get(config()['target-helper'], [])
 
     pkgs.extend(token_cache_pkgs(source=config()['openstack-origin']))
 
@@ -472,7 +694,7 @@ def restart_map():
     :returns: dict: A dictionary mapping config file to lists of services
                     that should be restarted when file changes.
     '''
-    return OrderedDict([(cfg, v['services'])
+    return OrderedDict([(cfg, list(v['services']))
                         for cfg, v in resource_map().items()
                         if v['services']])
 
@@ -494,6 +716,107 @@ def services():
     return list(sorted(_services))
 
 
+PhysicalVolume = namedtuple('PhysicalVolume',
+                            ['name', 'vg_name', 'size', 'free'])
+VolumeGroup = namedtuple('VolumeGroup',
+                         ['name', 'size', 'free', 'pv_count', 'lv_count'])
+LogicalVolume = namedtuple('LogicalVolume',
+                           ['name', 'vg_name', 'attr', 'size', 'segtype'])
+
+
+class LVMInventory(object):
+    """Snapshot of the physical volumes, volume groups and logical volumes
+    on the unit.
+
+    The snapshot is taken with a single pvs, vgs and lvs call each; every
+    LVM decision in configure_lvm_storage() reads from it. Call refresh()
+    after changing LVM state. Logical volumes include hidden ones, such as
+    the data volume of a thin pool, without the brackets lvs puts around
+    their names.
+    """
+
+    REPORT_ARGS = ['--reportformat', 'json', '--units', 'b', '--nosuffix']
+
+    def __init__(self):
+        self.physical_volumes = {}
+        self.volume_groups = {}
+        self.logical_volumes = []
+        self.refresh()
+
+    @classmethod
+    def _report(cls, command, options, key, args=None):
+        out = subprocess.check_output(
+            [command, '--options', options] + cls.REPORT_ARGS + (args or []))
+        return [row
+                for report in json.loads(out.decode('UTF-8'))['report']
+                for row in report.get(key, [])]
+
+    @staticmethod
+    def _device_key(device):
+        # PVs may be configured through a symlink such as /dev/disk/by-id.
+        return os.path.realpath(device) if device.startswith('/') else device
+
+    def refresh(self):
+        """Reload the inventory from LVM."""
+        self.physical_volumes = {
+            self._device_key(pv['pv_name']): PhysicalVolume(
+                pv['pv_name'], pv['vg_name'] or None,
+                int(pv['pv_size']), int(pv['pv_free']))
+            for pv in self._report('pvs', 'pv_name,vg_name,pv_size,pv_free',
+                                   'pv')}
+        self.volume_groups = {
+            vg['vg_name']: VolumeGroup(
+                vg['vg_name'], int(vg['vg_size']), int(vg['vg_free']),
+                int(vg['pv_count']), int(vg['lv_count']))
+            for vg in self._report('vgs',
+                                   'vg_name,vg_size,vg_free,pv_count,lv_count',
+                                   'vg')}
+        self.logical_volumes = [
+            LogicalVolume(lv['lv_name'].strip('[]'), lv['vg_name'],
+                          lv['lv_attr'], int(lv['lv_size']), lv['segtype'])
+            for lv in self._report('lvs',
+                                   'lv_name,vg_name,lv_attr,lv_size,segtype',
+                                   'lv', ['--all'])]
+
+    def physical_volume(self, device):
+        """:returns: the PhysicalVolume on device, or None"""
+        return self.physical_volumes.get(self._device_key(device))
+
+    def is_physical_volume(self, device):
+        return self.physical_volume(device) is not None
+
+    def volume_group_of(self, device):
+        """:returns: the name of the volume group device belongs to, or
+                     None"""
+        pv = self.physical_volume(device)
+        return pv.vg_name if pv else None
+
+    def has_volume_group(self, volume_group):
+        return volume_group in self.volume_groups
+
+    def thin_pools(self):
+        """:returns: thin pool logical volumes, in vg/lv format"""
+        return ['{}/{}'.format(lv.vg_name, lv.name)
+                for lv in self.logical_volumes if lv.attr.startswith('t')]
+
+    def logical_volume(self, lv):
+        """:param lv: logical volume in vg/lv format
+        :returns: the LogicalVolume, or None"""
+        for volume in self.logical_volumes:
+            if '{}/{}'.format(volume.vg_name, volume.name) == lv:
+                return volume
+        return None
+
+    def is_cached(self, lv):
+        """:param lv: logical volume in vg/lv format
+        :returns: whether lv, or the data volume of thin pool lv, has a
+                  cache attached"""
+        return any(
+            volume is not None and volume.segtype in CACHE_SEGTYPES
+            for volume in (self.logical_volume(lv),
+                           self.logical_volume(lv + '_tdata')))
+
+
 def reduce_lvm_volume_group_missing(volume_group, extra_args=None):
     '''
     Remove all missing physical volumes from the volume group, if there
@@ -542,28 +865,256 @@ def remove_lvm_volume_group(volume_group):
     subprocess.check_call(['vgremove', '--force', volume_group])
 
 
-def ensure_lvm_volume_group_non_existent(volume_group):
+def ensure_lvm_volume_group_non_existent(volume_group, inventory=None):
     """Remove volume_group if it exists.
 
     :param volume_group: str: Name of volume group.
+    :param inventory: LVMInventory: LVM state to check, rather than querying
+                      LVM for the volume group.
     """
-    if not lvm_volume_group_exists(volume_group):
+    if inventory is not None:
+        exists = inventory.has_volume_group(volume_group)
+    else:
+        exists = lvm_volume_group_exists(volume_group)
+    if not exists:
         return
 
     remove_lvm_volume_group(volume_group)
 
 
-def log_lvm_info():
-    """Log some useful information about how LVM is setup."""
-    try:
-        pvscan_output = subprocess.check_output(['pvscan']).decode('UTF-8')
-        juju_log('pvscan: {}'.format(pvscan_output))
-    except subprocess.CalledProcessError:
-        juju_log('pvscan did not complete successfully; may not be setup yet')
+def thin_pool_name(volume_group):
+    '''Return the thin pool cinder uses for volumes in volume_group.
+
+    :param volume_group: str: Name of volume group.
+    :returns: str: Thin pool as vg/lv.
+    '''
+    return '{0}/{0}-pool'.format(volume_group)
+
+
+def lvm_layout_args(stripes=1, stripe_size=None, raid_level=None):
+    '''Return the lvcreate arguments spreading a volume over stripes
+    physical volumes.
+
+    :param stripes: int: Number of physical volumes to span, including
+                         RAID parity and mirrors.
+    :param stripe_size: str: Stripe size, e.g. 64k; LVM's default if not
+                             set. Not used by raid1.
+    :param raid_level: str: One of LVM_RAID_LEVELS, or None for a linear
+                            or striped volume.
+    :returns: list: lvcreate arguments, empty for a linear volume.
+    '''
+    if raid_level == 'raid1':
+        return ['--type', 'raid1', '--mirrors', str(stripes - 1)]
+    if raid_level == 'raid10':
+        args = ['--type', 'raid10', '--mirrors', '1',
+                '--stripes', str(stripes // 2)]
+    elif raid_level in ('raid5', 'raid6'):
+        parity = 1 if raid_level == 'raid5' else 2
+        args = ['--type', raid_level, '--stripes', str(stripes - parity)]
+    elif raid_level == 'raid0':
+        args = ['--type', 'raid0', '--stripes', str(stripes)]
+    elif stripes > 1:
+        args = ['--stripes', str(stripes)]
+    else:
+        return []
+    if stripe_size:
+        args.extend(['--stripesize', stripe_size])
+    return args
+
+
+def create_thin_pool(volume_group, chunk_size=None, metadata_size=None,
+                     devices=None, layout=None):
+    '''Create cinder's thin pool from the free space of volume_group.
+
+    5% of the free space is left for LVM to grow the pool metadata and for
+    its spare metadata volume. A RAID pool is created as a RAID volume that
+    is then converted to a thin pool, as lvcreate cannot do both at once.
+
+    :param volume_group: str: Name of volume group.
+    :param chunk_size: str: Thin pool chunk size, e.g. 64k; LVM's default
+                            if not set.
+    :param metadata_size: str: Thin pool metadata size, e.g. 1G; LVM's
+                               default if not set.
+    :param devices: list: Physical volumes to allocate the pool from; any
+                          in the volume group if not set.
+    :param layout: list: lvcreate arguments from lvm_layout_args() for the
+                         pool data.
+    '''
+    layout = layout or []
+    pool_args = []
+    if chunk_size:
+        pool_args.extend(['--chunksize', chunk_size])
+    if metadata_size:
+        pool_args.extend(['--poolmetadatasize', metadata_size])
+    name = thin_pool_name(volume_group).split('/')[1]
+    if '--type' in layout:
+        subprocess.check_call(
+            ['lvcreate', '--yes'] + layout + ['--extents', '95%FREE',
+                                              '--name', name, volume_group] +
+            (devices or []))
+        subprocess.check_call(
+            ['lvconvert', '--yes', '--type', 'thin-pool'] + pool_args +
+            [thin_pool_name(volume_group)])
+        return
+    cmd = ['lvcreate', '--type', 'thin-pool', '--extents', '95%FREE',
+           '--name', name] + layout + pool_args
+    subprocess.check_call(cmd + [volume_group] + (devices or []))
+
+
+def ensure_thin_pool(volume_group, inventory, chunk_size=None,
+                     metadata_size=None, devices=None, layout=None):
+    '''Create cinder's thin pool on volume_group if it does not exist.
+
+    :param volume_group: str: Name of volume group.
+    :param inventory: LVMInventory: LVM state of the unit.
+    :param chunk_size: str: Chunk size for a new pool.
+    :param metadata_size: str: Metadata size for a new pool.
+    :param devices: list: Physical volumes to allocate a new pool from.
+    :param layout: list: lvcreate arguments for the data of a new pool.
+    :returns: bool: Whether the pool was created; not if there is no free
+                    space for it.
+    '''
+    if not inventory.has_volume_group(volume_group):
+        juju_log("Volume group {} not found, not creating thin pool".format(
+            volume_group))
+        return False
+    if thin_pool_name(volume_group) in inventory.thin_pools():
+        return False
+    if devices:
+        free = sum(inventory.physical_volume(d).free for d in devices
+                   if inventory.is_physical_volume(d))
+    else:
+        free = inventory.volume_groups[volume_group].free
+    if not free:
+        # e.g. the volume group was filled by thick volumes; lvcreate would
+        # fail the hook on every run.
+        juju_log("Volume group {} has no free space, not creating thin "
+                 "pool {}".format(volume_group, thin_pool_name(volume_group)))
+        return False
+    juju_log("Creating thin pool {}".format(thin_pool_name(volume_group)))
+    create_thin_pool(volume_group, chunk_size, metadata_size, devices,
+                     layout)
+    return True
+
+
+def cache_volume_name(volume_group):
+    '''Return the LV holding the cache of cinder's thin pool.
+
+    :param volume_group: str: Name of volume group.
+    :returns: str: Cache volume as vg/lv.
+    '''
+    return '{0}/{0}-cache'.format(volume_group)
+
+
+def attach_volume_cache(lv, cache_volume, cache_mode='writethrough'):
+    '''Attach cache_volume to lv as an lvmcache or dm-writecache.
+
+    :param lv: str: Logical volume to cache, in vg/lv format.
+    :param cache_volume: str: Logical volume on the fast devices, in vg/lv
+                              format.
+    :param cache_mode: str: One of CACHE_MODES.
+    '''
+    if cache_mode == 'writecache':
+        cmd = ['lvconvert', '--yes', '--type', 'writecache']
+    else:
+        cmd = ['lvconvert', '--yes', '--type', 'cache',
+               '--cachemode', cache_mode]
+    subprocess.check_call(cmd + ['--cachevol', cache_volume, lv])
+
+
+def ensure_volume_cache(volume_group, cache_devices, inventory,
+                        cache_mode='writethrough'):
+    '''Cache cinder's thin pool on cache_devices if it is not cached.
+
+    A volume is created on all of the cache devices in volume_group and
+    attached to the thin pool data volume, so every thin volume cinder
+    creates is cached.
+
+    :param volume_group: str: Name of volume group.
+    :param cache_devices: list: Fast block devices, already physical
+                                volumes in volume_group.
+    :param inventory: LVMInventory: LVM state of the unit.
+    :param cache_mode: str: One of CACHE_MODES.
+    :returns: bool: Whether LVM state was changed.
+    '''
+    pool = thin_pool_name(volume_group)
+    if pool not in inventory.thin_pools():
+        juju_log("Thin pool {} not found, not configuring cache".format(pool))
+        return False
+    if inventory.is_cached(pool):
+        return False
+    devices = [d for d in cache_devices
+               if inventory.volume_group_of(d) == volume_group]
+    if not devices:
+        juju_log("No cache devices in {}, not configuring cache".format(
+            volume_group))
+        return False
+    cache_volume = cache_volume_name(volume_group)
+    if inventory.logical_volume(cache_volume) is None:
+        juju_log("Creating cache volume {} on {}".format(
+            cache_volume, ', '.join(devices)))
+        subprocess.check_call(
+            ['lvcreate', '--yes', '--extents', '100%PVS',
+             '--name', cache_volume.split('/')[1], volume_group] + devices)
+    juju_log("Attaching {} cache {} to {}".format(
+        cache_mode, cache_volume, pool))
+    attach_volume_cache(pool, cache_volume, cache_mode)
+    return True
+
+
+def volume_cache_stats(volume_group):
+    '''Return the statistics of the caches in volume_group.
+
+    :param volume_group: str: Name of volume group.
+    :returns: list: A dict per cached logical volume with its name, cache
+                    type and the CACHE_STATS_FIELDS for that type, plus the
+                    read and write hit ratios of an lvmcache.
+    '''
+    fields = sorted(set(f for fs in CACHE_STATS_FIELDS.values() for f in fs))
+    rows = LVMInventory._report(
+        'lvs', ','.join(['lv_name', 'segtype'] + fields), 'lv',
+        ['--all', volume_group])
+    stats = []
+    for row in rows:
+        if row['segtype'] not in CACHE_SEGTYPES:
+            continue
+        entry = {'lv': '{}/{}'.format(volume_group,
+                                      row['lv_name'].strip('[]')),
+                 'type': row['segtype']}
+        for field in CACHE_STATS_FIELDS[row['segtype']]:
+            entry[field] = int(row[field] or 0)
+        for op in ('read', 'write'):
+            hits = entry.get('cache_{}_hits'.format(op))
+            misses = entry.get('cache_{}_misses'.format(op))
+            if hits is not None:
+                entry['{}_hit_ratio'.format(op)] = (
+                    round(hits / float(hits + misses), 4)
+                    if hits + misses else None)
+        stats.append(entry)
+    return stats
+
+
+def log_lvm_info(inventory):
+    """Log some useful information about how LVM is setup.
+
+    :param inventory: LVMInventory: LVM state to log.
+    """
+    pvs = ['{} ({})'.format(pv.name, pv.vg_name or 'no VG')
+           for pv in sorted(inventory.physical_volumes.values())]
+    vgs = ['{} ({} PVs, {} free of {} bytes)'.format(
+        vg.name, vg.pv_count, vg.free, vg.size)
+        for vg in sorted(inventory.volume_groups.values())]
+    juju_log('LVM physical volumes: {}'.format(', '.join(pvs) or 'none'))
+    juju_log('LVM volume groups: {}'.format(', '.join(vgs) or 'none'))
 
 
 def configure_lvm_storage(block_devices, volume_group, overwrite=False,
-                          remove_missing=False, remove_missing_force=False):
+                          remove_missing=False, remove_missing_force=False,
+                          wipe_method='zap', lvm_type='default',
+                          thin_pool_chunk_size=None,
+                          thin_pool_metadata_size=None, cache_devices=None,
+                          cache_mode='writethrough', lvm_stripes=1,
+                          lvm_stripe_size=None, lvm_raid_level=None):
     ''' Configure LVM storage on the list of block devices provided
 
     :param block_devices: list: List of whitelisted block devices to detect
@@ -575,44 +1126,59 @@ def configure_lvm_storage(block_devices, volume_group, overwrite=False,
     :param remove_missing_force: bool: Remove missing physical volumes from
                            volume group even if logical volumes are allocated
                            on them. Overrides 'remove_missing' if set.
+    :param wipe_method: str: How new devices are wiped, one of WIPE_METHODS.
+    :param lvm_type: str: One of LVM_TYPES; thin types get a thin pool
+                          created on the volume group.
+    :param thin_pool_chunk_size: str: Chunk size of a new thin pool.
+    :param thin_pool_metadata_size: str: Metadata size of a new thin pool.
+    :param cache_devices: list: Fast block devices added to the volume group
+                                to cache the thin pool of a thin lvm_type;
+                                ignored for other types.
+    :param cache_mode: str: How the thin pool is cached, one of CACHE_MODES.
+    :param lvm_stripes: int: Number of physical volumes the data of a new
+                             thin pool spans.
+    :param lvm_stripe_size: str: Stripe size of a new thin pool.
+    :param lvm_raid_level: str: RAID level of a new thin pool, one of
+                                LVM_RAID_LEVELS.
     '''
-    log_lvm_info()
-    devices = []
-    for block_device in block_devices:
-        (block_device, size) = _parse_block_device(block_device)
-
-        if not is_device_mounted(block_device):
-            if size == 0 and is_block_device(block_device):
-                devices.append(block_device)
-            elif size > 0:
-                devices.append(ensure_loopback_device(block_device, str(size)))
+    layout = lvm_layout_args(lvm_stripes, lvm_stripe_size, lvm_raid_level)
+    lvm = LVMInventory()
+    log_lvm_info(lvm)
+    devices = _usable_block_devices(block_devices)
+    # The fast devices only cache a thin pool; with thick volumes they would
+    # be allocated from like any other device.
+    if lvm_type not in THIN_LVM_TYPES:
+        cache_devices = []
+    cache_devices = _usable_block_devices(cache_devices or [])
 
     # NOTE(jamespage)
     # might need todo an initial one-time scrub on install if need be
     vg_found = False
-    new_devices = []
-    for device in devices:
-        if not is_lvm_physical_volume(device):
+    unprepared = []
+    for device in devices + cache_devices:
+        if not lvm.is_physical_volume(device):
             # Unused device
             if overwrite is True or not has_partition_table(device):
-                prepare_volume(device)
-                new_devices.append(device)
-        elif (is_lvm_physical_volume(device) and
-              list_lvm_volume_group(device) != volume_group):
+                unprepared.append(device)
+        elif lvm.volume_group_of(device) != volume_group:
             # Existing LVM but not part of required VG or new device
             if overwrite is True:
-                prepare_volume(device)
-                new_devices.append(device)
-        elif (is_lvm_physical_volume(device) and
-                list_lvm_volume_group(device) == volume_group):
+                unprepared.append(device)
+        else:
             # Mark vg as found
             vg_found = True
 
-    log_lvm_info()
+    new_devices, failed = prepare_volumes(unprepared, lvm, wipe_method)
+
+    # vgreduce and any new devices change the LVM state from here on.
+    changed = bool(new_devices) or remove_missing or remove_missing_force
+    if new_devices:
+        lvm.refresh()
+        log_lvm_info(lvm)
 
     if vg_found is False and len(new_devices) > 0:
         if overwrite:
-            ensure_lvm_volume_group_non_existent(volume_group)
+            ensure_lvm_volume_group_non_existent(volume_group, inventory=lvm)
 
         # Create new volume group from first device
         create_lvm_volume_group(volume_group, new_devices[0])
@@ -631,12 +1197,24 @@ def configure_lvm_storage(block_devices, volume_group, overwrite=False,
                  .format(str(e)))
 
     if len(new_devices) > 0:
+        # Extending the volume group does not create or remove thin pools.
+        thin_pools = lvm.thin_pools()
+        if (lvm_type in THIN_LVM_TYPES and
+                thin_pool_name(volume_group) in thin_pools):
+            thin_pools = [thin_pool_name(volume_group)]
         # Extend the volume group as required
         for new_device in new_devices:
             extend_lvm_volume_group(volume_group, new_device)
-            thin_pools = list_thin_logical_volume_pools(path_mode=True)
+            if new_device in cache_devices:
+                continue
             if len(thin_pools) == 0:
                 juju_log("No thin pools found")
+            elif layout and thin_pools == [thin_pool_name(volume_group)]:
+                # A striped or RAID pool cannot be extended one device at
+                # a time.
+                juju_log("Thin pool {} spans {} devices, skipping auto "
+                         "extending with {}".format(thin_pools[0],
+                                                    lvm_stripes, new_device))
             elif len(thin_pools) == 1:
                 juju_log("Thin pool {} found, extending with {}".format(
                     thin_pools[0],
@@ -647,23 +1225,138 @@ def configure_lvm_storage(block_devices, volume_group, overwrite=False,
                          "skipping auto extending with {}".format(
                              ','.join(thin_pools),
                              new_device))
-    log_lvm_info()
+    if changed:
+        lvm.refresh()
+        log_lvm_info(lvm)
+
+    if lvm_type in THIN_LVM_TYPES:
+        # Keep the thin pool data off the cache devices.
+        data_devices = None
+        if cache_devices:
+            data_devices = [d for d in devices
+                            if lvm.volume_group_of(d) == volume_group]
+        if ensure_thin_pool(volume_group, lvm, thin_pool_chunk_size,
+                            thin_pool_metadata_size, data_devices, layout):
+            lvm.refresh()
+        if cache_devices and ensure_volume_cache(volume_group, cache_devices,
+                                                 lvm, cache_mode):
+            lvm.refresh()
+            log_lvm_info(lvm)
+
+    if failed:
+        raise CinderCharmError(
+            "Failed to prepare block devices: {}".format(
+                ', '.join(sorted(failed))))
+
+
+def configure_target_helper():
+    """Install the packages and load the kernel modules needed by the
+    configured target helper, and stop tgt unless it is the helper so that
+    it does not hold the iSCSI port. tgt is started again if the charm
+    stopped it and tgtadm is selected once more.
+    """
+    helper = config('target-helper')
+    if helper not in cinder_contexts.TARGET_HELPERS:
+        # reported by check_lvm_config()
+        return
+    apt_install(filter_installed_packages(
+        TARGET_HELPER_PACKAGES.get(helper, [])), fatal=True)
+    # TARGET_MODULES_CONF loads the modules at boot.
+    for module in cinder_contexts.target_kernel_modules(
+            helper, config('target-protocol')):
+        modprobe(module, persist=False)
+    db = unitdata.kv()
+    tgt_paused = db.get(TGT_PAUSED_KEY, False)
+    if helper in TARGET_HELPER_SERVICES and not tgt_paused:
+        service_pause('tgt')
+        db.set(TGT_PAUSED_KEY, True)
+    elif helper not in TARGET_HELPER_SERVICES and tgt_paused:
+        service_resume('tgt')
+        db.unset(TGT_PAUSED_KEY)
+    else:
+        return
+    db.flush()
 
 
-def prepare_volume(device):
+def prepare_volume(device, inventory=None, wipe_method='zap'):
     juju_log("prepare_volume: {}".format(device))
-    clean_storage(device)
+    release_storage(device, inventory)
+    initialise_volume(device, wipe_method)
+
+
+def initialise_volume(device, wipe_method='zap'):
+    '''Wipe a block device released by release_storage() and initialise it
+    as an LVM physical volume. Only the device itself is touched, so several
+    devices may be initialised in parallel.
+
+    :param device: str: Full path to block device.
+    :param wipe_method: str: How the device is wiped, see wipe_block_device.
+    '''
+    wipe_block_device(device, wipe_method)
     create_lvm_physical_volume(device)
     juju_log("prepared volume: {}".format(device))
 
 
+def prepare_volumes(devices, inventory=None, wipe_method='zap'):
+    '''Prepare block devices as LVM physical volumes in parallel.
+
+    Devices are first released one at a time by release_storage(), as
+    unmounting rewrites /etc/fstab and deactivating a volume group changes
+    LVM metadata shared between devices. They are then wiped and
+    initialised by initialise_volume() in a pool of at most
+    PREPARE_VOLUME_WORKERS threads. A device that fails does not stop the
+    others from being prepared.
+
+    :param devices: list: block devices to prepare
+    :param inventory: LVMInventory: LVM state read before preparing
+    :param wipe_method: str: How devices are wiped, one of WIPE_METHODS.
+    :returns: tuple: (devices prepared, in the order given,
+                      dict of device -> exception for devices that failed)
+    '''
+    if not devices:
+        return [], {}
+    prepared = set()
+    failed = {}
+    total = len(devices)
+    status_set('maintenance',
+               'Preparing block devices (0/{})'.format(total))
+    for device in devices:
+        juju_log("prepare_volume: {}".format(device))
+        try:
+            release_storage(device, inventory)
+        except Exception as e:
+            juju_log("Failed to prepare {}: {}".format(device, e))
+            failed[device] = e
+    released = [device for device in devices if device not in failed]
+    if not released:
+        return [], failed
+    workers = min(len(released), PREPARE_VOLUME_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(initialise_volume, device,
+                                   wipe_method): device
+                   for device in released}
+        for done, future in enumerate(as_completed(futures),
+                                      len(failed) + 1):
+            device = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                juju_log("Failed to prepare {}: {}".format(device, e))
+                failed[device] = e
+            else:
+                prepared.add(device)
+            status_set('maintenance',
+                       'Preparing block devices ({}/{})'.format(done, total))
+    return [device for device in devices if device in prepared], failed
+
+
 def has_partition_table(block_device):
     out = subprocess.check_output(['fdisk', '-l', block_device],
                                   stderr=subprocess.STDOUT).decode('UTF-8')
     return "doesn't contain a valid partition" not in out
 
 
-def clean_storage(block_device):
+def clean_storage(block_device, inventory=None, wipe_method='zap'):
     '''Ensures a block device is clean.  That is:
         - unmounted
         - any lvm volume groups are deactivated
@@ -671,6 +1364,23 @@ def clean_storage(block_device):
         - partition table wiped
 
     :param block_device: str: Full path to block device to clean.
+    :param inventory: LVMInventory: LVM state of the unit, taken afresh if
+                      not provided.
+    :param wipe_method: str: How the device is wiped, see wipe_block_device.
+    '''
+    release_storage(block_device, inventory)
+    wipe_block_device(block_device, wipe_method)
+
+
+def release_storage(block_device, inventory=None):
+    '''Unmount a block device, deactivating the volume group it belongs to
+    and removing its LVM physical volume signature. These steps edit
+    /etc/fstab and LVM metadata, so must not run for several devices at
+    once.
+
+    :param block_device: str: Full path to block device to release.
+    :param inventory: LVMInventory: LVM state of the unit, taken afresh if
+                      not provided.
     '''
     for mp, d in mounts():
         if d == block_device:
@@ -678,13 +1388,115 @@ def clean_storage(block_device):
                      (d, mp))
             umount(mp, persist=True)
 
-    if is_lvm_physical_volume(block_device):
-        deactivate_lvm_volume_group(block_device)
+    lvm = inventory or LVMInventory()
+    if lvm.is_physical_volume(block_device):
+        vg = lvm.volume_group_of(block_device)
+        if vg:
+            subprocess.check_call(['vgchange', '-an', vg])
         remove_lvm_physical_volume(block_device)
 
+
+def discard_max_bytes(block_device):
+    '''Return the largest discard request a block device accepts, as
+    reported by sysfs. Partitions report the limit of their parent disk.
+
+    :param block_device: str: Full path to block device.
+    :returns: int: Maximum discard size in bytes, 0 if discard is not
+                   supported or the device is not found in sysfs.
+    '''
+    sysfs = os.path.realpath(os.path.join(
+        '/sys/class/block',
+        os.path.basename(os.path.realpath(block_device))))
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        sysfs = os.path.dirname(sysfs)
+    try:
+        with open(os.path.join(sysfs, 'queue', 'discard_max_bytes')) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return 0
+
+
+def wipe_block_device(block_device, method='zap'):
+    '''Wipe a block device so it can be initialised as a physical volume.
+
+    zap: clear the partition tables and the start and end of the device
+         with zap_disk().
+    blkdiscard: discard every block of the device.
+    blkdiscard-secure: securely discard every block, falling back to a
+                       plain discard where that is not supported.
+    wipefs: erase the filesystem, RAID and partition table signatures.
+
+    Discard methods fall back to zap on devices that do not support
+    discard.
+
+    :param block_device: str: Full path to block device to wipe.
+    :param method: str: One of WIPE_METHODS.
+    '''
+    if method not in WIPE_METHODS:
+        juju_log('Unknown wipe-method {}, using zap'.format(method))
+        method = 'zap'
+
+    if method == 'wipefs':
+        subprocess.check_call(['wipefs', '--all', block_device])
+        return
+
+    if method.startswith('blkdiscard'):
+        if discard_max_bytes(block_device) > 0:
+            commands = [['blkdiscard', block_device]]
+            if method == 'blkdiscard-secure':
+                commands.insert(0, ['blkdiscard', '--secure', block_device])
+            for cmd in commands:
+                try:
+                    subprocess.check_call(cmd)
+                except subprocess.CalledProcessError as e:
+                    juju_log('{} failed on {}: {}'.format(
+                        ' '.join(cmd[:-1]), block_device, e))
+                    continue
+                # Discarded blocks need not read back as zeroes, so also
+                # clear any signatures that survived.
+                subprocess.check_call(['wipefs', '--all', block_device])
+                return
+        else:
+            juju_log('{} does not support discard'.format(block_device))
+        juju_log('Falling back to zap for {}'.format(block_device))
+
     zap_disk(block_device)
 
 
+def expand_block_devices(block_devices):
+    '''Expand glob patterns, e.g. /dev/sd[b-m], in a list of block devices.
+
+    :param block_devices: list: Block devices or patterns
+    :returns: list: Block devices, patterns replaced by their sorted matches
+    '''
+    devices = []
+    for device in block_devices:
+        if glob.has_magic(device):
+            devices.extend(sorted(glob.glob(device)))
+        else:
+            devices.append(device)
+    return devices
+
+
+def _usable_block_devices(block_devices):
+    '''Resolve configured block devices to the unmounted block devices and
+    loopback devices to use.
+
+    :param block_devices: list: Block devices as provided in configuration
+    :returns: list: Full paths to the devices
+    '''
+    devices = []
+    for block_device in block_devices:
+        (block_device, size) = _parse_block_device(block_device)
+
+        if not is_device_mounted(block_device):
+            if size == 0 and is_block_device(block_device):
+                devices.append(block_device)
+            elif size > 0:
+                devices.append(ensure_loopback_device(block_device, str(size)))
+    return devices
+
+
 def _parse_block_device(block_device):
     ''' Parse a block device string and return either the full path
     to the block device, or the path to a loopback device and its size
@@ -947,6 +1759,160 @@ def get_optional_interfaces():
     return optional_interfaces
 
 
+def check_lvm_config():
+    """Check the options of the LVM backend.
+
+    :returns: a message describing the first invalid option, or None
+    :rtype: Optional[str]
+    """
+    for option, values in (('lvm-type', LVM_TYPES),
+                           ('wipe-method', WIPE_METHODS),
+                           ('cache-mode', CACHE_MODES),
+                           ('volume-clear', VOLUME_CLEAR_METHODS)):
+        if config(option) not in values:
+            return 'Invalid {} {}, expected one of: {}'.format(
+                option, config(option), ', '.join(values))
+    if config('cache-devices') and config('lvm-type') not in THIN_LVM_TYPES:
+        return 'cache-devices requires lvm-type thin or auto'
+    raid_level = config('lvm-raid-level') or None
+    if raid_level not in (None,) + LVM_RAID_LEVELS:
+        return 'Invalid lvm-raid-level {}, expected one of: {}'.format(
+            raid_level, ', '.join(LVM_RAID_LEVELS))
+    stripes = config('lvm-stripes')
+    if stripes < MIN_LVM_STRIPES[raid_level] or (
+            raid_level == 'raid10' and stripes % 2):
+        return 'lvm-stripes {} is too few or uneven for {}'.format(
+            stripes, raid_level or 'a striped volume')
+    try:
+        groups = cinder_contexts.parse_lvm_device_groups(
+            config('lvm-device-groups'))
+    except ValueError as e:
+        return str(e)
+    claimed = {}
+    for device in (config('block-device') or '').split():
+        device = _parse_block_device(device)[0]
+        if device:
+            claimed[device] = 'block-device'
+    for group, devices in groups.items():
+        for device in expand_block_devices(devices):
+            if device in claimed:
+                return 'Block device {} is used by both {} and {}'.format(
+                    device, claimed[device], group)
+            claimed[device] = group
+    helper = config('target-helper')
+    if helper not in cinder_contexts.TARGET_HELPERS:
+        return 'Invalid target-helper {}, expected one of: {}'.format(
+            helper, ', '.join(cinder_contexts.TARGET_HELPERS))
+    protocols = cinder_contexts.TARGET_HELPERS[helper]
+    if config('target-protocol') not in protocols:
+        return ('Invalid target-protocol {} for target-helper {}, expected '
+                'one of: {}'.format(config('target-protocol'), helper,
+                                    ', '.join(protocols)))
+    if (helper in TARGET_HELPER_SERVICES and
+            CompareOpenStackReleases(os_release('cinder-common')) < 'rocky'):
+        return 'target-helper {} requires OpenStack Rocky or later'.format(
+            helper)
+    # Cinder can only mirror the thick volumes it creates itself.
+    if (config('lvm-type') not in THIN_LVM_TYPES and stripes > 1 and
+            raid_level != 'raid1'):
+        return ('lvm-stripes and lvm-raid-level {} require lvm-type thin '
+                'or auto'.format(raid_level or 'none'))
+    return None
+
+
+def check_ceph_config():
+    """Check the options of the Ceph RBD backend.
+
+    :returns: a message describing the first invalid option, or None
+    :rtype: Optional[str]
+    """
+    if not relation_ids('ceph'):
+        return None
+    for option, values in (('pool-type', cinder_contexts.POOL_TYPES),
+                           ('ec-profile-plugin', cinder_contexts.EC_PLUGINS)):
+        if config(option) not in values:
+            return 'Invalid {} {}, expected one of: {}'.format(
+                option, config(option), ', '.join(values))
+    created = unitdata.kv().get(cinder_contexts.CEPH_POOL_TYPE_KEY)
+    if created and config('pool-type') != created:
+        return ('pool-type cannot be changed from {} to {} once the Ceph '
+                'pools have been created'.format(created,
+                                                 config('pool-type')))
+    failed = unitdata.kv().get(RBD_DATA_POOL_FAILURES_KEY)
+    if failed:
+        return 'Unable to set the data pool of ceph-backends {}'.format(
+            ', '.join(failed))
+    if config('ec-profile-k') < 1 or config('ec-profile-m') < 1:
+        return 'ec-profile-k and ec-profile-m must be at least 1'
+    if not 0 < config('ceph-pool-weight') <= 100:
+        return 'ceph-pool-weight must be between 1 and 100'
+    ratio = config('ceph-target-size-ratio')
+    if ratio is not None and not 0 < ratio <= 1:
+        return 'ceph-target-size-ratio must be between 0 and 1'
+    release = os_release('cinder-common')
+    unsupported = cinder_contexts.unsupported_rbd_options(release)
+    if unsupported:
+        return '{} not supported by OpenStack {}'.format(
+            ', '.join(unsupported), release)
+    chunk_size = config('rbd-store-chunk-size')
+    if chunk_size is not None and (
+            chunk_size not in RBD_STORE_CHUNK_SIZES):
+        return ('Invalid rbd-store-chunk-size {}, expected a power of two '
+                'from 1 to 32'.format(chunk_size))
+    max_clone_depth = config('rbd-max-clone-depth')
+    if max_clone_depth is not None and max_clone_depth < 0:
+        return 'Invalid rbd-max-clone-depth {}'.format(max_clone_depth)
+    try:
+        cinder_contexts.parse_ceph_backends(config('ceph-backends'))
+        tuning = cinder_contexts.parse_ceph_client_tuning(
+            config('ceph-client-tuning'))
+    except ValueError as e:
+        return str(e)
+    unsupported = cinder_contexts.unsupported_ceph_client_tuning(tuning)
+    if unsupported:
+        return '{} not supported by the installed Ceph client'.format(
+            ', '.join(unsupported))
+    backends = cinder_contexts.ceph_backends()
+    if backends and CompareOpenStackReleases(release) < 'ocata':
+        return 'ceph-backends requires OpenStack Ocata or later'
+    pools = {service_name(), cinder_contexts.rbd_pool_name()}
+    names = {'CEPH'}
+    for backend in backends:
+        for pool in {backend['pool'], backend['rbd_pool']}:
+            if pool in pools:
+                return 'Ceph pool {} is used by more than one backend'.format(
+                    pool)
+            pools.add(pool)
+        if backend['backend_name'] in names:
+            return 'Backend name {} is used more than once'.format(
+                backend['backend_name'])
+        names.add(backend['backend_name'])
+    total = cinder_contexts.volume_pool_weight() + sum(
+        backend['weight'] for backend in backends)
+    if total > 100:
+        return ('The Ceph pools of cinder weigh {:g}% of the cluster in '
+                'total, more than 100%'.format(round(total, 2)))
+    return None
+
+
+def record_ceph_pool_type():
+    """Record the type the volumes pool was created with, once the Ceph
+    broker has completed the request, so that later changes of the
+    pool-type option neither alter the pools used nor go unnoticed.
+    """
+    db = unitdata.kv()
+    if db.get(cinder_contexts.CEPH_POOL_TYPE_KEY) is None:
+        db.set(cinder_contexts.CEPH_POOL_TYPE_KEY, config('pool-type'))
+        db.flush()
+
+
+def clear_ceph_pool_type():
+    """Forget the type of the volumes pool when the ceph relation goes."""
+    db = unitdata.kv()
+    db.unset(cinder_contexts.CEPH_POOL_TYPE_KEY)
+    db.flush()
+
+
 def check_optional_relations(configs):
     """Check that if we have a relation_id for high availability that we can
     get the hacluster config.  If we can't then we are blocked.  This function
@@ -964,6 +1930,9 @@ def check_optional_relations(configs):
             return ('blocked',
                     'hacluster missing configuration: '
                     'vip, vip_iface, vip_cidr')
+    message = check_lvm_config() or check_ceph_config()
+    if message:
+        return 'blocked', message
     # return 'unknown' as the lowest priority to not clobber an existing
     # status.
     return 'unknown', ''
@@ -1076,3 +2045,36 @@ def scrub_old_style_ceph():
                 if not ceph_match(line):
                     print(line, end='', file=outfile)
     os.rename(outfile.name, input_file.name)
+
+
+def configure_rbd_data_pools():
+    """Set the data pool of the volumes of each backend of the ceph-backends
+    option on its pool.
+
+    The default data pool in ceph.conf only serves the CEPH backend, so it is
+    overridden per pool: erasure-coded backends write their data to their
+    erasure-coded pool and, when the CEPH backend is erasure-coded, the other
+    backends to their own pool.
+
+    Backends whose data pool could not be set are recorded so that the unit
+    is blocked until a later attempt succeeds, rather than volumes silently
+    landing in the wrong pool.
+    """
+    service = service_name()
+    failed = []
+    for backend in cinder_contexts.ceph_backends():
+        if not (backend['erasure_coded'] or
+                cinder_contexts.erasure_coded_pool()):
+            continue
+        try:
+            subprocess.check_call(
+                ['rbd', '--id', service, 'config', 'pool', 'set',
+                 backend['rbd_pool'], 'rbd_default_data_pool',
+                 backend['pool']])
+        except subprocess.CalledProcessError as e:
+            log('Unable to set the data pool of {}: {}'.format(
+                backend['rbd_pool'], e), level=ERROR)
+            failed.append(backend['name'])
+    db = unitdata.kv()
+    db.set(RBD_DATA_POOL_FAILURES_KEY, failed)
+    db.flush()
@@ -0,0 +1,107 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scale benchmark for the cinder hooks.
+
+Runs hooks from hooks/cinder_hooks.py against synthetic models with a
+growing number of related units and reports wall time and hook tool call
+counts per run. From the top of the charm:
+
+    python3 -m unit_tests.benchmark_hooks
+    python3 -m unit_tests.benchmark_hooks --units 1 200 --repeat 5 --json
+"""
+
+import argparse
+import json
+import sys
+
+from hooktools import HookRunner, HookToolSimulator
+
+# (label, hook, relation id the hook runs for)
+BENCHMARK_HOOKS = (
+    ('install', 'install.real', None),
+    ('config-changed', 'config-changed', None),
+    ('storage-backend-relation-changed', 'storage-backend-relation-changed',
+     'storage-backend:6'),
+    ('cluster-relation-changed', 'cluster-relation-changed', 'cluster:5'),
+    ('update-status', 'update-status', None),
+)
+DEFAULT_UNITS = (1, 10, 50, 100, 200)
+# Columns of the text report, in addition to the total.
+REPORTED_TOOLS = ('relation-get', 'relation-set', 'relation-ids',
+                  'relation-list', 'config-get', 'network-get')
+
+
+def benchmark(units=DEFAULT_UNITS, repeat=3, hooks=BENCHMARK_HOOKS):
+    """Run each hook repeat times for each model size.
+
+    :param units: model sizes, in units per scaled relation
+    :type units: Iterable[int]
+    :param repeat: runs per hook and model size; the fastest is reported
+    :type repeat: int
+    :returns: one result per hook and model size
+    :rtype: List[Dict[str, Any]]
+    """
+    results = []
+    for size in units:
+        simulator = HookToolSimulator.synthetic(size)
+        with HookRunner(simulator) as runner:
+            for label, hook, relation_id in hooks:
+                runs = [runner.run(hook, relation_id)
+                        for _ in range(repeat)]
+                fastest = min(runs, key=lambda r: r.duration)
+                results.append({
+                    'hook': label,
+                    'units': size,
+                    'wall': round(fastest.duration, 6),
+                    'calls': dict(fastest.calls),
+                })
+    return results
+
+
+def format_results(results):
+    header = ['hook', 'units', 'wall (ms)', 'calls'] + list(REPORTED_TOOLS)
+    rows = [header]
+    for r in results:
+        rows.append([r['hook'], str(r['units']),
+                     '{:.1f}'.format(r['wall'] * 1000),
+                     str(sum(r['calls'].values()))] +
+                    [str(r['calls'].get(t, 0)) for t in REPORTED_TOOLS])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join(
+        '  '.join(c.ljust(w) if i == 0 else c.rjust(w)
+                  for i, (c, w) in enumerate(zip(row, widths)))
+        for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--units', type=int, nargs='+',
+                        default=list(DEFAULT_UNITS),
+                        help='model sizes to run (units per relation)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per hook and size, fastest is reported')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args(argv)
+    results = benchmark(args.units, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_results(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
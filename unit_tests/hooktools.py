@@ -0,0 +1,576 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-in for the Juju hook tools.
+
+HookToolSimulator answers relation-get, relation-ids, relation-list,
+relation-set, config-get, storage-list, storage-get, status-set, juju-log
+and the other hook tools used by charmhelpers from a YAML model, and counts
+every command the charm runs. Commands that are not hook tools (apt-get,
+lvm, systemctl, ...) succeed with the output given in the model's
+"commands" section, or with no output.
+
+HookRunner executes hooks in-process against a simulator through
+cinder_hooks.main(), as hooks/cinder_hooks.py does when run by Juju, with
+writes to the host redirected into the simulator.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from unittest import mock
+
+import yaml
+
+CHARM_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures',
+                       'hooktools-model.yaml')
+
+SUBPROCESS_FUNCTIONS = ('call', 'check_call', 'check_output', 'run', 'Popen')
+HOST_FUNCTIONS = ('mkdir', 'write_file')
+# Modules holding their own reference to the patched functions.
+PATCHED_MODULES = ('charmhelpers.', 'cinder_')
+
+
+def _config_defaults():
+    with open(os.path.join(CHARM_DIR, 'config.yaml')) as f:
+        options = yaml.safe_load(f)['options']
+    return {k: v.get('default') for k, v in options.items()}
+
+
+def _expand(value, n):
+    if isinstance(value, str):
+        return value.replace('{n}', str(n))
+    if isinstance(value, dict):
+        return {k: _expand(v, n) for k, v in value.items()}
+    return value
+
+
+class FakePopen(object):
+
+    def __init__(self, simulator, args, **kwargs):
+        self.args = args
+        self.returncode, self._stdout = simulator.dispatch(args)
+        self._text = _text_mode(kwargs)
+
+    def communicate(self, input=None, timeout=None):
+        return _decode(self._stdout, self._text), _decode(b'', self._text)
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _text_mode(kwargs):
+    return bool(kwargs.get('universal_newlines') or kwargs.get('text') or
+                kwargs.get('encoding'))
+
+
+def _decode(output, text):
+    return output.decode('UTF-8') if text else output
+
+
+@contextmanager
+def patch_everywhere(replacements):
+    """Patch (owner, attr, replacement) along with every copy of the
+    patched function bound into charmhelpers and charm modules."""
+    originals = {id(getattr(owner, attr)): replacement
+                 for owner, attr, replacement in replacements}
+    patches = [mock.patch.object(owner, attr, replacement)
+               for owner, attr, replacement in replacements]
+    for modname, module in list(sys.modules.items()):
+        if not modname.startswith(PATCHED_MODULES) or module is None:
+            continue
+        for attr, value in list(vars(module).items()):
+            if id(value) in originals:
+                patches.append(mock.patch.object(
+                    module, attr, originals[id(value)]))
+    for p in patches:
+        p.start()
+    try:
+        yield
+    finally:
+        for p in reversed(patches):
+            p.stop()
+
+
+class HookToolSimulator(object):
+    """Serve hook tools from a model.
+
+    :param model: the model, in the format of fixtures/hooktools-model.yaml
+    :type model: Dict[str, Any]
+    """
+
+    def __init__(self, model):
+        self.model = copy.deepcopy(model)
+        self.model.setdefault('config', {})
+        self.model.setdefault('relations', {})
+        self.model.setdefault('storage', {})
+        self.model.setdefault('commands', {})
+        self.model.setdefault('leader-settings', {})
+        self.config = _config_defaults()
+        self.config.update(self.model['config'])
+        self.env = {}
+        self.calls = Counter()
+        self.commands = []
+        self.logs = []
+        self.status = ('unknown', '')
+        self.files = {}
+        self.dirs = set()
+
+    @classmethod
+    def from_yaml(cls, path=FIXTURE):
+        with open(path) as f:
+            return cls(yaml.safe_load(f))
+
+    @classmethod
+    def synthetic(cls, units, path=FIXTURE):
+        """Load a model, expanding template units into units copies.
+
+        :param units: number of units per templated relation
+        :type units: int
+        """
+        with open(path) as f:
+            model = yaml.safe_load(f)
+        for relations in model.get('relations', {}).values():
+            for relation in relations:
+                expanded = {}
+                for name, data in relation.get('units', {}).items():
+                    if '{n}' not in name:
+                        expanded[name] = data
+                        continue
+                    for n in range(1, units + 1):
+                        expanded[_expand(name, n)] = _expand(data, n)
+                relation['units'] = expanded
+        return cls(model)
+
+    @property
+    def unit(self):
+        return self.model['unit']
+
+    def _relation(self, rid):
+        for relations in self.model['relations'].values():
+            for relation in relations:
+                if relation['id'] == rid:
+                    return relation
+        raise KeyError(rid)
+
+    def relation_units(self, rid):
+        return sorted(self._relation(rid).get('units', {}))
+
+    def relation_data(self, rid, unit):
+        relation = self._relation(rid)
+        if unit == self.unit:
+            return relation.setdefault('local', {})
+        return relation['units'][unit]
+
+    def dispatch(self, args):
+        """Run a command against the model.
+
+        :returns: the exit code and output of the command
+        :rtype: Tuple[int, bytes]
+        """
+        if isinstance(args, str):
+            args = args.split()
+        args = [str(a) for a in args]
+        tool = os.path.basename(args[0])
+        self.calls[tool] += 1
+        self.commands.append(args)
+        handler = getattr(self, '_' + tool.replace('-', '_'), None)
+        if handler is not None and tool in HOOK_TOOLS:
+            result = handler(args[1:])
+            if isinstance(result, tuple):
+                return result
+            return 0, result.encode('UTF-8')
+        canned = self.model['commands'].get(tool, {})
+        return (canned.get('rc', 0),
+                canned.get('stdout', '').encode('UTF-8'))
+
+    # hook tools
+
+    @staticmethod
+    def _split(args):
+        """Split arguments into options and positional arguments."""
+        opts, positional = {}, []
+        args = [a for a in args if not a.startswith('--format')]
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg in ('-r', '-s', '--file'):
+                opts[arg] = args[i + 1]
+                i += 2
+                continue
+            if arg.startswith('--'):
+                opts[arg] = True
+            else:
+                positional.append(arg)
+            i += 1
+        return opts, positional
+
+    def _config_get(self, args):
+        opts, positional = self._split(args)
+        if positional:
+            return json.dumps(self.config.get(positional[0]))
+        return json.dumps(self.config)
+
+    def _relation_ids(self, args):
+        _, positional = self._split(args)
+        reltype = positional[0] if positional else self.env.get(
+            'JUJU_RELATION')
+        return json.dumps([r['id'] for r in
+                           self.model['relations'].get(reltype, [])])
+
+    def _relation_list(self, args):
+        opts, _ = self._split(args)
+        rid = opts.get('-r', self.env.get('JUJU_RELATION_ID'))
+        return json.dumps(self.relation_units(rid))
+
+    def _relation_get(self, args):
+        opts, positional = self._split(args)
+        rid = opts.get('-r', self.env.get('JUJU_RELATION_ID'))
+        attribute = positional[0] if positional else '-'
+        unit = (positional[1] if len(positional) > 1
+                else self.env.get('JUJU_REMOTE_UNIT'))
+        try:
+            if '--app' in opts:
+                data = self._relation(rid).get('app-data', {})
+            else:
+                data = self.relation_data(rid, unit)
+        except KeyError:
+            return 2, b''
+        if attribute == '-':
+            return json.dumps(data)
+        return json.dumps(data.get(attribute))
+
+    def _relation_set(self, args):
+        if '--help' in args:
+            return 'usage: relation-set [options] key=value [key=value ...]'
+        opts, positional = self._split(args)
+        rid = opts.get('-r', self.env.get('JUJU_RELATION_ID'))
+        settings = {}
+        if '--file' in opts:
+            with open(opts['--file']) as f:
+                settings.update(yaml.safe_load(f) or {})
+        for arg in positional:
+            key, _, value = arg.partition('=')
+            settings[key] = value or None
+        data = self.relation_data(rid, self.unit)
+        for key, value in settings.items():
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = str(value)
+        return ''
+
+    def _storage_list(self, args):
+        _, positional = self._split(args)
+        return json.dumps(sorted(
+            sid for sid in self.model['storage']
+            if not positional or sid.split('/')[0] == positional[0]))
+
+    def _storage_get(self, args):
+        opts, positional = self._split(args)
+        sid = opts.get('-s', self.env.get('JUJU_STORAGE_ID'))
+        storage = self.model['storage'].get(sid, {})
+        if positional:
+            return json.dumps(storage.get(positional[0]))
+        return json.dumps(storage)
+
+    def _status_set(self, args):
+        _, positional = self._split(args)
+        self.status = (positional[0], ' '.join(positional[1:]))
+        return ''
+
+    def _status_get(self, args):
+        return json.dumps({'status': self.status[0],
+                           'message': self.status[1]})
+
+    def _juju_log(self, args):
+        self.logs.append(args[-1])
+        return ''
+
+    def _is_leader(self, args):
+        return json.dumps(bool(self.model.get('leader')))
+
+    def _leader_get(self, args):
+        _, positional = self._split(args)
+        settings = self.model['leader-settings']
+        if positional and positional[0] != '-':
+            return json.dumps(settings.get(positional[0]))
+        return json.dumps(settings)
+
+    def _leader_set(self, args):
+        for arg in args:
+            key, _, value = arg.partition('=')
+            if value:
+                self.model['leader-settings'][key] = value
+            else:
+                self.model['leader-settings'].pop(key, None)
+        return ''
+
+    def _unit_get(self, args):
+        _, positional = self._split(args)
+        return json.dumps(self.model.get('addresses', {}).get(positional[0]))
+
+    def _network_get(self, args):
+        address = self.model.get('addresses', {}).get('private-address')
+        if '--primary-address' in args:
+            return address
+        return yaml.safe_dump({
+            'bind-addresses': [{'interface-name': 'eth0', 'addresses': [
+                {'value': address, 'cidr': '{}/24'.format(address)}]}],
+            'ingress-addresses': [address],
+            'egress-subnets': ['{}/32'.format(address)]})
+
+    def _opened_ports(self, args):
+        return '[]'
+
+    def _action_get(self, args):
+        return '{}'
+
+    def _noop(self, args):
+        return ''
+
+    _open_port = _close_port = _application_version_set = _noop
+    _action_set = _action_fail = _noop
+
+    # subprocess replacements
+
+    def _run(self, args, kwargs):
+        if args:
+            cmd = args[0]
+        else:
+            cmd = kwargs.get('args')
+        return self.dispatch(cmd)
+
+    def call(self, *args, **kwargs):
+        return self._run(args, kwargs)[0]
+
+    def check_call(self, *args, **kwargs):
+        rc, out = self._run(args, kwargs)
+        if rc:
+            raise subprocess.CalledProcessError(rc, args or kwargs, out)
+        return 0
+
+    def check_output(self, *args, **kwargs):
+        rc, out = self._run(args, kwargs)
+        if rc:
+            raise subprocess.CalledProcessError(rc, args or kwargs, out)
+        return _decode(out, _text_mode(kwargs))
+
+    def run(self, *args, **kwargs):
+        rc, out = self._run(args, kwargs)
+        if rc and kwargs.get('check'):
+            raise subprocess.CalledProcessError(rc, args or kwargs, out)
+        cmd = args[0] if args else kwargs.get('args')
+        return subprocess.CompletedProcess(
+            cmd, rc, _decode(out, _text_mode(kwargs)), b'')
+
+    def Popen(self, *args, **kwargs):
+        cmd = args[0] if args else kwargs.pop('args')
+        return FakePopen(self, cmd, **kwargs)
+
+    @contextmanager
+    def patch(self):
+        """Route subprocess calls and host file writes through the
+        simulator."""
+        from charmhelpers.contrib.openstack import utils
+        from charmhelpers.core import host
+        replacements = [(subprocess, n, getattr(self, n))
+                        for n in SUBPROCESS_FUNCTIONS]
+        replacements.extend((host, n, getattr(self, n))
+                            for n in HOST_FUNCTIONS)
+        # /etc/openstack-release, written by the openstack-release package.
+        replacements.append((utils, 'get_installed_os_version',
+                             lambda: self.model.get('release')))
+        with patch_everywhere(replacements):
+            yield self
+
+    # host files
+
+    def replace_file(self, config_file, content):
+        self.files[config_file] = content
+
+    def mkdir(self, path, owner='root', group='root', perms=0o555,
+              force=False):
+        self.dirs.add(path)
+
+    def write_file(self, path, content, owner='root', group='root',
+                   perms=0o444):
+        if isinstance(content, str):
+            content = content.encode('UTF-8')
+        self.files[path] = content
+
+    def current_digest(self, config_file):
+        content = self.files.get(config_file)
+        if content is None:
+            return None
+        return hashlib.sha256(content).hexdigest()
+
+
+HOOK_TOOLS = frozenset((
+    'action-fail', 'action-get', 'action-set', 'application-version-set',
+    'close-port', 'config-get', 'is-leader', 'juju-log', 'leader-get',
+    'leader-set', 'network-get', 'open-port', 'opened-ports', 'relation-get',
+    'relation-ids', 'relation-list', 'relation-set', 'status-get',
+    'status-set', 'storage-get', 'storage-list', 'unit-get',
+))
+
+
+# Commands counted together by grouped_calls().
+TOOL_GROUPS = {
+    'apt': ('apt-get', 'apt-cache', 'apt-mark', 'dpkg', 'dpkg-query'),
+    'lvm': ('lvm', 'pvs', 'vgs', 'lvs', 'pvscan', 'vgscan', 'pvcreate',
+            'pvremove', 'vgcreate', 'vgextend', 'vgreduce', 'vgchange',
+            'lvcreate', 'lvremove', 'lvextend', 'lvchange', 'lvconvert',
+            'pvdisplay', 'vgdisplay', 'lvdisplay'),
+}
+
+
+def grouped_calls(calls):
+    """Return calls with the commands in TOOL_GROUPS also counted under
+    their group.
+
+    :param calls: command counts, as recorded by HookToolSimulator
+    :type calls: Counter
+    :rtype: Counter
+    """
+    grouped = Counter(calls)
+    for group, tools in TOOL_GROUPS.items():
+        grouped[group] = sum(calls.get(t, 0) for t in tools)
+    return grouped
+
+
+class HookRun(object):
+    """Result of HookRunner.run()."""
+
+    def __init__(self, hook, duration, calls):
+        self.hook = hook
+        self.duration = duration
+        self.calls = calls
+
+
+class HookRunner(object):
+    """Execute cinder hooks in-process against a HookToolSimulator.
+
+    Each run mirrors a fresh hook process: the hookenv cache, the relation
+    snapshot and the kv store handle are reset, and CONFIGS is registered
+    again.
+
+    :param simulator: the simulator serving the model
+    :type simulator: HookToolSimulator
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.tmpdir = None
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cinder-hooktools-')
+        self._stack = [
+            self.simulator.patch(),
+            mock.patch.dict(os.environ, {
+                'CHARM_DIR': CHARM_DIR,
+                'JUJU_UNIT_NAME': self.simulator.unit,
+                'UNIT_STATE_DB': os.path.join(self.tmpdir, 'unit-state.db'),
+            }),
+            mock.patch('charmhelpers.core.unitdata._KV', None),
+            # keep the previous config snapshot out of the charm tree.
+            mock.patch('charmhelpers.core.hookenv.Config.CONFIG_FILE_NAME',
+                       os.path.join(self.tmpdir, '.juju-persistent-config')),
+            mock.patch(
+                'charmhelpers.contrib.openstack.templating.'
+                'OSConfigRenderer._replace_file',
+                staticmethod(self.simulator.replace_file)),
+            mock.patch(
+                'charmhelpers.contrib.openstack.templating.'
+                'OSConfigRenderer._current_digest',
+                self.simulator.current_digest),
+            # the model's addresses are not configured on this host.
+            mock.patch('charmhelpers.contrib.network.ip.'
+                       'get_netmask_for_address',
+                       return_value='255.255.255.0'),
+            mock.patch('charmhelpers.contrib.charmsupport.nrpe.'
+                       'copy_nrpe_checks'),
+            mock.patch('cinder_utils.install_ceph_config_alternative'),
+            mock.patch(
+                'cinder_contexts.VolumeUsageAuditContext.'
+                'DEFAULT_CRONTAB_PATH',
+                os.path.join(self.tmpdir, 'cinder-volume-usage-audit')),
+        ]
+        for cm in self._stack:
+            cm.__enter__()
+        self._cwd = os.getcwd()
+        os.chdir(CHARM_DIR)
+        return self
+
+    def __exit__(self, *exc):
+        os.chdir(self._cwd)
+        for cm in reversed(self._stack):
+            cm.__exit__(None, None, None)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def run(self, hook, relation_id=None, remote_unit=None):
+        """Run hook, optionally in the context of a relation.
+
+        :returns: the wall time and hook tool call counts of the run
+        :rtype: HookRun
+        """
+        from charmhelpers.contrib.openstack.utils import reset_os_release
+        from charmhelpers.core import hookenv
+        import cinder_hooks
+        import cinder_utils
+
+        env = {'JUJU_HOOK_NAME': hook}
+        if relation_id:
+            env['JUJU_RELATION'] = relation_id.split(':')[0]
+            env['JUJU_RELATION_ID'] = relation_id
+            env['JUJU_REMOTE_UNIT'] = (
+                remote_unit or self.simulator.relation_units(relation_id)[0])
+        self.simulator.env = env
+        self.simulator.calls.clear()
+        hookenv.cache.clear()
+        hookenv.clear_relation_snapshot()
+        hookenv._cache_config = None
+        # callbacks left over by a previous run that ended before they ran.
+        del hookenv._atstart[:]
+        del hookenv._atexit[:]
+        reset_os_release()
+        cinder_utils.reset_resource_map()
+        t0 = time.time()
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(sys, 'argv', [hook]), \
+                mock.patch.object(cinder_hooks, 'CONFIGS',
+                                  cinder_utils.register_configs()):
+            cinder_hooks.main([hook])
+        duration = time.time() - t0
+        hookenv.clear_relation_snapshot()
+        reset_os_release()
+        return HookRun(hook, duration, Counter(self.simulator.calls))
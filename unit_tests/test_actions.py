@@ -52,6 +52,35 @@ class ResumeTestCase(CharmTestCase):
         self.resume_unit_helper.assert_called_once_with('test-config')
 
 
+class HookProfileTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HookProfileTestCase, self).setUp(
+            actions, ["action_get", "action_set", "profile_report"])
+
+    def test_hook_profile(self):
+        self.action_get.return_value = 3
+        self.profile_report.return_value = {'runs': 1}
+        actions.hook_profile([])
+        self.profile_report.assert_called_once_with(limit=3)
+        self.action_set.assert_called_once_with({'profile': '{"runs": 1}'})
+
+
+class CacheStatsTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(CacheStatsTestCase, self).setUp(
+            actions, ["action_set", "config", "volume_cache_stats"])
+
+    def test_cache_stats(self):
+        self.config.return_value = 'cinder-volumes'
+        self.volume_cache_stats.return_value = [{'lv': 'cinder-volumes/x'}]
+        actions.cache_stats([])
+        self.volume_cache_stats.assert_called_once_with('cinder-volumes')
+        self.action_set.assert_called_once_with(
+            {'stats': '[{"lv": "cinder-volumes/x"}]'})
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
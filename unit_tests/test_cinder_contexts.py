@@ -28,7 +28,8 @@ TO_PATCH = [
     'service_name',
     'os_release',
     'related_units',
-    'relation_get'
+    'relation_get',
+    'unitdata',
 ]
 
 
@@ -36,6 +37,8 @@ class TestCinderContext(CharmTestCase):
 
     def setUp(self):
         super(TestCinderContext, self).setUp(contexts, TO_PATCH)
+        self.kv = {}
+        self.unitdata.kv.return_value.get.side_effect = self.kv.get
 
     def test_enable_lvm_disabled(self):
         for v in [None, 'None', 'none']:
@@ -69,6 +72,7 @@ class TestCinderContext(CharmTestCase):
     def test_ceph_related(self):
         self.relation_ids.return_value = ['ceph:0']
         self.os_release.return_value = 'havana'
+        self.config.side_effect = self.test_config.get
         service = 'mycinder'
         self.service_name.return_value = service
         self.assertEqual(
@@ -77,11 +81,14 @@ class TestCinderContext(CharmTestCase):
              'rbd_pool': service,
              'rbd_user': service,
              'rbd_ceph_conf': '/var/lib/charm/mycinder/ceph.conf',
+             'rbd_options': [],
+             'ceph_backends': [],
              'host': service})
 
     def test_ceph_related_icehouse(self):
         self.relation_ids.return_value = ['ceph:0']
         self.os_release.return_value = 'icehouse'
+        self.config.side_effect = self.test_config.get
         service = 'mycinder'
         self.service_name.return_value = service
         self.assertEqual(
@@ -90,11 +97,14 @@ class TestCinderContext(CharmTestCase):
              'rbd_pool': service,
              'rbd_user': service,
              'rbd_ceph_conf': '/var/lib/charm/mycinder/ceph.conf',
+             'rbd_options': [],
+             'ceph_backends': [],
              'host': service})
 
     def test_ceph_related_ocata(self):
         self.relation_ids.return_value = ['ceph:0']
         self.os_release.return_value = 'ocata'
+        self.config.side_effect = self.test_config.get
         service = 'mycinder'
         self.service_name.return_value = service
         self.assertEqual(
@@ -103,8 +113,184 @@ class TestCinderContext(CharmTestCase):
              'rbd_pool': service,
              'rbd_user': service,
              'rbd_ceph_conf': '/var/lib/charm/mycinder/ceph.conf',
+             'rbd_options': [],
+             'ceph_backends': [],
              'host': service})
 
+    def test_parse_ceph_backends(self):
+        parse = contexts.parse_ceph_backends
+        self.assertEqual(parse(None), {})
+        self.assertEqual(
+            list(parse('ssd: {device-class: ssd, weight: 10}\n'
+                       'hdd: {pool-type: erasure-coded, ec-profile-k: 4}\n'
+                       'plain:').items()),
+            [('ssd', {'device-class': 'ssd', 'weight': 10}),
+             ('hdd', {'pool-type': 'erasure-coded', 'ec-profile-k': 4}),
+             ('plain', {})])
+        for value in ('ssd', 'ssd: [', 'ssd: [a]', 'ss-d: {}',
+                      'ssd: {size: 1}', 'ssd: {pool-type: erasure}',
+                      'ssd: {replicas: 0}', 'ssd: {weight: 101}'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, parse, value)
+
+    def test_ceph_backends(self):
+        self.config.side_effect = self.test_config.get
+        self.service_name.return_value = 'cinder'
+        self.assertEqual(contexts.ceph_backends(), [])
+        self.test_config.set(
+            'ceph-backends',
+            'ssd: {device-class: ssd, weight: 10}\n'
+            'hdd: {pool-type: erasure-coded, device-class: hdd, '
+            'ec-profile-k: 4, pool: volumes-hdd, backend-name: HDD}')
+        self.assertEqual(contexts.ceph_backends(), [
+            {'name': 'ssd', 'backend_name': 'CEPH-ssd',
+             'pool': 'cinder-ssd', 'rbd_pool': 'cinder-ssd',
+             'erasure_coded': False, 'replicas': 3, 'device_class': 'ssd',
+             'crush_rule': 'replicated_ssd', 'ec_profile_k': 1,
+             'ec_profile_m': 2, 'weight': 10.0},
+            {'name': 'hdd', 'backend_name': 'HDD',
+             'pool': 'volumes-hdd', 'rbd_pool': 'volumes-hdd-metadata',
+             'erasure_coded': True, 'replicas': 3, 'device_class': 'hdd',
+             'crush_rule': None, 'ec_profile_k': 4, 'ec_profile_m': 2,
+             'weight': 20.0}])
+
+    def test_volume_pool_weight(self):
+        self.config.side_effect = self.test_config.get
+        self.service_name.return_value = 'cinder'
+        self.assertEqual(contexts.volume_pool_weight(), 40.0)
+        # ceph-pool-weight is shared with backends without a weight.
+        self.test_config.set('ceph-backends', 'ssd:\nhdd:\nnvme:')
+        self.assertEqual(contexts.volume_pool_weight(), 10.0)
+        self.assertEqual([b['weight'] for b in contexts.ceph_backends()],
+                         [10.0, 10.0, 10.0])
+        self.test_config.set('ceph-backends', 'ssd: {weight: 30}')
+        self.assertEqual(contexts.volume_pool_weight(), 40.0)
+        self.test_config.set('ceph-backends', 'ssd: [')
+        self.assertEqual(contexts.volume_pool_weight(), 40.0)
+
+    @patch.object(contexts, 'log')
+    def test_ceph_backends_invalid(self, log):
+        self.config.return_value = 'not a mapping'
+        self.assertEqual(contexts.ceph_backends(), [])
+        self.assertTrue(log.called)
+
+    def test_parse_ceph_client_tuning(self):
+        parse = contexts.parse_ceph_client_tuning
+        self.assertEqual(parse(None), {})
+        self.assertEqual(
+            list(parse('rbd_cache: true\n'
+                       'rbd-cache-size: 64M\n'
+                       'rbd cache max dirty: 1024\n'
+                       'objecter inflight ops: 4096\n'
+                       'rbd cache policy: writeback').items()),
+            [('rbd cache', 'true'),
+             ('rbd cache size', 67108864),
+             ('rbd cache max dirty', 1024),
+             ('objecter inflight ops', 4096),
+             ('rbd cache policy', 'writeback')])
+        for value in ('rbd cache', 'rbd cache: [', 'rbd cachex: true',
+                      'rbd cache: 1', 'rbd cache size: 64X',
+                      'rbd cache size: -1', 'ms async op threads: true',
+                      'rbd cache policy: writecache',
+                      'rbd cache size: 1M\nrbd cache max dirty: 2M'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, parse, value)
+
+    @patch.object(contexts, 'cmp_pkgrevno')
+    @patch.object(contexts, 'log')
+    def test_ceph_client_context(self, log, cmp_pkgrevno):
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+        self.assertEqual(contexts.CephClientContext()(), {})
+        self.relation_ids.return_value = ['ceph:0']
+        self.assertEqual(contexts.CephClientContext()(),
+                         {'rbd_client_cache_settings': {},
+                          'rbd_default_data_pool': None})
+        self.test_config.set('ceph-client-tuning',
+                             'rbd cache: false\nrbd cache policy: writeback')
+        cmp_pkgrevno.return_value = 0
+        self.assertEqual(
+            contexts.CephClientContext()(),
+            {'rbd_client_cache_settings': {'rbd cache': 'false',
+                                           'rbd cache policy': 'writeback'},
+             'rbd_default_data_pool': None})
+        cmp_pkgrevno.assert_called_with('ceph-common', '15.2.0')
+        cmp_pkgrevno.return_value = -1
+        self.assertEqual(
+            contexts.CephClientContext()()['rbd_client_cache_settings'],
+            {'rbd cache': 'false'})
+        self.assertTrue(log.called)
+        log.reset_mock()
+        self.test_config.set('ceph-client-tuning', 'rbd cache: 1')
+        self.assertEqual(
+            contexts.CephClientContext()()['rbd_client_cache_settings'], {})
+        self.assertTrue(log.called)
+
+    def test_storage_backend_ceph_backends(self):
+        self.test_config.set('block-device', 'None')
+        self.test_config.set('ceph-backends', 'ssd:\nhdd:')
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.side_effect = lambda r: (
+            ['ceph:1'] if r == 'ceph' else [])
+        self.service_name.return_value = 'cinder'
+        self.os_release.return_value = 'yoga'
+        self.assertEqual(contexts.StorageBackendContext()()['backends'],
+                         'CEPH,CEPH-ssd,CEPH-hdd')
+
+    def test_ceph_pool_weight(self):
+        self.config.side_effect = self.test_config.get
+        self.assertEqual(contexts.ceph_pool_weight(), 40.0)
+        self.test_config.set('ceph-target-size-ratio', 0.25)
+        self.assertEqual(contexts.ceph_pool_weight(), 25.0)
+
+    def test_ceph_related_erasure_coded(self):
+        self.relation_ids.return_value = ['ceph:0']
+        self.os_release.return_value = 'yoga'
+        self.service_name.return_value = 'mycinder'
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.assertEqual(contexts.CephContext()()['rbd_pool'],
+                         'mycinder-metadata')
+
+    def test_ceph_related_pool_type_changed(self):
+        self.relation_ids.return_value = ['ceph:0']
+        self.os_release.return_value = 'yoga'
+        self.service_name.return_value = 'mycinder'
+        self.config.side_effect = self.test_config.get
+        # the pools were created replicated before pool-type was changed.
+        self.kv[contexts.CEPH_POOL_TYPE_KEY] = 'replicated'
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.assertEqual(contexts.CephContext()()['rbd_pool'], 'mycinder')
+        self.assertIsNone(
+            contexts.CephClientContext()()['rbd_default_data_pool'])
+        self.kv[contexts.CEPH_POOL_TYPE_KEY] = 'erasure-coded'
+        self.test_config.set('pool-type', 'replicated')
+        self.assertEqual(contexts.CephContext()()['rbd_pool'],
+                         'mycinder-metadata')
+        self.assertEqual(
+            contexts.CephClientContext()()['rbd_default_data_pool'],
+            'mycinder')
+
+    @patch.object(contexts, 'log')
+    def test_ceph_related_rbd_options(self, log):
+        self.relation_ids.return_value = ['ceph:0']
+        self.os_release.return_value = 'queens'
+        self.service_name.return_value = 'mycinder'
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('rbd-exclusive-cinder-pool', True)
+        self.test_config.set('rbd-max-clone-depth', 0)
+        self.test_config.set('rados-connect-timeout', 30)
+        self.assertEqual(contexts.CephContext()()['rbd_options'],
+                         [('rbd_exclusive_cinder_pool', True),
+                          ('rbd_max_clone_depth', 0),
+                          ('rados_connect_timeout', 30)])
+        self.assertFalse(log.called)
+        self.os_release.return_value = 'pike'
+        self.assertEqual(contexts.CephContext()()['rbd_options'],
+                         [('rbd_max_clone_depth', 0),
+                          ('rados_connect_timeout', 30)])
+        self.assertTrue(log.called)
+
     @patch.object(utils, 'service_enabled')
     def test_apache_ssl_context_service_disabled(self, service_enabled):
         service_enabled.return_value = False
@@ -127,7 +313,9 @@ class TestCinderContext(CharmTestCase):
              'scheduler_default_filters': None,
              'image_volume_cache_enabled': False,
              'image_volume_cache_max_size_gb': 0,
-             'image_volume_cache_max_count': 0})
+             'image_volume_cache_max_count': 0,
+             'volume_copy_bps_limit': 0,
+             'volume_copy_blkio_cgroup_name': 'cinder-volume-copy'})
 
     def test_storage_backend_single_backend(self):
         rel_dict = {
@@ -151,7 +339,10 @@ class TestCinderContext(CharmTestCase):
                           'scheduler_default_filters': None,
                           'image_volume_cache_enabled': False,
                           'image_volume_cache_max_size_gb': 0,
-                          'image_volume_cache_max_count': 0})
+                          'image_volume_cache_max_count': 0,
+                          'volume_copy_bps_limit': 0,
+                          'volume_copy_blkio_cgroup_name':
+                              'cinder-volume-copy'})
 
     def test_storage_backend_multi_backend(self):
         self.test_config.set('default-volume-type', None)
@@ -175,7 +366,9 @@ class TestCinderContext(CharmTestCase):
              'scheduler_default_filters': None,
              'image_volume_cache_enabled': False,
              'image_volume_cache_max_size_gb': 0,
-             'image_volume_cache_max_count': 0})
+             'image_volume_cache_max_count': 0,
+             'volume_copy_bps_limit': 0,
+             'volume_copy_blkio_cgroup_name': 'cinder-volume-copy'})
 
     def test_storage_backend_multi_backend_with_default_type(self):
         self.test_config.set('default-volume-type', 'my-preferred-volume-type')
@@ -199,7 +392,9 @@ class TestCinderContext(CharmTestCase):
              'scheduler_default_filters': None,
              'image_volume_cache_enabled': True,
              'image_volume_cache_max_size_gb': 10,
-             'image_volume_cache_max_count': 100})
+             'image_volume_cache_max_count': 100,
+             'volume_copy_bps_limit': 0,
+             'volume_copy_blkio_cgroup_name': 'cinder-volume-copy'})
 
     def test_storage_backend_default_filters_set(self):
         self.test_config.set(
@@ -217,7 +412,9 @@ class TestCinderContext(CharmTestCase):
              'scheduler_default_filters': 'DriverFilter,AvailabilityFilter',
              'image_volume_cache_enabled': False,
              'image_volume_cache_max_size_gb': 0,
-             'image_volume_cache_max_count': 0})
+             'image_volume_cache_max_count': 0,
+             'volume_copy_bps_limit': 0,
+             'volume_copy_blkio_cgroup_name': 'cinder-volume-copy'})
 
     def test_image_volume_cache(self):
         rel_dict = {
@@ -244,7 +441,10 @@ class TestCinderContext(CharmTestCase):
                                   'scheduler_default_filters': None,
                                   'image_volume_cache_enabled': enabled,
                                   'image_volume_cache_max_size_gb': size,
-                                  'image_volume_cache_max_count': count})
+                                  'image_volume_cache_max_count': count,
+                                  'volume_copy_bps_limit': 0,
+                                  'volume_copy_blkio_cgroup_name':
+                                      'cinder-volume-copy'})
 
     mod_ch_context = 'charmhelpers.contrib.openstack.context'
 
@@ -522,18 +722,149 @@ class TestCinderContext(CharmTestCase):
         ctxt = contexts.LVMContext()()
         self.assertEqual(ctxt, {})
 
+    @patch.object(contexts, 'storage_data_addresses')
     @patch.object(contexts, 'enable_lvm')
-    def test_lvm_context_enabled(self, enable_lvm):
+    def test_lvm_context_enabled(self, enable_lvm, storage_data_addresses):
         enable_lvm.return_value = True
-        self.config.return_value = 'cinder-vol1'
+        storage_data_addresses.return_value = (
+            '10.6.0.10', ['10.7.0.10', '10.8.0.10'])
+        config = {'volume-group': 'cinder-vol1',
+                  'lvm-type': 'thin',
+                  'max-over-subscription-ratio': '10.0',
+                  'reserved-percentage': 5,
+                  'lvm-raid-level': 'raid1',
+                  'lvm-stripes': 2,
+                  'lvm-device-groups': None,
+                  'volume-clear': 'zero',
+                  'volume-clear-size': 100,
+                  'volume-clear-ionice': '-c3',
+                  'target-helper': 'lioadm',
+                  'target-protocol': 'iscsi'}
+        self.config.side_effect = lambda x: config[x]
         ctxt = contexts.LVMContext()()
         expect = {
             'volume_backend_name': 'LVM',
             'volume_driver': 'cinder.volume.drivers.lvm.LVMVolumeDriver',
             'volume_group': 'cinder-vol1',
             'volume_name_template': 'volume-%s',
-            'volumes_dir': '/var/lib/cinder/volumes'}
+            'volumes_dir': '/var/lib/cinder/volumes',
+            'lvm_type': 'thin',
+            'max_over_subscription_ratio': '10.0',
+            'reserved_percentage': 5,
+            'lvm_mirrors': 0,
+            'volume_clear': 'zero',
+            'volume_clear_size': 100,
+            'volume_clear_ionice': '-c3',
+            'target_helper': 'lioadm',
+            'target_protocol': 'iscsi',
+            'target_ip_address': '10.6.0.10',
+            'target_secondary_ip_addresses': '10.7.0.10,10.8.0.10'}
+        expect['lvm_backends'] = [dict(expect)]
         self.assertEqual(ctxt, expect)
+        config['lvm-type'] = 'default'
+        config['lvm-stripes'] = 3
+        self.assertEqual(contexts.LVMContext()()['lvm_mirrors'], 2)
+        # targets stay on cinder's default address unless storage-data is
+        # bound to its own space.
+        storage_data_addresses.return_value = (None, [])
+        ctxt = contexts.LVMContext()()
+        self.assertNotIn('target_ip_address', ctxt)
+        self.assertNotIn('target_secondary_ip_addresses', ctxt)
+
+    def test_target_context(self):
+        self.config.side_effect = self.test_config.get
+        self.assertEqual(contexts.TargetContext()(), {'target_modules': []})
+        self.test_config.set('target-helper', 'nvmet')
+        self.test_config.set('target-protocol', 'nvmet_rdma')
+        self.assertEqual(contexts.TargetContext()(),
+                         {'target_modules': ['nvmet', 'nvmet_rdma']})
+
+    @patch.object(contexts, 'storage_data_addresses')
+    @patch.object(contexts, 'enable_lvm')
+    def test_lvm_context_device_groups(self, enable_lvm,
+                                       storage_data_addresses):
+        enable_lvm.return_value = False
+        storage_data_addresses.return_value = ('10.6.0.10', [])
+        self.test_config.set('lvm-device-groups',
+                             'fast: /dev/nvme0n1\nbulk: /dev/sd[b-m]')
+        self.config.side_effect = self.test_config.get
+        ctxt = contexts.LVMContext()()
+        self.assertEqual(list(ctxt), ['lvm_backends'])
+        self.assertEqual(
+            [(b['volume_backend_name'], b['volume_group'])
+             for b in ctxt['lvm_backends']],
+            [('LVM-fast', 'cinder-volumes-fast'),
+             ('LVM-bulk', 'cinder-volumes-bulk')])
+        enable_lvm.return_value = True
+        ctxt = contexts.LVMContext()()
+        self.assertEqual(ctxt['volume_backend_name'], 'LVM')
+        self.assertEqual([b['volume_backend_name']
+                          for b in ctxt['lvm_backends']],
+                         ['LVM', 'LVM-fast', 'LVM-bulk'])
+
+    @patch.object(contexts, 'unit_get')
+    @patch.object(contexts, 'network_get')
+    @patch.object(contexts, 'get_relation_ip')
+    def test_storage_data_addresses(self, get_relation_ip, network_get,
+                                    unit_get):
+        unit_get.return_value = '10.5.0.10'
+        get_relation_ip.return_value = '10.6.0.10'
+        network_get.return_value = {'bind-addresses': [
+            {'interface-name': 'ens4', 'addresses': [
+                {'value': '10.6.0.10', 'cidr': '10.6.0.0/24'},
+                {'value': 'fd00::10', 'cidr': 'fd00::/64'}]},
+            {'interface-name': 'ens5', 'addresses': [
+                {'value': '10.7.0.10', 'cidr': '10.7.0.0/24'}]}]}
+        self.assertEqual(contexts.storage_data_addresses(),
+                         ('10.6.0.10', ['10.7.0.10']))
+        get_relation_ip.assert_called_once_with('storage-data')
+        network_get.side_effect = NotImplementedError
+        self.assertEqual(contexts.storage_data_addresses(),
+                         ('10.6.0.10', []))
+
+    @patch.object(contexts, 'unit_get')
+    @patch.object(contexts, 'network_get')
+    @patch.object(contexts, 'get_relation_ip')
+    def test_storage_data_addresses_unbound(self, get_relation_ip,
+                                            network_get, unit_get):
+        # an unbound storage-data binding follows the default space.
+        unit_get.return_value = '10.5.0.10'
+        get_relation_ip.return_value = '10.5.0.10'
+        self.assertEqual(contexts.storage_data_addresses(), (None, []))
+        unit_get.assert_called_once_with('private-address')
+        self.assertFalse(network_get.called)
+
+    @patch.object(contexts, 'enable_lvm')
+    def test_storage_backend_lvm_device_groups(self, enable_lvm):
+        enable_lvm.return_value = True
+        self.test_config.set('lvm-device-groups',
+                             'fast: /dev/nvme0n1\nbulk: /dev/sdb')
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+        self.os_release.return_value = 'ocata'
+        ctxt = contexts.StorageBackendContext()()
+        self.assertEqual(ctxt['active_backends'],
+                         ['LVM', 'LVM-fast', 'LVM-bulk'])
+        self.assertEqual(ctxt['backends'], 'LVM,LVM-fast,LVM-bulk')
+
+    def test_parse_lvm_device_groups(self):
+        parse = contexts.parse_lvm_device_groups
+        self.assertEqual(parse(None), {})
+        self.assertEqual(
+            list(parse('fast: /dev/nvme0n1 /dev/nvme1n1\n'
+                       'bulk: [/dev/sdb, /dev/sdc]').items()),
+            [('fast', ['/dev/nvme0n1', '/dev/nvme1n1']),
+             ('bulk', ['/dev/sdb', '/dev/sdc'])])
+        for value in ('/dev/sdb', 'fast: [', 'fast:', 'fast-1: /dev/sdb',
+                      'fast: {a: b}'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, parse, value)
+
+    @patch.object(contexts, 'log')
+    def test_lvm_device_groups_invalid(self, log):
+        self.config.return_value = 'not a mapping'
+        self.assertEqual(contexts.lvm_device_groups(), {})
+        self.assertTrue(log.called)
 
     @patch('builtins.open')
     def test_volume_usage_audit_context(self, _open):
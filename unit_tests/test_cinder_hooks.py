@@ -16,6 +16,7 @@ from importlib import reload
 import os
 import json
 
+from collections import OrderedDict
 from unittest.mock import (
     patch,
     call
@@ -43,7 +44,19 @@ TO_PATCH = [
     'send_request_if_needed',
     'is_request_complete',
     # cinder_utils
+    'check_lvm_config',
     'configure_lvm_storage',
+    'configure_target_helper',
+    'expand_block_devices',
+    'lvm_device_groups',
+    'lvm_group_volume_group',
+    'ceph_backends',
+    'volume_pool_weight',
+    'configure_rbd_data_pools',
+    'record_ceph_pool_type',
+    'clear_ceph_pool_type',
+    'erasure_coded_pool',
+    'rbd_pool_name',
     'determine_packages',
     'do_openstack_upgrade',
     'ensure_ceph_keyring',
@@ -98,11 +111,28 @@ TO_PATCH = [
     'is_db_maintenance_mode',
 ]
 
+# Storage options passed to configure_lvm_storage with the charm defaults.
+LVM_STORAGE_OPTIONS = {
+    'wipe_method': 'zap',
+    'lvm_type': 'default',
+    'thin_pool_chunk_size': None,
+    'thin_pool_metadata_size': None,
+    'cache_devices': [],
+    'cache_mode': 'writethrough',
+    'lvm_stripes': 1,
+    'lvm_stripe_size': None,
+    'lvm_raid_level': None,
+}
+GROUP_STORAGE_OPTIONS = {k: v for k, v in LVM_STORAGE_OPTIONS.items()
+                         if not k.startswith('cache_')}
+
 
 class TestInstallHook(CharmTestCase):
 
     def setUp(self):
         super(TestInstallHook, self).setUp(hooks, TO_PATCH)
+        self.check_lvm_config.return_value = None
+        self.relation_ids.return_value = []
         self.config.side_effect = self.test_config.get
 
     def test_install_precise_distro(self):
@@ -136,6 +166,7 @@ class TestChangedHooks(CharmTestCase):
 
     def setUp(self):
         super(TestChangedHooks, self).setUp(hooks, TO_PATCH)
+        self.check_lvm_config.return_value = None
         self.config.side_effect = self.test_config.get
 
     @patch.object(hooks, 'scrub_old_style_ceph')
@@ -158,10 +189,34 @@ class TestChangedHooks(CharmTestCase):
         _scrub_old_style_ceph.assert_called_once_with()
         self.service_restart.assert_called_once_with('cinder-api')
 
+    @patch.object(hooks, 'get_ceph_request')
+    @patch.object(hooks, 'scrub_old_style_ceph')
+    @patch.object(hooks, 'amqp_joined')
+    def test_upgrade_charm_records_ceph_pool_type(self, _joined,
+                                                  _scrub_old_style_ceph,
+                                                  get_ceph_request):
+        self.remove_old_packages.return_value = False
+        self.relation_ids.side_effect = lambda r: {
+            'ceph': ['ceph:1']}.get(r, [])
+        self.is_request_complete.return_value = False
+        hooks.hooks.execute(['hooks/upgrade-charm'])
+        self.assertFalse(self.record_ceph_pool_type.called)
+        # pools created by the charm this unit was upgraded from.
+        self.is_request_complete.return_value = True
+        hooks.hooks.execute(['hooks/upgrade-charm'])
+        self.is_request_complete.assert_called_with(
+            get_ceph_request.return_value)
+        self.record_ceph_pool_type.assert_called_once_with()
+        self.record_ceph_pool_type.reset_mock()
+        self.relation_ids.side_effect = lambda r: []
+        hooks.hooks.execute(['hooks/upgrade-charm'])
+        self.assertFalse(self.record_ceph_pool_type.called)
+
     @patch.object(hooks, 'scrub_old_style_ceph')
     @patch.object(hooks, 'amqp_joined')
     def test_upgrade_charm_with_amqp(self, _joined, _scrub_old_style_ceph):
-        self.relation_ids.return_value = ['amqp:1']
+        self.relation_ids.side_effect = lambda r: {
+            'amqp': ['amqp:1']}.get(r, [])
         hooks.hooks.execute(['hooks/upgrade-charm'])
         _joined.assert_called_with(relation_id='amqp:1')
         _scrub_old_style_ceph.assert_called_once_with()
@@ -181,7 +236,8 @@ class TestChangedHooks(CharmTestCase):
         self.assertTrue(conf_https.called)
         self.configure_lvm_storage.assert_called_with(['sdb'],
                                                       'cinder-volumes',
-                                                      False, False, False)
+                                                      False, False, False,
+                                                      **LVM_STORAGE_OPTIONS)
         self.open_port.assert_called_with(8776)
         identity_joined.assert_called_once_with(rid='identity-service:1')
 
@@ -201,7 +257,85 @@ class TestChangedHooks(CharmTestCase):
         self.configure_lvm_storage.assert_called_with(
             ['sdb', '/dev/sdc', 'sde'],
             'cinder-new',
-            True, True, False)
+            True, True, False, **LVM_STORAGE_OPTIONS)
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'config_value_changed')
+    def test_config_changed_lvm_device_groups(self, config_val_changed,
+                                              conf_https):
+        self.openstack_upgrade_available.return_value = False
+        self.test_config.set('block-device', 'sdb')
+        self.lvm_device_groups.return_value = OrderedDict([
+            ('fast', ['/dev/nvme0n1']), ('bulk', ['/dev/sd[b-c]'])])
+        self.expand_block_devices.side_effect = lambda d: [
+            x.replace('[b-c]', 'b') for x in d]
+        self.lvm_group_volume_group.side_effect = 'cinder-volumes-{}'.format
+        hooks.hooks.execute(['hooks/config-changed'])
+        self.configure_lvm_storage.assert_has_calls([
+            call(['sdb'], 'cinder-volumes', False, False, False,
+                 **LVM_STORAGE_OPTIONS),
+            call(['/dev/nvme0n1'], 'cinder-volumes-fast', False, False,
+                 False, **GROUP_STORAGE_OPTIONS),
+            call(['/dev/sdb'], 'cinder-volumes-bulk', False, False, False,
+                 **GROUP_STORAGE_OPTIONS)])
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'config_value_changed')
+    def test_config_changed_invalid_lvm_config(self, config_val_changed,
+                                               conf_https):
+        self.openstack_upgrade_available.return_value = False
+        self.test_config.set('block-device', 'sdb')
+        self.test_config.set('overwrite', 'True')
+        self.lvm_device_groups.return_value = OrderedDict([
+            ('fast', ['sdb'])])
+        self.check_lvm_config.return_value = (
+            'Block device /dev/sdb is used by both block-device and fast')
+        hooks.hooks.execute(['hooks/config-changed'])
+        self.assertFalse(self.configure_lvm_storage.called)
+        self.assertTrue(self.CONFIGS.write_all.called)
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'config_value_changed')
+    def test_config_changed_invalid_raid_layout(self, config_val_changed,
+                                                conf_https):
+        self.openstack_upgrade_available.return_value = False
+        self.test_config.set('block-device', 'sdb sdc')
+        self.test_config.set('lvm-type', 'thin')
+        self.test_config.set('lvm-raid-level', 'raid5')
+        self.test_config.set('lvm-stripes', 2)
+        self.check_lvm_config.side_effect = utils.check_lvm_config
+        with patch.object(utils, 'config', self.config):
+            hooks.hooks.execute(['hooks/config-changed'])
+        # blocked by assess_status() rather than failed by lvcreate.
+        self.assertFalse(self.configure_lvm_storage.called)
+        self.juju_log.assert_any_call(
+            'Not configuring lvm storage: lvm-stripes 2 is too few or '
+            'uneven for raid5')
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'config_value_changed')
+    def test_config_changed_volume_copy_limit(self, config_val_changed,
+                                              conf_https):
+        self.openstack_upgrade_available.return_value = False
+        self.filter_installed_packages.side_effect = lambda p: p
+        hooks.hooks.execute(['hooks/config-changed'])
+        self.assertFalse(self.apt_install.called)
+        self.test_config.set('volume-copy-bps-limit', 104857600)
+        hooks.hooks.execute(['hooks/config-changed'])
+        self.apt_install.assert_called_once_with(['cgroup-tools'],
+                                                 fatal=True)
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'config_value_changed')
+    def test_config_changed_target_helper(self, config_val_changed,
+                                          conf_https):
+        self.openstack_upgrade_available.return_value = False
+        hooks.hooks.execute(['hooks/config-changed'])
+        self.configure_target_helper.assert_called_once_with()
+        self.configure_target_helper.reset_mock()
+        self.service_enabled.side_effect = lambda s: s != 'volume'
+        hooks.hooks.execute(['hooks/config-changed'])
+        self.assertFalse(self.configure_target_helper.called)
 
     @patch.object(hooks, 'configure_https')
     @patch.object(hooks, 'config_value_changed')
@@ -216,7 +350,7 @@ class TestChangedHooks(CharmTestCase):
         self.configure_lvm_storage.assert_called_with(
             ['sdb'],
             'cinder-volumes',
-            False, False, True)
+            False, False, True, **LVM_STORAGE_OPTIONS)
 
     @patch.object(hooks, 'configure_https')
     @patch.object(hooks, 'config_value_changed')
@@ -226,6 +360,7 @@ class TestChangedHooks(CharmTestCase):
         self.openstack_upgrade_available.return_value = True
         hooks.hooks.execute(['hooks/config-changed'])
         self.do_openstack_upgrade.assert_called_with(configs=self.CONFIGS)
+        self.CONFIGS.invalidate_contexts.assert_called_once_with()
 
     @patch('charmhelpers.core.host.service')
     @patch.object(hooks, 'configure_https')
@@ -241,7 +376,8 @@ class TestChangedHooks(CharmTestCase):
         self.assertTrue(conf_https.called)
         self.configure_lvm_storage.assert_called_with(['sdb'],
                                                       'cinder-volumes',
-                                                      False, False, False)
+                                                      False, False, False,
+                                                      **LVM_STORAGE_OPTIONS)
         self.service_restart.assert_called_with('cinder-volume')
 
     @patch.object(hooks, 'config_value_changed')
@@ -414,11 +550,33 @@ class TestChangedHooks(CharmTestCase):
         hooks.hooks.execute(['hooks/storage-backend-relation-broken'])
         self.CONFIGS.write.assert_called_with(utils.CINDER_CONF)
 
+    @patch('charmhelpers.contrib.openstack.utils.is_unit_paused_set')
+    @patch('charmhelpers.core.host.service')
+    def test_storage_backend_changed_restarts(self, service, paused):
+        paused.return_value = False
+        self.CONFIGS.changed_files = []
+        self.CONFIGS.write.side_effect = self.CONFIGS.changed_files.append
+        hooks.hooks.execute(['hooks/storage-backend-relation-changed'])
+        service.assert_has_calls([
+            call('restart', 'cinder-api'),
+            call('restart', 'cinder-volume'),
+            call('restart', 'cinder-scheduler'),
+            call('restart', 'haproxy')])
+
+    @patch('charmhelpers.contrib.openstack.utils.is_unit_paused_set')
+    @patch('charmhelpers.core.host.service')
+    def test_storage_backend_unchanged_no_restart(self, service, paused):
+        paused.return_value = False
+        self.CONFIGS.changed_files = []
+        hooks.hooks.execute(['hooks/storage-backend-relation-changed'])
+        service.assert_not_called()
+
 
 class TestJoinedHooks(CharmTestCase):
 
     def setUp(self):
         super(TestJoinedHooks, self).setUp(hooks, TO_PATCH)
+        self.check_lvm_config.return_value = None
         self.config.side_effect = self.test_config.get
 
     def test_db_joined(self):
@@ -632,6 +790,8 @@ class TestJoinedHooks(CharmTestCase):
         for c in [call('/var/lib/charm/cinder/ceph.conf'),
                   call('/etc/cinder/cinder.conf')]:
             self.assertIn(c, self.CONFIGS.write.call_args_list)
+        self.configure_rbd_data_pools.assert_called_once_with()
+        self.record_ceph_pool_type.assert_called_once_with()
         self.service_restart.assert_called_with('cinder-volume')
 
     @patch.object(hooks, "get_ceph_request")
@@ -649,6 +809,73 @@ class TestJoinedHooks(CharmTestCase):
                   call('/etc/cinder/cinder.conf')]:
             self.assertNotIn(c, self.CONFIGS.write.call_args_list)
 
+    @patch.object(hooks, 'CephBrokerRq')
+    def test_get_ceph_request(self, mock_broker_rq):
+        self.service_name.return_value = 'cinder'
+        self.erasure_coded_pool.return_value = False
+        self.rbd_pool_name.return_value = 'cinder'
+        self.ceph_backends.return_value = []
+        self.volume_pool_weight.return_value = 40.0
+        rq = hooks.get_ceph_request()
+        rq.add_op_create_pool.assert_called_once_with(
+            name='cinder', replica_count=3, weight=40.0, group='volumes')
+        self.assertFalse(rq.add_op_create_erasure_pool.called)
+
+    @patch.object(hooks, 'CephBrokerRq')
+    def test_get_ceph_request_erasure_coded(self, mock_broker_rq):
+        self.service_name.return_value = 'cinder'
+        self.erasure_coded_pool.return_value = True
+        self.rbd_pool_name.return_value = 'cinder-metadata'
+        self.volume_pool_weight.return_value = 50.0
+        self.ceph_backends.return_value = []
+        self.test_config.set('ec-profile-k', 4)
+        self.test_config.set('ec-profile-m', 2)
+        self.test_config.set('ec-profile-device-class', 'hdd')
+        rq = hooks.get_ceph_request()
+        rq.add_op_create_pool.assert_called_once_with(
+            name='cinder-metadata', replica_count=3, weight=0.5,
+            group='volumes', app_name='rbd')
+        rq.add_op_create_erasure_profile.assert_called_once_with(
+            name='cinder-profile', erasure_type='jerasure',
+            erasure_technique=None, k=4, m=2, device_class='hdd')
+        rq.add_op_create_erasure_pool.assert_called_once_with(
+            name='cinder', erasure_profile='cinder-profile', weight=49.5,
+            group='volumes', app_name='rbd', allow_ec_overwrites=True)
+
+    @patch.object(hooks, 'CephBrokerRq')
+    def test_get_ceph_request_ceph_backends(self, mock_broker_rq):
+        self.service_name.return_value = 'cinder'
+        self.erasure_coded_pool.return_value = False
+        self.rbd_pool_name.return_value = 'cinder'
+        self.volume_pool_weight.return_value = 40.0
+        self.ceph_backends.return_value = [
+            {'name': 'ssd', 'backend_name': 'CEPH-ssd',
+             'pool': 'cinder-ssd', 'rbd_pool': 'cinder-ssd',
+             'erasure_coded': False, 'replicas': 3, 'device_class': 'ssd',
+             'crush_rule': 'replicated_ssd', 'ec_profile_k': 1,
+             'ec_profile_m': 2, 'weight': 10.0},
+            {'name': 'hdd', 'backend_name': 'CEPH-hdd',
+             'pool': 'cinder-hdd', 'rbd_pool': 'cinder-hdd-metadata',
+             'erasure_coded': True, 'replicas': 3, 'device_class': 'hdd',
+             'crush_rule': None, 'ec_profile_k': 4, 'ec_profile_m': 2,
+             'weight': 40.0}]
+        rq = hooks.get_ceph_request()
+        rq.add_op_create_pool.assert_has_calls([
+            call(name='cinder', replica_count=3, weight=40.0,
+                 group='volumes'),
+            call(name='cinder-hdd-metadata', replica_count=3, weight=0.4,
+                 group='volumes', app_name='rbd')])
+        rq.add_op_create_replicated_pool.assert_called_once_with(
+            name='cinder-ssd', replica_count=3, weight=10.0,
+            group='volumes', app_name='rbd', crush_profile='replicated_ssd')
+        rq.add_op_create_erasure_profile.assert_called_once_with(
+            name='cinder-hdd-profile', erasure_type='jerasure',
+            erasure_technique=None, k=4, m=2, device_class='hdd')
+        rq.add_op_create_erasure_pool.assert_called_once_with(
+            name='cinder-hdd', erasure_profile='cinder-hdd-profile',
+            weight=39.6, group='volumes', app_name='rbd',
+            allow_ec_overwrites=True)
+
     def test_ceph_changed_no_keys(self):
         'It ensures ceph assets created on ceph changed'
         self.CONFIGS.complete_contexts.return_value = ['ceph']
@@ -665,6 +892,7 @@ class TestJoinedHooks(CharmTestCase):
         with patch.object(hooks, 'CEPH_CONF', new="/some/random/file"):
             hooks.hooks.execute(['hooks/ceph-relation-broken'])
         self.delete_keyring.assert_called_with(service='cinder')
+        self.clear_ceph_pool_type.assert_called_once_with()
         self.assertTrue(self.CONFIGS.write_all.called)
         self.remove_alternative.assert_called_with(
             os.path.basename("/some/random/file"),
@@ -688,6 +916,7 @@ class TestDepartedHooks(CharmTestCase):
 
     def setUp(self):
         super(TestDepartedHooks, self).setUp(hooks, TO_PATCH)
+        self.check_lvm_config.return_value = None
         self.config.side_effect = self.test_config.get_all
 
     def test_amqp_departed(self):
@@ -0,0 +1,174 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+
+from collections import defaultdict
+from unittest.mock import MagicMock, patch
+
+import charmhelpers.contrib.storage.linux.lvm as lvm
+import cinder_profile
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'cache_stats',
+    'unitdata',
+]
+
+
+class FakeKV(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+    def flush(self):
+        pass
+
+
+class TestCinderProfile(CharmTestCase):
+
+    def setUp(self):
+        super(TestCinderProfile, self).setUp(cinder_profile, TO_PATCH)
+        self.kv = FakeKV()
+        self.unitdata.kv.return_value = self.kv
+        self.cache_stats.return_value = {
+            'hits': 3, 'misses': 1, 'evictions': 0, 'functions': {}}
+
+    def test_subprocess_spans(self):
+        check_call = subprocess.check_call
+        with cinder_profile.hook_profile('config-changed') as profiler:
+            subprocess.check_output(['true'])
+            # bound with "from subprocess import check_call"
+            lvm.check_call(['true', 'arg'])
+            with self.assertRaises(subprocess.CalledProcessError):
+                subprocess.check_call(['false'])
+            self.assertEqual(subprocess.call(['false']), 1)
+        self.assertIs(subprocess.check_call, check_call)
+        self.assertIs(lvm.check_call, check_call)
+        spans = [(s['kind'], s['name'], s['args'], s['rc'])
+                 for s in profiler.spans]
+        self.assertEqual(spans, [
+            ('exec', 'true', [], 0),
+            ('exec', 'true', ['arg'], 0),
+            ('exec', 'false', [], 1),
+            ('exec', 'false', [], 1),
+        ])
+        runs = self.kv[cinder_profile.PROFILE_KEY]
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0]['hook'], 'config-changed')
+        self.assertEqual(runs[0]['cache'],
+                         {'hits': 3, 'misses': 1, 'evictions': 0})
+
+    def test_context_and_render_spans(self):
+        context = MagicMock(return_value={'a': 1})
+        context.interfaces = []
+        template = cinder_profile.OSConfigTemplate(
+            config_file='/etc/foo.conf', contexts=[context],
+            context_cache={})
+        renderer = MagicMock(spec=cinder_profile.OSConfigRenderer)
+        renderer.templates = {'/etc/foo.conf': template}
+        with patch.object(cinder_profile.OSConfigRenderer, 'render',
+                          lambda self, config_file: 'rendered'):
+            with cinder_profile.hook_profile('update-status') as profiler:
+                template.context()
+                template.context()
+                cinder_profile.OSConfigRenderer.render(renderer,
+                                                       '/etc/foo.conf')
+        self.assertEqual(context.call_count, 1)
+        self.assertEqual([(s['kind'], s['name']) for s in profiler.spans],
+                         [('context', 'MagicMock'),
+                          ('render', '/etc/foo.conf')])
+
+    def test_spans_past_limit_counted(self):
+        extra = 5
+        with patch.object(cinder_profile, 'MAX_SPANS', 3):
+            with cinder_profile.hook_profile('config-changed') as profiler:
+                for _ in range(3 + extra):
+                    subprocess.call(['true'])
+                subprocess.call(['false'])
+        self.assertEqual(len(profiler.spans), 3)
+        self.assertEqual(profiler.dropped, extra + 1)
+        report = cinder_profile.profile_report()
+        self.assertEqual(report['slowest-hooks'][0]['spans'], 4 + extra)
+        self.assertEqual(report['slowest-hooks'][0]['dropped-spans'],
+                         extra + 1)
+        self.assertEqual(
+            sorted((e['name'], e['calls'], e['failures'])
+                   for e in report['top-subprocesses']),
+            [('false', 1, 1), ('true', 3 + extra, 0)])
+
+    def test_failed_hook_not_saved(self):
+        check_call = subprocess.check_call
+        with self.assertRaises(subprocess.CalledProcessError):
+            with cinder_profile.hook_profile('config-changed'):
+                subprocess.check_call(['false'])
+        self.assertIs(subprocess.check_call, check_call)
+        self.assertNotIn(cinder_profile.PROFILE_KEY, self.kv)
+        self.assertFalse(self.unitdata.kv.called)
+        with self.assertRaises(SystemExit):
+            with cinder_profile.hook_profile('config-changed'):
+                raise SystemExit(1)
+        self.assertNotIn(cinder_profile.PROFILE_KEY, self.kv)
+        with self.assertRaises(SystemExit):
+            with cinder_profile.hook_profile('config-changed'):
+                raise SystemExit(0)
+        self.assertEqual(len(self.kv[cinder_profile.PROFILE_KEY]), 1)
+
+    def test_disabled(self):
+        with cinder_profile.hook_profile('install', enabled=False) as p:
+            self.assertIsNone(p)
+        self.assertNotIn(cinder_profile.PROFILE_KEY, self.kv)
+
+    def test_ring_buffer(self):
+        for i in range(cinder_profile.MAX_RUNS + 2):
+            with cinder_profile.hook_profile('hook-{}'.format(i)):
+                pass
+        runs = self.kv[cinder_profile.PROFILE_KEY]
+        self.assertEqual(len(runs), cinder_profile.MAX_RUNS)
+        self.assertEqual(runs[0]['hook'], 'hook-2')
+
+    def test_profile_report(self):
+        def span(name, duration, rc=0, kind='exec'):
+            return {'kind': kind, 'name': name, 'args': [], 'rc': rc,
+                    'duration': duration}
+
+        def run(hook, started, duration, spans):
+            totals = defaultdict(dict)
+            for s in spans:
+                cinder_profile._add_span(totals[s['kind']], s)
+            return {'hook': hook, 'started': started, 'duration': duration,
+                    'spans': spans, 'dropped-spans': 0, 'totals': totals}
+
+        self.kv[cinder_profile.PROFILE_KEY] = [
+            run('install', 1, 30.0,
+                [span('apt-get', 25.0), span('relation-get', 0.5)]),
+            run('update-status', 2, 2.0,
+                [span('relation-get', 0.5, rc=1),
+                 span('CephContext', 0.2, kind='context')]),
+        ]
+        report = cinder_profile.profile_report(limit=1)
+        self.assertEqual(report['runs'], 2)
+        self.assertEqual(report['slowest-hooks'], [
+            {'hook': 'install', 'started': 1, 'duration': 30.0,
+             'spans': 2, 'dropped-spans': 0}])
+        self.assertEqual(report['top-subprocesses'], [
+            {'name': 'apt-get', 'calls': 1, 'total': 25.0, 'max': 25.0,
+             'failures': 0}])
+        report = cinder_profile.profile_report()
+        self.assertEqual(report['top-subprocesses'][1], {
+            'name': 'relation-get', 'calls': 2, 'total': 1.0, 'max': 0.5,
+            'failures': 1})
+        self.assertEqual(report['top-contexts'][0]['name'], 'CephContext')
+        self.assertEqual(report['top-templates'], [])
@@ -12,17 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import subprocess
 
 from collections import OrderedDict
-from unittest.mock import patch, call, MagicMock, Mock
+from unittest.mock import patch, call, MagicMock, Mock, mock_open
 
 os.environ['JUJU_UNIT_NAME'] = 'cinder'
 import cinder_utils as cinder_utils
 
 from test_utils import CharmTestCase
 
+LVM_INVENTORY = cinder_utils.LVMInventory
+
 TO_PATCH = [
     # helpers.core.hookenv
     'config',
@@ -31,6 +34,7 @@ TO_PATCH = [
     'relation_get',
     'relation_set',
     'local_unit',
+    'status_set',
     # helpers.core.host
     'lsb_release',
     'mounts',
@@ -41,9 +45,7 @@ TO_PATCH = [
     # storage_utils
     'create_lvm_physical_volume',
     'create_lvm_volume_group',
-    'deactivate_lvm_volume_group',
-    'is_lvm_physical_volume',
-    'list_lvm_volume_group',
+    'LVMInventory',
     'relation_ids',
     'relation_set',
     'remove_lvm_physical_volume',
@@ -78,6 +80,47 @@ MOUNTS = [
     ['/mnt', '/dev/fakevbd']
 ]
 
+
+def lvm_reports(pvs=None, lvs=None, free=1073741824):
+    """Return pvs, vgs and lvs JSON reports for the given PVs and LVs.
+
+    :param pvs: device -> volume group name, or None for an unused PV
+    :param lvs: list of (lv_name, vg_name, lv_attr[, segtype]); segtype
+                defaults to thin-pool or linear from lv_attr
+    :param free: free bytes of each PV and VG
+    """
+    pvs = pvs or {}
+    lvs = lvs or []
+    vgs = sorted(set(vg for vg in pvs.values() if vg))
+    return {
+        'pvs': {'pv': [{'pv_name': d, 'vg_name': vg or '',
+                        'pv_size': '1073741824', 'pv_free': str(free)}
+                       for d, vg in pvs.items()]},
+        'vgs': {'vg': [{'vg_name': vg, 'vg_size': '1073741824',
+                        'vg_free': str(free), 'pv_count': '1',
+                        'lv_count': str(len(lvs))} for vg in vgs]},
+        'lvs': {'lv': [{'lv_name': lv[0], 'vg_name': lv[1], 'lv_attr': lv[2],
+                        'lv_size': '1073741824',
+                        'segtype': lv[3] if len(lv) > 3 else (
+                            'thin-pool' if lv[2].startswith('t')
+                            else 'linear')} for lv in lvs]},
+    }
+
+
+def lvm_inventory(pvs=None, lvs=None, free=1073741824):
+    """Build a real LVMInventory from canned reports; refresh() is
+    mocked out."""
+    reports = lvm_reports(pvs, lvs, free)
+
+    def check_output(cmd, **kwargs):
+        return json.dumps({'report': [reports[cmd[0]]]}).encode()
+
+    with patch('subprocess.check_output', side_effect=check_output):
+        inventory = LVM_INVENTORY()
+    inventory.refresh = Mock()
+    return inventory
+
+
 DPKG_OPTIONS = [
     '--option', 'Dpkg::Options::=--force-confnew',
     '--option', 'Dpkg::Options::=--force-confdef',
@@ -101,6 +144,8 @@ class TestCinderUtils(CharmTestCase):
     def setUp(self):
         super(TestCinderUtils, self).setUp(cinder_utils, TO_PATCH)
         self.config.side_effect = self.test_config.get_all
+        cinder_utils.reset_resource_map()
+        self.addCleanup(cinder_utils.reset_resource_map)
         self.apache24_conf_dir = '/etc/apache2/conf-available'
         self.charm_ceph_conf = '/var/lib/charm/cinder/ceph.conf'
         self.ceph_conf = '/etc/ceph/ceph.conf'
@@ -212,6 +257,38 @@ class TestCinderUtils(CharmTestCase):
             sorted(common + cinder_utils.API_PACKAGES + ['memcached'] +
                    cinder_utils.SCHEDULER_PACKAGES))
 
+    @patch.object(cinder_utils, 'get_subordinate_release_packages')
+    @patch('cinder_utils.service_enabled')
+    def test_determine_packages_volume_copy_limit(
+            self, service_enabled, mock_get_subordinate_release_packages):
+        service_enabled.side_effect = self.svc_enabled
+        self.os_release.return_value = 'newton'
+        self.token_cache_pkgs.return_value = []
+        self.test_config.set('enabled-services', 'api,volume')
+        self.assertNotIn('cgroup-tools', cinder_utils.determine_packages())
+        self.test_config.set('volume-copy-bps-limit', 104857600)
+        self.assertIn('cgroup-tools', cinder_utils.determine_packages())
+        self.test_config.set('enabled-services', 'api')
+        self.assertNotIn('cgroup-tools', cinder_utils.determine_packages())
+
+    @patch.object(cinder_utils, 'get_subordinate_release_packages')
+    @patch('cinder_utils.service_enabled')
+    def test_determine_packages_target_helper(
+            self, service_enabled, mock_get_subordinate_release_packages):
+        service_enabled.side_effect = self.svc_enabled
+        self.os_release.return_value = 'yoga'
+        self.token_cache_pkgs.return_value = []
+        self.test_config.set('enabled-services', 'volume')
+        pkgs = cinder_utils.determine_packages()
+        self.assertNotIn('python3-rtslib-fb', pkgs)
+        self.assertNotIn('nvmetcli', pkgs)
+        self.test_config.set('target-helper', 'lioadm')
+        self.assertIn('python3-rtslib-fb', cinder_utils.determine_packages())
+        self.test_config.set('target-helper', 'nvmet')
+        self.assertIn('nvmetcli', cinder_utils.determine_packages())
+        self.test_config.set('enabled-services', 'api')
+        self.assertNotIn('nvmetcli', cinder_utils.determine_packages())
+
     @patch('cinder_utils.restart_map')
     def test_services(self, restart_map):
         restart_map.return_value = OrderedDict([
@@ -240,8 +317,9 @@ class TestCinderUtils(CharmTestCase):
              ['apache2']),
         ])
         for cfg in ex_map.keys():
-            self.assertEqual(cinder_utils.resource_map()[cfg]['services'],
-                             ex_map[cfg])
+            self.assertEqual(
+                list(cinder_utils.resource_map()[cfg]['services']),
+                ex_map[cfg])
 
     @patch('cinder_utils.service_enabled')
     @patch('os.path.exists')
@@ -258,8 +336,9 @@ class TestCinderUtils(CharmTestCase):
                                          'cinder-scheduler']),
         ])
         for cfg in ex_map.keys():
-            self.assertEqual(cinder_utils.resource_map()[cfg]['services'],
-                             ex_map[cfg])
+            self.assertEqual(
+                list(cinder_utils.resource_map()[cfg]['services']),
+                ex_map[cfg])
 
     @patch('cinder_utils.service_enabled')
     @patch('os.path.exists')
@@ -322,6 +401,91 @@ class TestCinderUtils(CharmTestCase):
             'ceph': ['rid1']}[x]
         self.assertTrue(self.charm_ceph_conf in
                         cinder_utils.resource_map().keys())
+        self.mkdir.assert_not_called()
+        self.install_alternative.assert_not_called()
+
+    @patch('cinder_utils.service_enabled')
+    @patch('os.path.exists')
+    def test_resource_map_memoized(self, path_exists, service_enabled):
+        service_enabled.return_value = True
+        path_exists.return_value = True
+        self.os_release.return_value = 'havana'
+        self.ceph_config_file.return_value = self.charm_ceph_conf
+        self.relation_ids.return_value = []
+        with patch.object(cinder_utils, '_build_resource_map',
+                          wraps=cinder_utils._build_resource_map) as build:
+            rmap = cinder_utils.resource_map()
+            self.assertIs(cinder_utils.resource_map(), rmap)
+            self.assertEqual(build.call_count, 1)
+        with self.assertRaises(TypeError):
+            rmap[self.cinder_conf]['services'] = []
+        cinder_utils.reset_resource_map()
+        self.assertIsNot(cinder_utils.resource_map(), rmap)
+
+    @patch('cinder_utils.service_enabled')
+    def test_resource_map_inputs_changed(self, service_enabled):
+        service_enabled.side_effect = self.svc_enabled
+        self.os_release.return_value = 'yoga'
+        self.ceph_config_file.return_value = self.charm_ceph_conf
+        self.relation_ids.return_value = []
+        self.test_config.set('enabled-services', 'api,backup')
+        rmap = cinder_utils.resource_map()
+        self.assertNotIn('cinder-volume', rmap[self.cinder_conf]['services'])
+        # e.g. config-changed enabling the volume service.
+        self.test_config.set('enabled-services', 'api,volume,backup')
+        self.assertIn('cinder-volume',
+                      cinder_utils.resource_map()[self.cinder_conf][
+                          'services'])
+        self.relation_ids.side_effect = lambda r: (
+            ['backup-backend:1'] if r == 'backup-backend' else [])
+        self.assertIn('cinder-backup',
+                      cinder_utils.resource_map()[self.cinder_conf][
+                          'services'])
+
+    @patch('cinder_utils.service_enabled')
+    @patch('os.path.exists')
+    def test_resource_map_shares_contexts(self, path_exists,
+                                          service_enabled):
+        service_enabled.return_value = True
+        path_exists.return_value = True
+        self.os_release.return_value = 'havana'
+        self.ceph_config_file.return_value = self.charm_ceph_conf
+        self.relation_ids.return_value = []
+        rmap = cinder_utils.resource_map()
+        haproxy_ctxt = [
+            c for c in rmap[self.cinder_conf]['contexts']
+            if isinstance(c, cinder_utils.cinder_contexts.HAProxyContext)]
+        self.assertEqual(len(haproxy_ctxt), 1)
+        self.assertIn(haproxy_ctxt[0],
+                      rmap['/etc/haproxy/haproxy.cfg']['contexts'])
+
+    @patch('cinder_utils.service_enabled')
+    @patch('os.path.exists')
+    def test_resource_map_target_helper(self, path_exists, service_enabled):
+        service_enabled.side_effect = self.svc_enabled
+        path_exists.return_value = True
+        self.os_release.return_value = 'yoga'
+        self.ceph_config_file.return_value = self.charm_ceph_conf
+        self.relation_ids.return_value = []
+        self.test_config.set('enabled-services', 'volume')
+        self.assertNotIn(cinder_utils.TARGET_MODULES_CONF,
+                         cinder_utils.resource_map())
+        cinder_utils.reset_resource_map()
+        self.test_config.set('target-helper', 'lioadm')
+        self.assertEqual(
+            cinder_utils.resource_map()[
+                cinder_utils.TARGET_MODULES_CONF]['services'],
+            ('rtslib-fb-targetctl',))
+        cinder_utils.reset_resource_map()
+        self.test_config.set('enabled-services', 'api')
+        self.assertNotIn(cinder_utils.TARGET_MODULES_CONF,
+                         cinder_utils.resource_map())
+
+    @patch('os.path.exists')
+    def test_install_ceph_config_alternative(self, path_exists):
+        path_exists.return_value = True
+        self.ceph_config_file.return_value = self.charm_ceph_conf
+        cinder_utils.install_ceph_config_alternative()
         self.mkdir.assert_has_calls(
             [call('/etc/ceph'),
              call('/var/lib/charm/cinder')]
@@ -401,7 +565,7 @@ class TestCinderUtils(CharmTestCase):
 
     def test_clean_storage_unmount(self):
         'It unmounts block device when cleaning storage'
-        self.is_lvm_physical_volume.return_value = False
+        self.LVMInventory.return_value = lvm_inventory()
         self.zap_disk.return_value = True
         self.mounts.return_value = MOUNTS
         cinder_utils.clean_storage('/dev/fakevbd')
@@ -410,19 +574,119 @@ class TestCinderUtils(CharmTestCase):
     def test_clean_storage_lvm_wipe(self):
         'It removes traces of LVM when cleaning storage'
         self.mounts.return_value = []
-        self.is_lvm_physical_volume.return_value = True
-        cinder_utils.clean_storage('/dev/fakevbd')
+        self.LVMInventory.return_value = lvm_inventory(
+            {'/dev/fakevbd': 'test'})
+        with patch('subprocess.check_call') as check_call:
+            cinder_utils.clean_storage('/dev/fakevbd')
         self.remove_lvm_physical_volume.assert_called_with('/dev/fakevbd')
-        self.deactivate_lvm_volume_group.assert_called_with('/dev/fakevbd')
+        check_call.assert_called_once_with(['vgchange', '-an', 'test'])
         self.zap_disk.assert_called_with('/dev/fakevbd')
 
     def test_clean_storage_zap_disk(self):
         'It removes traces of LVM when cleaning storage'
         self.mounts.return_value = []
-        self.is_lvm_physical_volume.return_value = False
+        self.LVMInventory.return_value = lvm_inventory()
         cinder_utils.clean_storage('/dev/fakevbd')
         self.zap_disk.assert_called_with('/dev/fakevbd')
 
+    def test_clean_storage_wipe_method(self):
+        self.mounts.return_value = []
+        self.LVMInventory.return_value = lvm_inventory()
+        with patch('subprocess.check_call') as check_call:
+            cinder_utils.clean_storage('/dev/fakevbd', wipe_method='wipefs')
+        check_call.assert_called_once_with(['wipefs', '--all', '/dev/fakevbd'])
+        self.assertFalse(self.zap_disk.called)
+
+    @patch('os.path.exists')
+    @patch('os.path.realpath')
+    def test_discard_max_bytes(self, realpath, exists):
+        realpath.side_effect = lambda p: p.replace('/dev/disk/by-id/a',
+                                                   '/dev/sdb')
+        exists.return_value = False
+        with patch('builtins.open', mock_open(read_data='2147450880\n')) \
+                as _open:
+            self.assertEqual(
+                cinder_utils.discard_max_bytes('/dev/disk/by-id/a'),
+                2147450880)
+        _open.assert_called_once_with(
+            '/sys/class/block/sdb/queue/discard_max_bytes')
+        realpath.side_effect = lambda p: p.replace(
+            '/sys/class/block/sdb1', '/sys/devices/pci0/block/sdb/sdb1')
+        exists.return_value = True
+        with patch('builtins.open', mock_open(read_data='0\n')) as _open:
+            self.assertEqual(cinder_utils.discard_max_bytes('/dev/sdb1'), 0)
+        _open.assert_called_once_with(
+            '/sys/devices/pci0/block/sdb/queue/discard_max_bytes')
+        with patch('builtins.open', side_effect=IOError):
+            self.assertEqual(cinder_utils.discard_max_bytes('/dev/sdb1'), 0)
+
+    @patch('subprocess.check_call')
+    def test_wipe_block_device_zap(self, check_call):
+        cinder_utils.wipe_block_device('/dev/sdb')
+        self.zap_disk.assert_called_once_with('/dev/sdb')
+        cinder_utils.wipe_block_device('/dev/sdc', 'bogus')
+        self.zap_disk.assert_called_with('/dev/sdc')
+        self.assertFalse(check_call.called)
+
+    @patch('subprocess.check_call')
+    def test_wipe_block_device_wipefs(self, check_call):
+        cinder_utils.wipe_block_device('/dev/sdb', 'wipefs')
+        check_call.assert_called_once_with(['wipefs', '--all', '/dev/sdb'])
+        self.assertFalse(self.zap_disk.called)
+
+    @patch.object(cinder_utils, 'discard_max_bytes')
+    @patch('subprocess.check_call')
+    def test_wipe_block_device_blkdiscard(self, check_call, max_bytes):
+        max_bytes.return_value = 2147450880
+        cinder_utils.wipe_block_device('/dev/sdb', 'blkdiscard')
+        check_call.assert_has_calls([
+            call(['blkdiscard', '/dev/sdb']),
+            call(['wipefs', '--all', '/dev/sdb'])])
+        self.assertEqual(check_call.call_count, 2)
+        self.assertFalse(self.zap_disk.called)
+
+    @patch.object(cinder_utils, 'discard_max_bytes')
+    @patch('subprocess.check_call')
+    def test_wipe_block_device_no_discard(self, check_call, max_bytes):
+        max_bytes.return_value = 0
+        cinder_utils.wipe_block_device('/dev/sdb', 'blkdiscard-secure')
+        self.assertFalse(check_call.called)
+        self.zap_disk.assert_called_once_with('/dev/sdb')
+
+    @patch.object(cinder_utils, 'discard_max_bytes')
+    @patch('subprocess.check_call')
+    def test_wipe_block_device_secure_fallback(self, check_call, max_bytes):
+        max_bytes.return_value = 2147450880
+
+        def _check_call(cmd):
+            if '--secure' in cmd:
+                raise subprocess.CalledProcessError(1, cmd)
+
+        check_call.side_effect = _check_call
+        cinder_utils.wipe_block_device('/dev/sdb', 'blkdiscard-secure')
+        check_call.assert_has_calls([
+            call(['blkdiscard', '--secure', '/dev/sdb']),
+            call(['blkdiscard', '/dev/sdb']),
+            call(['wipefs', '--all', '/dev/sdb'])])
+        self.assertFalse(self.zap_disk.called)
+
+        check_call.reset_mock()
+        check_call.side_effect = subprocess.CalledProcessError(1, 'blk')
+        cinder_utils.wipe_block_device('/dev/sdb', 'blkdiscard-secure')
+        self.assertEqual(check_call.call_count, 2)
+        self.zap_disk.assert_called_once_with('/dev/sdb')
+
+    @patch.object(cinder_utils, 'relation_ids', lambda *_: [])
+    def test_check_optional_relations_wipe_method(self):
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+        self.assertEqual(cinder_utils.check_optional_relations(None),
+                         ('unknown', ''))
+        self.test_config.set('wipe-method', 'shred')
+        status, message = cinder_utils.check_optional_relations(None)
+        self.assertEqual(status, 'blocked')
+        self.assertIn('Invalid wipe-method shred', message)
+
     def test_parse_block_device(self):
         self.assertTrue(cinder_utils._parse_block_device(None),
                         (None, 0))
@@ -446,58 +710,59 @@ class TestCinderUtils(CharmTestCase):
 
     @patch('cinder_utils.log_lvm_info', Mock())
     @patch.object(cinder_utils, 'ensure_lvm_volume_group_non_existent')
-    @patch.object(cinder_utils, 'clean_storage')
+    @patch.object(cinder_utils, 'release_storage')
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     @patch.object(cinder_utils, 'extend_lvm_volume_group')
-    @patch.object(cinder_utils, 'list_thin_logical_volume_pools')
-    def test_configure_lvm_storage(self, list_thin_pools,
-                                   extend_lvm, reduce_lvm, clean_storage,
-                                   ensure_non_existent):
+    def test_configure_lvm_storage(self, extend_lvm, reduce_lvm,
+                                   release_storage, ensure_non_existent):
         devices = ['/dev/fakevbd', '/dev/fakevdc']
         self.is_device_mounted.return_value = False
-        self.is_lvm_physical_volume.return_value = False
+        self.LVMInventory.return_value = lvm_inventory()
         self.is_block_device.return_value = True
         self.ensure_loopback_device.side_effect = lambda x, y: x
         cinder_utils.configure_lvm_storage(devices, 'test', True, True)
-        clean_storage.assert_has_calls(
-            [call('/dev/fakevbd'),
-             call('/dev/fakevdc')]
+        inventory = self.LVMInventory.return_value
+        release_storage.assert_has_calls(
+            [call('/dev/fakevbd', inventory),
+             call('/dev/fakevdc', inventory)], any_order=True
         )
+        self.zap_disk.assert_has_calls(
+            [call('/dev/fakevbd'), call('/dev/fakevdc')], any_order=True)
         self.create_lvm_physical_volume.assert_has_calls(
             [call('/dev/fakevbd'),
-             call('/dev/fakevdc')]
+             call('/dev/fakevdc')], any_order=True
         )
         self.create_lvm_volume_group.assert_called_with('test', '/dev/fakevbd')
         reduce_lvm.assert_called_with('test')
         extend_lvm.assert_called_with('test', '/dev/fakevdc')
-        ensure_non_existent.assert_called_with('test')
+        ensure_non_existent.assert_called_with(
+            'test', inventory=self.LVMInventory.return_value)
 
     @patch('cinder_utils.log_lvm_info', Mock())
     @patch.object(cinder_utils, 'has_partition_table')
-    @patch.object(cinder_utils, 'clean_storage')
+    @patch.object(cinder_utils, 'release_storage')
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     @patch.object(cinder_utils, 'extend_lvm_volume_group')
-    @patch.object(cinder_utils, 'list_thin_logical_volume_pools')
     @patch.object(cinder_utils, 'extend_logical_volume_by_device')
     def test_configure_lvm_storage_unused_dev(self, extend_lv_by_dev,
-                                              list_thin_pools,
                                               extend_lvm, reduce_lvm,
-                                              clean_storage, has_part):
+                                              release_storage, has_part):
         devices = ['/dev/fakevbd', '/dev/fakevdc']
         self.is_device_mounted.return_value = False
-        self.is_lvm_physical_volume.return_value = False
+        self.LVMInventory.return_value = lvm_inventory(
+            lvs=[('thinpool', 'vg', 'twi-a-tz--')])
         self.is_block_device.return_value = True
         has_part.return_value = False
         self.ensure_loopback_device.side_effect = lambda x, y: x
-        list_thin_pools.return_value = ['vg/thinpool']
         cinder_utils.configure_lvm_storage(devices, 'test', False, True)
-        clean_storage.assert_has_calls(
-            [call('/dev/fakevbd'),
-             call('/dev/fakevdc')]
+        inventory = self.LVMInventory.return_value
+        release_storage.assert_has_calls(
+            [call('/dev/fakevbd', inventory),
+             call('/dev/fakevdc', inventory)], any_order=True
         )
         self.create_lvm_physical_volume.assert_has_calls(
             [call('/dev/fakevbd'),
-             call('/dev/fakevdc')]
+             call('/dev/fakevdc')], any_order=True
         )
         self.create_lvm_volume_group.assert_called_with('test', '/dev/fakevbd')
         reduce_lvm.assert_called_with('test')
@@ -510,65 +775,52 @@ class TestCinderUtils(CharmTestCase):
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     def test_configure_lvm_storage_used_dev(self, reduce_lvm, has_part):
         devices = ['/dev/fakevbd', '/dev/fakevdc']
-        self.is_lvm_physical_volume.return_value = False
+        self.LVMInventory.return_value = lvm_inventory()
         has_part.return_value = True
         cinder_utils.configure_lvm_storage(devices, 'test', False, True)
         reduce_lvm.assert_called_with('test')
 
     @patch('cinder_utils.log_lvm_info', Mock())
     @patch.object(cinder_utils, 'ensure_lvm_volume_group_non_existent')
-    @patch.object(cinder_utils, 'clean_storage')
+    @patch.object(cinder_utils, 'release_storage')
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     @patch.object(cinder_utils, 'extend_lvm_volume_group')
     def test_configure_lvm_storage_loopback(self, extend_lvm, reduce_lvm,
-                                            clean_storage,
+                                            release_storage,
                                             ensure_non_existent):
         devices = ['/mnt/loop0|10']
         self.ensure_loopback_device.return_value = '/dev/loop0'
         self.is_device_mounted.return_value = False
-        self.is_lvm_physical_volume.return_value = False
+        self.LVMInventory.return_value = lvm_inventory()
         self.is_block_device.return_value = False
         cinder_utils.configure_lvm_storage(devices, 'test', True, True)
-        clean_storage.assert_called_with('/dev/loop0')
+        release_storage.assert_called_with(
+            '/dev/loop0', self.LVMInventory.return_value)
         self.ensure_loopback_device.assert_called_with('/mnt/loop0', '10')
         self.create_lvm_physical_volume.assert_called_with('/dev/loop0')
         self.create_lvm_volume_group.assert_called_with('test', '/dev/loop0')
         reduce_lvm.assert_called_with('test')
         self.assertFalse(extend_lvm.called)
-        ensure_non_existent.assert_called_with('test')
+        ensure_non_existent.assert_called_with(
+            'test', inventory=self.LVMInventory.return_value)
 
     @patch.object(cinder_utils, 'lvm_volume_group_exists')
     @patch('cinder_utils.log_lvm_info', Mock())
-    @patch.object(cinder_utils, 'clean_storage')
+    @patch.object(cinder_utils, 'release_storage')
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     @patch.object(cinder_utils, 'extend_lvm_volume_group')
-    @patch.object(cinder_utils, 'list_thin_logical_volume_pools')
-    def test_configure_lvm_storage_existing_vg(self, list_thin_pools,
-                                               extend_lvm, reduce_lvm,
-                                               clean_storage, lvm_exists):
-        def pv_lookup(device):
-            devices = {
-                '/dev/fakevbd': True,
-                '/dev/fakevdc': False
-            }
-            return devices[device]
-
-        def vg_lookup(device):
-            devices = {
-                '/dev/fakevbd': 'test',
-                '/dev/fakevdc': None
-            }
-            return devices[device]
+    def test_configure_lvm_storage_existing_vg(self, extend_lvm, reduce_lvm,
+                                               release_storage, lvm_exists):
         devices = ['/dev/fakevbd', '/dev/fakevdc']
         self.is_device_mounted.return_value = False
         self.is_block_device.return_value = True
         lvm_exists.return_value = False
-        self.is_lvm_physical_volume.side_effect = pv_lookup
-        self.list_lvm_volume_group.side_effect = vg_lookup
+        self.LVMInventory.return_value = lvm_inventory(
+            {'/dev/fakevbd': 'test'})
         self.ensure_loopback_device.side_effect = lambda x, y: x
         cinder_utils.configure_lvm_storage(devices, 'test', True, True)
-        clean_storage.assert_has_calls(
-            [call('/dev/fakevdc')]
+        release_storage.assert_has_calls(
+            [call('/dev/fakevdc', self.LVMInventory.return_value)]
         )
         self.create_lvm_physical_volume.assert_has_calls(
             [call('/dev/fakevdc')]
@@ -579,66 +831,39 @@ class TestCinderUtils(CharmTestCase):
 
     @patch.object(cinder_utils, 'lvm_volume_group_exists')
     @patch('cinder_utils.log_lvm_info', Mock())
-    @patch.object(cinder_utils, 'clean_storage')
+    @patch.object(cinder_utils, 'release_storage')
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     @patch.object(cinder_utils, 'extend_lvm_volume_group')
-    @patch.object(cinder_utils, 'list_thin_logical_volume_pools')
-    def test_configure_lvm_storage_different_vg(self, list_thin_pools,
-                                                extend_lvm, reduce_lvm,
-                                                clean_storage, lvm_exists):
-        def pv_lookup(device):
-            devices = {
-                '/dev/fakevbd': True,
-                '/dev/fakevdc': True
-            }
-            return devices[device]
-
-        def vg_lookup(device):
-            devices = {
-                '/dev/fakevbd': 'test',
-                '/dev/fakevdc': 'another'
-            }
-            return devices[device]
+    def test_configure_lvm_storage_different_vg(self, extend_lvm, reduce_lvm,
+                                                release_storage, lvm_exists):
         devices = ['/dev/fakevbd', '/dev/fakevdc']
         self.is_device_mounted.return_value = False
         self.is_block_device.return_value = True
-        self.is_lvm_physical_volume.side_effect = pv_lookup
-        self.list_lvm_volume_group.side_effect = vg_lookup
+        self.LVMInventory.return_value = lvm_inventory(
+            {'/dev/fakevbd': 'test', '/dev/fakevdc': 'another'})
         lvm_exists.return_value = False
         self.ensure_loopback_device.side_effect = lambda x, y: x
         cinder_utils.configure_lvm_storage(devices, 'test', True, True)
-        clean_storage.assert_called_with('/dev/fakevdc')
+        release_storage.assert_called_with('/dev/fakevdc',
+                                           self.LVMInventory.return_value)
         self.create_lvm_physical_volume.assert_called_with('/dev/fakevdc')
         reduce_lvm.assert_called_with('test')
         extend_lvm.assert_called_with('test', '/dev/fakevdc')
         self.assertFalse(self.create_lvm_volume_group.called)
 
     @patch('cinder_utils.log_lvm_info', Mock())
-    @patch.object(cinder_utils, 'clean_storage')
+    @patch.object(cinder_utils, 'release_storage')
     @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
     @patch.object(cinder_utils, 'extend_lvm_volume_group')
     def test_configure_lvm_storage_different_vg_ignore(self, extend_lvm,
                                                        reduce_lvm,
-                                                       clean_storage):
-        def pv_lookup(device):
-            devices = {
-                '/dev/fakevbd': True,
-                '/dev/fakevdc': True
-            }
-            return devices[device]
-
-        def vg_lookup(device):
-            devices = {
-                '/dev/fakevbd': 'test',
-                '/dev/fakevdc': 'another'
-            }
-            return devices[device]
+                                                       release_storage):
         devices = ['/dev/fakevbd', '/dev/fakevdc']
-        self.is_lvm_physical_volume.side_effect = pv_lookup
-        self.list_lvm_volume_group.side_effect = vg_lookup
+        self.LVMInventory.return_value = lvm_inventory(
+            {'/dev/fakevbd': 'test', '/dev/fakevdc': 'another'})
         self.ensure_loopback_device.side_effect = lambda x, y: x
         cinder_utils.configure_lvm_storage(devices, 'test', False, False)
-        self.assertFalse(clean_storage.called)
+        self.assertFalse(release_storage.called)
         self.assertFalse(self.create_lvm_physical_volume.called)
         self.assertFalse(reduce_lvm.called)
         self.assertFalse(extend_lvm.called)
@@ -796,8 +1021,11 @@ class TestCinderUtils(CharmTestCase):
                               cinder_utils.migrate_database,
                               upgrade=True)
 
+    @patch.object(cinder_utils, 'install_ceph_config_alternative')
     @patch.object(cinder_utils, 'resource_map')
-    def test_register_configs(self, resource_map):
+    def test_register_configs(self, resource_map,
+                              install_ceph_config_alternative):
+        self.relation_ids.return_value = ['ceph:1']
         resource_map.return_value = OrderedDict([
             ('/etc/testfile1.conf', {
                 'contexts': ['dummyctxt1', 'dummyctxt2'],
@@ -814,6 +1042,7 @@ class TestCinderUtils(CharmTestCase):
             call('/etc/testfile2.conf', ['dummyctxt1', 'dummyctxt3']),
         ]
         configs.register.assert_has_calls(calls)
+        install_ceph_config_alternative.assert_called_once_with()
 
     def test_set_ceph_kludge(self):
         pass
@@ -988,13 +1217,741 @@ class TestCinderUtils(CharmTestCase):
         self.relation_set.assert_has_calls(calls)
         self.service_restart.assert_called_with('svc1')
 
+    def test_log_lvm_info(self):
+        cinder_utils.log_lvm_info(lvm_inventory(
+            {'/dev/fakevbd': 'test', '/dev/fakevdc': None}, free=0))
+        self.juju_log.assert_has_calls([
+            call('LVM physical volumes: /dev/fakevbd (test), '
+                 '/dev/fakevdc (no VG)'),
+            call('LVM volume groups: test (1 PVs, 0 free of 1073741824 '
+                 'bytes)')])
+
+    @patch('os.path.realpath')
+    @patch('subprocess.check_output')
+    def test_lvm_inventory(self, check_output, realpath):
+        reports = lvm_reports(
+            {'/dev/sdb': 'cinder-volumes', '/dev/sdc': None},
+            [('pool', 'cinder-volumes', 'twi-aotz--'),
+             ('volume-1', 'cinder-volumes', 'Vwi-aotz--')])
+        check_output.side_effect = lambda cmd: json.dumps(
+            {'report': [reports[cmd[0]]]}).encode()
+        realpath.side_effect = lambda p: p.replace('/dev/disk/by-id/b',
+                                                   '/dev/sdb')
+        inventory = LVM_INVENTORY()
+        self.assertEqual([c[0][0][0] for c in check_output.call_args_list],
+                         ['pvs', 'vgs', 'lvs'])
+        self.assertIn('--reportformat', check_output.call_args[0][0])
+        self.assertTrue(inventory.is_physical_volume('/dev/sdb'))
+        self.assertTrue(inventory.is_physical_volume('/dev/disk/by-id/b'))
+        self.assertFalse(inventory.is_physical_volume('/dev/sdd'))
+        self.assertEqual(inventory.volume_group_of('/dev/sdb'),
+                         'cinder-volumes')
+        self.assertIsNone(inventory.volume_group_of('/dev/sdc'))
+        self.assertIsNone(inventory.volume_group_of('/dev/sdd'))
+        self.assertTrue(inventory.has_volume_group('cinder-volumes'))
+        self.assertFalse(inventory.has_volume_group('other'))
+        self.assertEqual(inventory.thin_pools(), ['cinder-volumes/pool'])
+        self.assertEqual(
+            inventory.volume_groups['cinder-volumes'].size, 1073741824)
+        inventory.refresh()
+        self.assertEqual(check_output.call_count, 6)
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
+    def test_configure_lvm_storage_single_snapshot(self, reduce_lvm):
+        """Existing configuration is checked without further LVM calls."""
+        devices = ['/dev/fakevbd', '/dev/fakevdc']
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        inventory = lvm_inventory(
+            {'/dev/fakevbd': 'test', '/dev/fakevdc': 'test'})
+        self.LVMInventory.return_value = inventory
+        with patch('subprocess.check_output') as check_output:
+            cinder_utils.configure_lvm_storage(devices, 'test', False, False)
+        self.LVMInventory.assert_called_once_with()
+        self.assertFalse(check_output.called)
+        self.assertFalse(inventory.refresh.called)
+        self.assertFalse(self.create_lvm_volume_group.called)
+        self.assertFalse(reduce_lvm.called)
+
+    @patch.object(cinder_utils, 'initialise_volume')
+    @patch.object(cinder_utils, 'release_storage')
+    def test_prepare_volumes(self, release_storage, initialise_volume):
+        devices = ['/dev/sd{}'.format(c) for c in 'bcdefghijkl']
+        inventory = lvm_inventory()
+        manager = Mock()
+        manager.attach_mock(release_storage, 'release_storage')
+        manager.attach_mock(initialise_volume, 'initialise_volume')
+        prepared, failed = cinder_utils.prepare_volumes(devices, inventory)
+        self.assertEqual(prepared, devices)
+        self.assertEqual(failed, {})
+        # every device is released, serially, before any is wiped.
+        self.assertEqual(
+            manager.mock_calls[:len(devices)],
+            [call.release_storage(device, inventory) for device in devices])
+        initialise_volume.assert_has_calls(
+            [call(device, 'zap') for device in devices], any_order=True)
+        self.assertEqual(
+            self.status_set.call_args_list,
+            [call('maintenance', 'Preparing block devices ({}/11)'.format(n))
+             for n in range(12)])
+
+    @patch.object(cinder_utils, 'initialise_volume')
+    @patch.object(cinder_utils, 'release_storage')
+    def test_prepare_volumes_none(self, release_storage, initialise_volume):
+        self.assertEqual(cinder_utils.prepare_volumes([]), ([], {}))
+        self.assertFalse(release_storage.called)
+        self.assertFalse(initialise_volume.called)
+        self.assertFalse(self.status_set.called)
+
+    @patch.object(cinder_utils, 'initialise_volume')
+    @patch.object(cinder_utils, 'release_storage')
+    def test_prepare_volumes_failure(self, release_storage,
+                                     initialise_volume):
+        error = subprocess.CalledProcessError(5, ['pvcreate', '/dev/sdc'])
+        busy = subprocess.CalledProcessError(5, ['vgchange', '-an', 'vg'])
+
+        def _initialise(device, wipe_method):
+            if device == '/dev/sdc':
+                raise error
+
+        def _release(device, inventory):
+            if device == '/dev/sde':
+                raise busy
+
+        initialise_volume.side_effect = _initialise
+        release_storage.side_effect = _release
+        prepared, failed = cinder_utils.prepare_volumes(
+            ['/dev/sdb', '/dev/sdc', '/dev/sdd', '/dev/sde'])
+        self.assertEqual(prepared, ['/dev/sdb', '/dev/sdd'])
+        self.assertEqual(failed, {'/dev/sdc': error, '/dev/sde': busy})
+        self.assertNotIn(call('/dev/sde', 'zap'),
+                         initialise_volume.call_args_list)
+        self.assertEqual(self.status_set.call_args_list[-1],
+                         call('maintenance', 'Preparing block devices (4/4)'))
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'ensure_lvm_volume_group_non_existent',
+                  Mock())
+    @patch.object(cinder_utils, 'prepare_volumes')
+    @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing')
+    @patch.object(cinder_utils, 'extend_lvm_volume_group')
+    def test_configure_lvm_storage_prepare_failure(self, extend_lvm,
+                                                   reduce_lvm,
+                                                   prepare_volumes):
+        """Devices prepared successfully are used before failing."""
+        devices = ['/dev/fakevbd', '/dev/fakevdc', '/dev/fakevdd']
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        self.LVMInventory.return_value = lvm_inventory()
+        prepare_volumes.return_value = (
+            ['/dev/fakevdc', '/dev/fakevdd'], {'/dev/fakevbd': OSError()})
+        with self.assertRaises(cinder_utils.CinderCharmError) as ctx:
+            cinder_utils.configure_lvm_storage(devices, 'test', True, True)
+        self.assertIn('/dev/fakevbd', str(ctx.exception))
+        prepare_volumes.assert_called_once_with(
+            devices, self.LVMInventory.return_value, 'zap')
+        self.create_lvm_volume_group.assert_called_once_with(
+            'test', '/dev/fakevdc')
+        extend_lvm.assert_called_once_with('test', '/dev/fakevdd')
+        reduce_lvm.assert_called_once_with('test')
+
+    @patch('subprocess.check_call')
+    def test_create_thin_pool(self, check_call):
+        cinder_utils.create_thin_pool('test')
+        check_call.assert_called_once_with(
+            ['lvcreate', '--type', 'thin-pool', '--extents', '95%FREE',
+             '--name', 'test-pool', 'test'])
+        cinder_utils.create_thin_pool('test', '64k', '1G')
+        check_call.assert_called_with(
+            ['lvcreate', '--type', 'thin-pool', '--extents', '95%FREE',
+             '--name', 'test-pool', '--chunksize', '64k',
+             '--poolmetadatasize', '1G', 'test'])
+
+    def test_lvm_layout_args(self):
+        layout = cinder_utils.lvm_layout_args
+        self.assertEqual(layout(), [])
+        self.assertEqual(layout(1, '64k'), [])
+        self.assertEqual(layout(4, '64k'),
+                         ['--stripes', '4', '--stripesize', '64k'])
+        self.assertEqual(layout(2, None, 'raid0'),
+                         ['--type', 'raid0', '--stripes', '2'])
+        self.assertEqual(layout(3, '64k', 'raid1'),
+                         ['--type', 'raid1', '--mirrors', '2'])
+        self.assertEqual(layout(4, None, 'raid5'),
+                         ['--type', 'raid5', '--stripes', '3'])
+        self.assertEqual(layout(6, None, 'raid6'),
+                         ['--type', 'raid6', '--stripes', '4'])
+        self.assertEqual(layout(6, '128k', 'raid10'),
+                         ['--type', 'raid10', '--mirrors', '1',
+                          '--stripes', '3', '--stripesize', '128k'])
+
+    @patch('subprocess.check_call')
+    def test_create_thin_pool_layout(self, check_call):
+        cinder_utils.create_thin_pool('test', layout=['--stripes', '2'],
+                                      devices=['/dev/sdb', '/dev/sdc'])
+        check_call.assert_called_once_with(
+            ['lvcreate', '--type', 'thin-pool', '--extents', '95%FREE',
+             '--name', 'test-pool', '--stripes', '2', 'test', '/dev/sdb',
+             '/dev/sdc'])
+        check_call.reset_mock()
+        cinder_utils.create_thin_pool(
+            'test', '64k', layout=['--type', 'raid5', '--stripes', '2'])
+        check_call.assert_has_calls([
+            call(['lvcreate', '--yes', '--type', 'raid5', '--stripes', '2',
+                  '--extents', '95%FREE', '--name', 'test-pool', 'test']),
+            call(['lvconvert', '--yes', '--type', 'thin-pool',
+                  '--chunksize', '64k', 'test/test-pool'])])
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'release_storage', Mock())
+    @patch.object(cinder_utils, 'has_partition_table',
+                  Mock(return_value=False))
+    @patch.object(cinder_utils, 'ensure_thin_pool')
+    @patch.object(cinder_utils, 'extend_lvm_volume_group')
+    @patch.object(cinder_utils, 'extend_logical_volume_by_device')
+    def test_configure_lvm_storage_striped(self, extend_lv_by_dev,
+                                           extend_lvm, ensure_thin_pool):
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        inventory = lvm_inventory({'/dev/sdb': 'test'},
+                                  [('test-pool', 'test', 'twi-aotz--')])
+        self.LVMInventory.return_value = inventory
+        ensure_thin_pool.return_value = False
+        cinder_utils.configure_lvm_storage(
+            ['/dev/sdb', '/dev/sdc'], 'test', lvm_type='thin',
+            lvm_stripes=4, lvm_stripe_size='64k', lvm_raid_level='raid10')
+        extend_lvm.assert_called_once_with('test', '/dev/sdc')
+        self.assertFalse(extend_lv_by_dev.called)
+        ensure_thin_pool.assert_called_once_with(
+            'test', inventory, None, None, None,
+            ['--type', 'raid10', '--mirrors', '1', '--stripes', '2',
+             '--stripesize', '64k'])
+
+    def test_check_lvm_config_layout(self):
+        self.config.side_effect = self.test_config.get
+        for lvm_type, raid_level, stripes, valid in (
+                ('default', '', 1, True),
+                ('default', 'raid1', 2, True),
+                ('default', 'raid1', 1, False),
+                ('default', '', 2, False),
+                ('default', 'raid5', 3, False),
+                ('thin', '', 4, True),
+                ('thin', 'raid0', 1, False),
+                ('thin', 'raid5', 3, True),
+                ('thin', 'raid6', 4, False),
+                ('auto', 'raid10', 4, True),
+                ('auto', 'raid10', 5, False),
+                ('thin', 'raid50', 4, False)):
+            with self.subTest(lvm_type=lvm_type, raid_level=raid_level,
+                              stripes=stripes):
+                self.test_config.set('lvm-type', lvm_type)
+                self.test_config.set('lvm-raid-level', raid_level)
+                self.test_config.set('lvm-stripes', stripes)
+                message = cinder_utils.check_lvm_config()
+                self.assertEqual(message is None, valid, message)
+
+    @patch('glob.glob')
+    def test_expand_block_devices(self, _glob):
+        _glob.return_value = ['/dev/sdc', '/dev/sdb']
+        self.assertEqual(
+            cinder_utils.expand_block_devices(['/dev/nvme0n1',
+                                               '/dev/sd[b-c]']),
+            ['/dev/nvme0n1', '/dev/sdb', '/dev/sdc'])
+        _glob.assert_called_once_with('/dev/sd[b-c]')
+
+    def test_check_lvm_config_device_groups(self):
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('block-device', 'sdb')
+        self.test_config.set('lvm-device-groups', 'fast: /dev/nvme0n1')
+        self.assertIsNone(cinder_utils.check_lvm_config())
+        self.test_config.set('lvm-device-groups', 'fast: /dev/nvme0n1 sdb')
+        self.assertIsNone(cinder_utils.check_lvm_config())
+        self.test_config.set('lvm-device-groups', 'fast: /dev/sdb')
+        self.assertEqual(cinder_utils.check_lvm_config(),
+                         'Block device /dev/sdb is used by both '
+                         'block-device and fast')
+        self.test_config.set('lvm-device-groups',
+                             'fast: /dev/nvme0n1\nbulk: /dev/nvme0n1')
+        self.assertEqual(cinder_utils.check_lvm_config(),
+                         'Block device /dev/nvme0n1 is used by both '
+                         'fast and bulk')
+        self.test_config.set('lvm-device-groups', 'fast')
+        self.assertIn('must be a mapping', cinder_utils.check_lvm_config())
+
+    @patch.object(cinder_utils, 'create_thin_pool')
+    def test_ensure_thin_pool(self, create_thin_pool):
+        self.assertFalse(cinder_utils.ensure_thin_pool(
+            'test', lvm_inventory()))
+        self.assertFalse(cinder_utils.ensure_thin_pool(
+            'test', lvm_inventory({'/dev/fakevbd': 'test'},
+                                  [('test-pool', 'test', 'twi-a-tz--')])))
+        self.assertFalse(create_thin_pool.called)
+        self.assertTrue(cinder_utils.ensure_thin_pool(
+            'test', lvm_inventory({'/dev/fakevbd': 'test'},
+                                  [('other', 'test', 'twi-a-tz--')]),
+            '64k', '1G'))
+        create_thin_pool.assert_called_once_with('test', '64k', '1G', None,
+                                                 None)
+
+    @patch.object(cinder_utils, 'create_thin_pool')
+    def test_ensure_thin_pool_no_free_space(self, create_thin_pool):
+        inventory = lvm_inventory({'/dev/fakevbd': 'test',
+                                   '/dev/fakevbd2': 'test'},
+                                  [('thick', 'test', '-wi-a-----')], free=0)
+        self.assertFalse(cinder_utils.ensure_thin_pool('test', inventory))
+        self.assertFalse(cinder_utils.ensure_thin_pool(
+            'test', inventory, devices=['/dev/fakevbd']))
+        self.assertFalse(create_thin_pool.called)
+        self.assertIn('has no free space', self.juju_log.call_args[0][0])
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'ensure_lvm_volume_group_non_existent',
+                  Mock())
+    @patch.object(cinder_utils, 'release_storage', Mock())
+    @patch.object(cinder_utils, 'ensure_thin_pool')
+    @patch.object(cinder_utils, 'reduce_lvm_volume_group_missing', Mock())
+    @patch.object(cinder_utils, 'extend_lvm_volume_group', Mock())
+    @patch.object(cinder_utils, 'extend_logical_volume_by_device')
+    def test_configure_lvm_storage_thin(self, extend_lv_by_dev,
+                                        ensure_thin_pool):
+        devices = ['/dev/fakevbd', '/dev/fakevdc']
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        inventory = lvm_inventory(
+            {'/dev/fakevbd': 'test'},
+            [('test-pool', 'test', 'twi-a-tz--'),
+             ('other', 'test', 'twi-a-tz--')])
+        self.LVMInventory.return_value = inventory
+        ensure_thin_pool.return_value = False
+        cinder_utils.configure_lvm_storage(
+            devices, 'test', True, False, lvm_type='thin',
+            thin_pool_chunk_size='64k', thin_pool_metadata_size='1G')
+        extend_lv_by_dev.assert_called_once_with('test/test-pool',
+                                                 '/dev/fakevdc')
+        ensure_thin_pool.assert_called_once_with('test', inventory, '64k',
+                                                 '1G', None, [])
+        self.assertEqual(inventory.refresh.call_count, 2)
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'ensure_thin_pool')
+    def test_configure_lvm_storage_thin_new_pool(self, ensure_thin_pool):
+        inventory = lvm_inventory({'/dev/fakevbd': 'test'})
+        self.LVMInventory.return_value = inventory
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        ensure_thin_pool.return_value = True
+        cinder_utils.configure_lvm_storage(['/dev/fakevbd'], 'test',
+                                           lvm_type='auto')
+        ensure_thin_pool.assert_called_once_with('test', inventory, None,
+                                                 None, None, [])
+        inventory.refresh.assert_called_once_with()
+        ensure_thin_pool.reset_mock()
+        cinder_utils.configure_lvm_storage(['/dev/fakevbd'], 'test')
+        self.assertFalse(ensure_thin_pool.called)
+
+    def test_lvm_inventory_cached(self):
+        inventory = lvm_inventory(
+            {'/dev/sdb': 'test', '/dev/nvme0n1': 'test'},
+            [('test-pool', 'test', 'twi-aotz--'),
+             ('[test-pool_tdata]', 'test', 'Cwi-aoC---', 'cache'),
+             ('[test-cache_cvol]', 'test', 'Cwi-aoC---', 'linear'),
+             ('other', 'test', '-wi-a-----')])
+        self.assertEqual(inventory.thin_pools(), ['test/test-pool'])
+        self.assertEqual(inventory.logical_volume('test/test-pool_tdata').attr,
+                         'Cwi-aoC---')
+        self.assertIsNone(inventory.logical_volume('test/missing'))
+        self.assertTrue(inventory.is_cached('test/test-pool'))
+        self.assertFalse(inventory.is_cached('test/other'))
+
+    @patch('subprocess.check_call')
+    def test_attach_volume_cache(self, check_call):
+        cinder_utils.attach_volume_cache('test/test-pool', 'test/test-cache',
+                                         'writeback')
+        check_call.assert_called_once_with(
+            ['lvconvert', '--yes', '--type', 'cache', '--cachemode',
+             'writeback', '--cachevol', 'test/test-cache', 'test/test-pool'])
+        cinder_utils.attach_volume_cache('test/test-pool', 'test/test-cache',
+                                         'writecache')
+        check_call.assert_called_with(
+            ['lvconvert', '--yes', '--type', 'writecache', '--cachevol',
+             'test/test-cache', 'test/test-pool'])
+
+    @patch.object(cinder_utils, 'attach_volume_cache')
+    @patch('subprocess.check_call')
+    def test_ensure_volume_cache(self, check_call, attach_volume_cache):
+        pvs = {'/dev/sdb': 'test', '/dev/nvme0n1': 'test',
+               '/dev/nvme1n1': None}
+        self.assertFalse(cinder_utils.ensure_volume_cache(
+            'test', ['/dev/nvme0n1'], lvm_inventory(pvs)))
+        self.assertFalse(cinder_utils.ensure_volume_cache(
+            'test', ['/dev/nvme1n1'],
+            lvm_inventory(pvs, [('test-pool', 'test', 'twi-aotz--')])))
+        self.assertFalse(cinder_utils.ensure_volume_cache(
+            'test', ['/dev/nvme0n1'],
+            lvm_inventory(pvs, [('test-pool', 'test', 'twi-aotz--'),
+                                ('[test-pool_tdata]', 'test', 'Dwi-aoC---',
+                                 'writecache')])))
+        self.assertFalse(check_call.called)
+        self.assertFalse(attach_volume_cache.called)
+
+        self.assertTrue(cinder_utils.ensure_volume_cache(
+            'test', ['/dev/nvme0n1', '/dev/nvme1n1'],
+            lvm_inventory(pvs, [('test-pool', 'test', 'twi-aotz--')]),
+            'writeback'))
+        check_call.assert_called_once_with(
+            ['lvcreate', '--yes', '--extents', '100%PVS', '--name',
+             'test-cache', 'test', '/dev/nvme0n1'])
+        attach_volume_cache.assert_called_once_with(
+            'test/test-pool', 'test/test-cache', 'writeback')
+
+        # An unattached cache volume from an earlier run is reused.
+        check_call.reset_mock()
+        self.assertTrue(cinder_utils.ensure_volume_cache(
+            'test', ['/dev/nvme0n1'],
+            lvm_inventory(pvs, [('test-pool', 'test', 'twi-aotz--'),
+                                ('test-cache', 'test', '-wi-a-----')])))
+        self.assertFalse(check_call.called)
+
     @patch('subprocess.check_output')
-    def test_log_lvm_info(self, _check):
-        output = b"some output"
-        _check.return_value = output
-        cinder_utils.log_lvm_info()
-        _check.assert_called_with(['pvscan'])
-        self.juju_log.assert_called_with("pvscan: {}".format(output.decode()))
+    def test_volume_cache_stats(self, check_output):
+        check_output.return_value = json.dumps({'report': [{'lv': [
+            {'lv_name': 'test-pool', 'segtype': 'thin-pool',
+             'cache_read_hits': ''},
+            {'lv_name': '[test-pool_tdata]', 'segtype': 'cache',
+             'cache_total_blocks': '1000', 'cache_used_blocks': '500',
+             'cache_dirty_blocks': '0', 'cache_read_hits': '75',
+             'cache_read_misses': '25', 'cache_write_hits': '0',
+             'cache_write_misses': '0'},
+            {'lv_name': '[other_wcorig]', 'segtype': 'writecache',
+             'writecache_total_blocks': '100',
+             'writecache_free_blocks': '90',
+             'writecache_writeback_blocks': '', 'writecache_error': '0'},
+        ]}]}).encode()
+        with patch.object(cinder_utils, 'LVMInventory', LVM_INVENTORY):
+            stats = cinder_utils.volume_cache_stats('test')
+        cmd = check_output.call_args[0][0]
+        self.assertEqual(cmd[0], 'lvs')
+        self.assertEqual(cmd[-2:], ['--all', 'test'])
+        self.assertIn('cache_read_hits', cmd[2])
+        self.assertEqual(stats, [
+            {'lv': 'test/test-pool_tdata', 'type': 'cache',
+             'cache_total_blocks': 1000, 'cache_used_blocks': 500,
+             'cache_dirty_blocks': 0, 'cache_read_hits': 75,
+             'cache_read_misses': 25, 'cache_write_hits': 0,
+             'cache_write_misses': 0, 'read_hit_ratio': 0.75,
+             'write_hit_ratio': None},
+            {'lv': 'test/other_wcorig', 'type': 'writecache',
+             'writecache_total_blocks': 100, 'writecache_free_blocks': 90,
+             'writecache_writeback_blocks': 0, 'writecache_error': 0}])
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'release_storage', Mock())
+    @patch.object(cinder_utils, 'has_partition_table',
+                  Mock(return_value=False))
+    @patch.object(cinder_utils, 'ensure_volume_cache')
+    @patch.object(cinder_utils, 'ensure_thin_pool')
+    @patch.object(cinder_utils, 'extend_lvm_volume_group')
+    @patch.object(cinder_utils, 'extend_logical_volume_by_device')
+    def test_configure_lvm_storage_cache(self, extend_lv_by_dev, extend_lvm,
+                                         ensure_thin_pool,
+                                         ensure_volume_cache):
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        inventory = lvm_inventory(
+            {'/dev/sdb': 'test', '/dev/sdc': 'test', '/dev/nvme0n1': 'test'},
+            [('test-pool', 'test', 'twi-aotz--')])
+        # Only /dev/sdb is in the volume group when storage is configured.
+        inventory.is_physical_volume = lambda d: d == '/dev/sdb'
+        self.LVMInventory.return_value = inventory
+        ensure_thin_pool.return_value = False
+        ensure_volume_cache.return_value = True
+        cinder_utils.configure_lvm_storage(
+            ['/dev/sdb', '/dev/sdc'], 'test', lvm_type='thin',
+            cache_devices=['/dev/nvme0n1'], cache_mode='writeback')
+        extend_lvm.assert_has_calls([call('test', '/dev/sdc'),
+                                     call('test', '/dev/nvme0n1')])
+        extend_lv_by_dev.assert_called_once_with('test/test-pool',
+                                                 '/dev/sdc')
+        ensure_thin_pool.assert_called_once_with(
+            'test', inventory, None, None, ['/dev/sdb', '/dev/sdc'], [])
+        ensure_volume_cache.assert_called_once_with(
+            'test', ['/dev/nvme0n1'], inventory, 'writeback')
+        self.assertEqual(inventory.refresh.call_count, 3)
+
+    @patch.object(cinder_utils, 'log_lvm_info', Mock())
+    @patch.object(cinder_utils, 'release_storage', Mock())
+    @patch.object(cinder_utils, 'has_partition_table',
+                  Mock(return_value=False))
+    @patch.object(cinder_utils, 'ensure_volume_cache')
+    @patch.object(cinder_utils, 'ensure_thin_pool')
+    @patch.object(cinder_utils, 'extend_lvm_volume_group')
+    def test_configure_lvm_storage_cache_thick(self, extend_lvm,
+                                               ensure_thin_pool,
+                                               ensure_volume_cache):
+        self.is_device_mounted.return_value = False
+        self.is_block_device.return_value = True
+        inventory = lvm_inventory({'/dev/sdb': 'test'})
+        self.LVMInventory.return_value = inventory
+        cinder_utils.configure_lvm_storage(
+            ['/dev/sdb'], 'test', cache_devices=['/dev/nvme0n1'])
+        self.assertFalse(extend_lvm.called)
+        self.assertFalse(ensure_thin_pool.called)
+        self.assertFalse(ensure_volume_cache.called)
+
+    def test_check_lvm_config(self):
+        self.config.side_effect = self.test_config.get
+        self.assertIsNone(cinder_utils.check_lvm_config())
+        self.test_config.set('cache-mode', 'writearound')
+        self.assertEqual(
+            cinder_utils.check_lvm_config(),
+            'Invalid cache-mode writearound, expected one of: '
+            'writethrough, writeback, writecache')
+        self.test_config.set('cache-mode', 'writeback')
+        self.test_config.set('cache-devices', '/dev/nvme0n1')
+        self.assertEqual(cinder_utils.check_lvm_config(),
+                         'cache-devices requires lvm-type thin or auto')
+        self.test_config.set('lvm-type', 'thin')
+        self.assertIsNone(cinder_utils.check_lvm_config())
+
+    @patch.object(cinder_utils.cinder_contexts, 'config')
+    def test_check_ceph_config(self, contexts_config):
+        self.config.side_effect = self.test_config.get
+        contexts_config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+        self.test_config.set('rbd-store-chunk-size', 3)
+        self.assertIsNone(cinder_utils.check_ceph_config())
+        self.test_config.set('rbd-store-chunk-size', None)
+        self.relation_ids.return_value = ['ceph:1']
+        self.os_release.return_value = 'pike'
+        self.assertIsNone(cinder_utils.check_ceph_config())
+        self.test_config.set('rbd-exclusive-cinder-pool', True)
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'rbd-exclusive-cinder-pool not supported by OpenStack pike')
+        self.os_release.return_value = 'yoga'
+        self.assertIsNone(cinder_utils.check_ceph_config())
+        self.test_config.set('rbd-store-chunk-size', 3)
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'Invalid rbd-store-chunk-size 3, expected a power of two from 1 '
+            'to 32')
+        self.test_config.set('rbd-store-chunk-size', 8)
+        self.test_config.set('rbd-max-clone-depth', -1)
+        self.assertEqual(cinder_utils.check_ceph_config(),
+                         'Invalid rbd-max-clone-depth -1')
+        self.test_config.set('rbd-max-clone-depth', None)
+        self.test_config.set('pool-type', 'erasure')
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'Invalid pool-type erasure, expected one of: replicated, '
+            'erasure-coded')
+        self.test_config.set('pool-type', 'erasure-coded')
+        self.test_config.set('ec-profile-m', 0)
+        self.assertEqual(cinder_utils.check_ceph_config(),
+                         'ec-profile-k and ec-profile-m must be at least 1')
+        self.test_config.set('ec-profile-m', 2)
+        self.assertIsNone(cinder_utils.check_ceph_config())
+        self.test_config.set('ceph-pool-weight', 0)
+        self.assertEqual(cinder_utils.check_ceph_config(),
+                         'ceph-pool-weight must be between 1 and 100')
+        self.test_config.set('ceph-pool-weight', 40)
+        self.test_config.set('ceph-target-size-ratio', 1.5)
+        self.assertEqual(cinder_utils.check_ceph_config(),
+                         'ceph-target-size-ratio must be between 0 and 1')
+
+    @patch.object(cinder_utils.cinder_contexts, 'config')
+    @patch.object(cinder_utils, 'unitdata')
+    def test_check_ceph_config_pool_type_changed(self, unitdata,
+                                                 contexts_config):
+        kv = {}
+        unitdata.kv.return_value.get.side_effect = kv.get
+        unitdata.kv.return_value.set.side_effect = kv.__setitem__
+        unitdata.kv.return_value.unset.side_effect = kv.pop
+        self.config.side_effect = self.test_config.get
+        contexts_config.side_effect = self.test_config.get
+        self.relation_ids.return_value = ['ceph:1']
+        self.os_release.return_value = 'yoga'
+        cinder_utils.record_ceph_pool_type()
+        self.assertEqual(kv, {'cinder-ceph-pool-type': 'replicated'})
+        self.assertIsNone(cinder_utils.check_ceph_config())
+        # changed after the broker created the pools.
+        self.test_config.set('pool-type', 'erasure-coded')
+        cinder_utils.record_ceph_pool_type()
+        self.assertEqual(kv, {'cinder-ceph-pool-type': 'replicated'})
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'pool-type cannot be changed from replicated to erasure-coded '
+            'once the Ceph pools have been created')
+        cinder_utils.clear_ceph_pool_type()
+        self.assertIsNone(cinder_utils.check_ceph_config())
+
+    @patch.object(cinder_utils, 'service_name')
+    @patch.object(cinder_utils.cinder_contexts, 'service_name')
+    @patch.object(cinder_utils.cinder_contexts, 'config')
+    def test_check_ceph_config_backends(self, contexts_config,
+                                        contexts_service_name,
+                                        service_name):
+        self.config.side_effect = self.test_config.get
+        contexts_config.side_effect = self.test_config.get
+        contexts_service_name.return_value = service_name.return_value = \
+            'cinder'
+        self.relation_ids.return_value = ['ceph:1']
+        self.os_release.return_value = 'yoga'
+        self.test_config.set('ceph-backends', 'ssd: {replicas: -1}')
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'ceph-backends replicas of backend ssd must be a positive '
+            'integer')
+        self.test_config.set('ceph-backends', 'ssd:\nhdd: {pool: cinder}')
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'Ceph pool cinder is used by more than one backend')
+        self.test_config.set('ceph-backends',
+                             'ssd:\nhdd: {backend-name: CEPH-ssd}')
+        self.assertEqual(cinder_utils.check_ceph_config(),
+                         'Backend name CEPH-ssd is used more than once')
+        self.test_config.set('ceph-backends', 'ssd:\nhdd:')
+        self.assertIsNone(cinder_utils.check_ceph_config())
+        self.test_config.set('ceph-backends',
+                             'ssd: {weight: 40}\nhdd: {weight: 30}')
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'The Ceph pools of cinder weigh 110% of the cluster in total, '
+            'more than 100%')
+        self.test_config.set('ceph-backends', 'ssd:\nhdd:')
+        self.test_config.set('ceph-client-tuning', 'rbd cache size: big')
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'ceph-client-tuning rbd cache size must be a non-negative size')
+        self.test_config.set('ceph-client-tuning',
+                             'rbd cache policy: writearound')
+        with patch.object(cinder_utils.cinder_contexts, 'cmp_pkgrevno',
+                          return_value=-1):
+            self.assertEqual(
+                cinder_utils.check_ceph_config(),
+                'rbd cache policy not supported by the installed Ceph client')
+        self.test_config.set('ceph-client-tuning', None)
+        self.os_release.return_value = 'newton'
+        self.assertEqual(cinder_utils.check_ceph_config(),
+                         'ceph-backends requires OpenStack Ocata or later')
+
+    @patch.object(cinder_utils, 'unitdata')
+    @patch.object(cinder_utils.subprocess, 'check_call')
+    @patch.object(cinder_utils, 'service_name')
+    @patch.object(cinder_utils.cinder_contexts, 'erasure_coded_pool')
+    @patch.object(cinder_utils.cinder_contexts, 'ceph_backends')
+    def test_configure_rbd_data_pools(self, ceph_backends,
+                                      erasure_coded_pool, service_name,
+                                      check_call, unitdata):
+        kv = {}
+        unitdata.kv.return_value.set.side_effect = kv.__setitem__
+        service_name.return_value = 'cinder'
+        erasure_coded_pool.return_value = False
+        ceph_backends.return_value = [
+            {'name': 'ssd', 'pool': 'cinder-ssd', 'rbd_pool': 'cinder-ssd',
+             'erasure_coded': False},
+            {'name': 'hdd', 'pool': 'cinder-hdd',
+             'rbd_pool': 'cinder-hdd-metadata', 'erasure_coded': True}]
+        cinder_utils.configure_rbd_data_pools()
+        check_call.assert_called_once_with(
+            ['rbd', '--id', 'cinder', 'config', 'pool', 'set',
+             'cinder-hdd-metadata', 'rbd_default_data_pool', 'cinder-hdd'])
+        self.assertEqual(kv, {'cinder-rbd-data-pool-failures': []})
+        check_call.reset_mock()
+        erasure_coded_pool.return_value = True
+        check_call.side_effect = [
+            subprocess.CalledProcessError(1, 'rbd'), None]
+        cinder_utils.configure_rbd_data_pools()
+        self.assertEqual(check_call.call_count, 2)
+        self.assertTrue(self.log.called)
+        self.assertEqual(kv, {'cinder-rbd-data-pool-failures': ['ssd']})
+
+    @patch.object(cinder_utils.cinder_contexts, 'config')
+    @patch.object(cinder_utils, 'unitdata')
+    def test_check_ceph_config_data_pool_failures(self, unitdata,
+                                                  contexts_config):
+        kv = {'cinder-rbd-data-pool-failures': ['ssd', 'hdd']}
+        unitdata.kv.return_value.get.side_effect = kv.get
+        self.config.side_effect = self.test_config.get
+        contexts_config.side_effect = self.test_config.get
+        self.relation_ids.return_value = ['ceph:1']
+        self.os_release.return_value = 'yoga'
+        self.assertEqual(
+            cinder_utils.check_ceph_config(),
+            'Unable to set the data pool of ceph-backends ssd, hdd')
+        kv['cinder-rbd-data-pool-failures'] = []
+        self.assertIsNone(cinder_utils.check_ceph_config())
+
+    def test_check_lvm_config_target_helper(self):
+        self.config.side_effect = self.test_config.get
+        self.os_release.return_value = 'yoga'
+        self.test_config.set('target-helper', 'iet')
+        self.assertEqual(
+            cinder_utils.check_lvm_config(),
+            'Invalid target-helper iet, expected one of: '
+            'tgtadm, lioadm, nvmet')
+        self.test_config.set('target-helper', 'nvmet')
+        self.assertEqual(
+            cinder_utils.check_lvm_config(),
+            'Invalid target-protocol iscsi for target-helper nvmet, '
+            'expected one of: nvmet_tcp, nvmet_rdma')
+        self.test_config.set('target-protocol', 'nvmet_tcp')
+        self.assertIsNone(cinder_utils.check_lvm_config())
+        self.os_release.return_value = 'queens'
+        self.assertEqual(cinder_utils.check_lvm_config(),
+                         'target-helper nvmet requires OpenStack Rocky or '
+                         'later')
+
+    @patch.object(cinder_utils, 'unitdata')
+    @patch.object(cinder_utils, 'service_resume')
+    @patch.object(cinder_utils, 'service_pause')
+    @patch.object(cinder_utils, 'modprobe')
+    @patch.object(cinder_utils, 'filter_installed_packages')
+    def test_configure_target_helper(self, filter_installed_packages,
+                                     modprobe, service_pause,
+                                     service_resume, unitdata):
+        self.config.side_effect = self.test_config.get
+        filter_installed_packages.side_effect = lambda p: p
+        kv = {}
+        unitdata.kv.return_value.get.side_effect = kv.get
+        unitdata.kv.return_value.set.side_effect = kv.__setitem__
+        unitdata.kv.return_value.unset.side_effect = kv.pop
+        cinder_utils.configure_target_helper()
+        self.apt_install.assert_called_once_with([], fatal=True)
+        self.assertFalse(modprobe.called)
+        self.assertFalse(service_pause.called)
+        self.assertFalse(service_resume.called)
+
+        self.apt_install.reset_mock()
+        self.test_config.set('target-helper', 'nvmet')
+        self.test_config.set('target-protocol', 'nvmet_tcp')
+        cinder_utils.configure_target_helper()
+        self.apt_install.assert_called_once_with(['nvmetcli'], fatal=True)
+        modprobe.assert_has_calls([call('nvmet', persist=False),
+                                   call('nvmet_tcp', persist=False)])
+        service_pause.assert_called_once_with('tgt')
+        cinder_utils.configure_target_helper()
+        service_pause.assert_called_once_with('tgt')
+
+        self.test_config.set('target-helper', 'tgtadm')
+        self.test_config.set('target-protocol', 'iscsi')
+        cinder_utils.configure_target_helper()
+        service_resume.assert_called_once_with('tgt')
+        self.assertEqual(kv, {})
+
+    @patch.object(cinder_utils, 'lvm_volume_group_exists')
+    @patch.object(cinder_utils, 'remove_lvm_volume_group')
+    def test_ensure_non_existent_from_inventory(self,
+                                                remove_lvm_volume_group,
+                                                volume_group_exists):
+        cinder_utils.ensure_lvm_volume_group_non_existent(
+            'test', inventory=lvm_inventory({'/dev/fakevbd': 'test'}))
+        remove_lvm_volume_group.assert_called_once_with('test')
+        cinder_utils.ensure_lvm_volume_group_non_existent(
+            'other', inventory=lvm_inventory({'/dev/fakevbd': 'test'}))
+        remove_lvm_volume_group.assert_called_once_with('test')
+        self.assertFalse(volume_group_exists.called)
 
     @patch.object(cinder_utils, 'lvm_volume_group_exists')
     @patch.object(cinder_utils, 'remove_lvm_volume_group')
@@ -1120,3 +2077,68 @@ class TestCinderUtils(CharmTestCase):
             asf.assert_called_once_with('some-config')
             # ports=None whilst port checks are disabled.
             f.assert_called_once_with('assessor', services=['s1'], ports=None)
+
+    def test_idle_fast_path_hook(self):
+        self.assertTrue(cinder_utils.idle_fast_path_hook('config-changed'))
+        self.assertTrue(cinder_utils.idle_fast_path_hook('update-status'))
+        self.assertTrue(cinder_utils.idle_fast_path_hook(
+            'storage-backend-relation-changed'))
+        self.assertFalse(cinder_utils.idle_fast_path_hook('install'))
+        self.assertFalse(cinder_utils.idle_fast_path_hook(
+            'cluster-relation-joined'))
+
+    @patch.object(cinder_utils, 'is_leader')
+    @patch.object(cinder_utils, 'is_unit_paused_set')
+    @patch.object(cinder_utils, 'storage_list')
+    @patch.object(cinder_utils, 'relation_snapshot')
+    def test_hook_inputs_fingerprint(self, relation_snapshot, storage_list,
+                                     is_unit_paused_set, is_leader):
+        relation_snapshot.return_value.digest.return_value = 'abc'
+        self.local_unit.return_value = 'cinder/0'
+        storage_list.return_value = []
+        is_unit_paused_set.return_value = False
+        is_leader.return_value = True
+        self.os_release.return_value = 'yoga'
+        fingerprint = cinder_utils.hook_inputs_fingerprint()
+        relation_snapshot.return_value.digest.assert_called_once_with(
+            exclude_units=['cinder/0'])
+        self.assertEqual(fingerprint, cinder_utils.hook_inputs_fingerprint())
+        self.test_config.set('debug', True)
+        self.assertNotEqual(fingerprint,
+                            cinder_utils.hook_inputs_fingerprint())
+        relation_snapshot.return_value = None
+        self.assertIsNone(cinder_utils.hook_inputs_fingerprint())
+
+    @patch.object(cinder_utils, 'unitdata')
+    @patch.object(cinder_utils, 'hook_inputs_fingerprint')
+    def test_hook_inputs_unchanged(self, hook_inputs_fingerprint, unitdata):
+        hook_inputs_fingerprint.return_value = 'abc'
+        kv = {cinder_utils.HOOK_INPUTS_KEY: {'config-changed': 'abc',
+                                             'update-status': 'def'}}
+        unitdata.kv.return_value.get.side_effect = kv.get
+        self.assertTrue(cinder_utils.hook_inputs_unchanged('config-changed'))
+        self.assertFalse(cinder_utils.hook_inputs_unchanged('install'))
+        self.assertFalse(cinder_utils.hook_inputs_unchanged('update-status'))
+        self.assertFalse(cinder_utils.hook_inputs_unchanged(
+            'ceph-relation-changed'))
+        hook_inputs_fingerprint.return_value = None
+        kv.clear()
+        self.assertFalse(cinder_utils.hook_inputs_unchanged('update-status'))
+
+    @patch.object(cinder_utils, 'unitdata')
+    @patch.object(cinder_utils, 'hook_inputs_fingerprint')
+    def test_record_hook_inputs(self, hook_inputs_fingerprint, unitdata):
+        kv = {}
+        db = unitdata.kv.return_value
+        db.get.side_effect = kv.get
+        db.set.side_effect = kv.__setitem__
+        db.unset.side_effect = kv.pop
+        hook_inputs_fingerprint.return_value = 'abc'
+        cinder_utils.record_hook_inputs('config-changed')
+        hook_inputs_fingerprint.return_value = 'def'
+        cinder_utils.record_hook_inputs('update-status')
+        self.assertEqual(kv, {cinder_utils.HOOK_INPUTS_KEY: {
+            'config-changed': 'abc', 'update-status': 'def'}})
+        cinder_utils.record_hook_inputs('upgrade-charm')
+        self.assertEqual(kv, {})
+        self.assertEqual(db.flush.call_count, 3)
@@ -76,16 +76,12 @@ class TestClusterHooks(CharmTestCase):
     @patch.object(hooks, 'check_local_db_actions_complete',
                   lambda *args, **kwargs: None)
     @patch('charmhelpers.core.host.service')
-    @patch('charmhelpers.core.host.path_hash')
-    def test_cluster_hook(self, path_hash, service):
+    def test_cluster_hook(self, service):
         'Ensure API restart before haproxy on cluster changed'
-        # set first hash lookup on all files
-        side_effects = []
-        # set first hash lookup on all configs in restart_on_change
-        [side_effects.append('foo') for f in RESTART_MAP.keys()]
-        # set second hash lookup on all configs in restart_on_change
-        [side_effects.append('bar') for f in RESTART_MAP.keys()]
-        path_hash.side_effect = side_effects
+        # all configs in restart_on_change are rewritten with new content
+        self.CONFIGS.changed_files = []
+        self.CONFIGS.write_all.side_effect = (
+            lambda: self.CONFIGS.changed_files.extend(RESTART_MAP.keys()))
         hooks.hooks.execute(['hooks/cluster-relation-changed'])
         ex = [
             call('stop', 'cinder-api'),
@@ -0,0 +1,121 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hook tool call budgets for the cinder hooks.
+
+Each hook is run against synthetic models of growing size and the number
+of calls per tool must stay within fixed + per_unit * units, where units is
+the number of units on each scaled relation of the model. The counts must
+also grow no faster than linearly with the model size.
+
+When a change legitimately costs more calls, update BUDGETS; the counts
+for any model size can be listed with:
+
+    python3 -m unit_tests.benchmark_hooks --units 5 10 20 --json
+"""
+
+import unittest
+
+from benchmark_hooks import BENCHMARK_HOOKS
+from hooktools import HookRunner, HookToolSimulator, grouped_calls
+
+# Model sizes, each double the previous one.
+SIZES = (5, 10, 20)
+
+# hook -> tool -> (fixed, per_unit)
+BUDGETS = {
+    'install': {
+        'relation-get': (17, 2),
+        'relation-set': (0, 0),
+        'relation-ids': (15, 0),
+        'relation-list': (6, 0),
+        'config-get': (1, 0),
+        'apt': (9, 0),
+        'lvm': (0, 0),
+    },
+    # identity_joined, cluster_joined and ha_joined are run for every
+    # relation id; none of them may cost anything per related unit.
+    'config-changed': {
+        'relation-get': (17, 2),
+        'relation-set': (6, 0),
+        'relation-ids': (15, 0),
+        'relation-list': (6, 0),
+        'config-get': (1, 0),
+        'apt': (32, 0),
+        'lvm': (3, 0),
+    },
+    'storage-backend-relation-changed': {
+        'relation-get': (16, 2),
+        'relation-set': (0, 0),
+        'relation-ids': (15, 0),
+        'relation-list': (6, 0),
+        'config-get': (1, 0),
+        'apt': (6, 0),
+        'lvm': (0, 0),
+    },
+    'cluster-relation-changed': {
+        'relation-get': (16, 2),
+        'relation-set': (0, 0),
+        'relation-ids': (15, 0),
+        'relation-list': (6, 0),
+        'config-get': (1, 0),
+        'apt': (6, 0),
+        'lvm': (0, 0),
+    },
+    'update-status': {
+        'relation-get': (17, 2),
+        'relation-set': (0, 0),
+        'relation-ids': (15, 0),
+        'relation-list': (6, 0),
+        'config-get': (1, 0),
+        'apt': (6, 0),
+        'lvm': (0, 0),
+    },
+}
+
+
+class TestHookBudgets(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.calls = {}
+        for size in SIZES:
+            with HookRunner(HookToolSimulator.synthetic(size)) as runner:
+                for label, hook, relation_id in BENCHMARK_HOOKS:
+                    run = runner.run(hook, relation_id)
+                    cls.calls[(label, size)] = grouped_calls(run.calls)
+
+    def test_all_hooks_budgeted(self):
+        self.assertEqual(sorted(BUDGETS),
+                         sorted(label for label, _, _ in BENCHMARK_HOOKS))
+
+    def test_budgets(self):
+        for hook, budget in BUDGETS.items():
+            for tool, (fixed, per_unit) in budget.items():
+                for size in SIZES:
+                    with self.subTest(hook=hook, tool=tool, units=size):
+                        self.assertLessEqual(
+                            self.calls[(hook, size)][tool],
+                            fixed + per_unit * size)
+
+    def test_linear_scaling(self):
+        for hook in BUDGETS:
+            for tool in BUDGETS[hook]:
+                counts = [self.calls[(hook, size)][tool] for size in SIZES]
+                with self.subTest(hook=hook, tool=tool, counts=counts):
+                    # doubling the model may at most double the growth.
+                    for small, medium, large in zip(counts, counts[1:],
+                                                    counts[2:]):
+                        self.assertLessEqual(large - medium,
+                                             2 * (medium - small))
@@ -0,0 +1,270 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from unittest.mock import patch
+
+from charmhelpers.core import hookenv
+
+import hooktools
+
+
+class FakeKV(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+    def flush(self):
+        pass
+
+
+def value_of(key):
+    return key[0].__name__
+
+
+def lookup(*args, **kwargs):
+    pass
+
+
+def other(*args, **kwargs):
+    pass
+
+
+class TestHookCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = hookenv.HookCache(maxsize=3)
+
+    def key(self, func, *args, **kwargs):
+        return self.cache.make_key(func, args, kwargs)
+
+    def test_flush_by_token(self):
+        local = self.key(lookup, 'foo', 'cinder/0', 'cluster:1')
+        remote = self.key(lookup, 'foo', 'cinder/1', 'cluster:1')
+        kwargs = self.key(other, unit='cinder/0')
+        for key in (local, remote, kwargs):
+            self.cache[key] = value_of(key)
+        self.cache.flush('cinder/0')
+        self.assertEqual(list(self.cache), [remote])
+        self.cache.flush(lookup)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache._index, {})
+
+    def test_lru_eviction(self):
+        keys = [self.key(lookup, str(i)) for i in range(4)]
+        for key in keys[:3]:
+            self.cache[key] = value_of(key)
+        # a lookup makes keys[0] the most recently used entry.
+        self.cache[keys[0]]
+        self.cache[keys[3]] = value_of(keys[3])
+        self.assertEqual(list(self.cache), [keys[2], keys[0], keys[3]])
+        self.assertNotIn('1', self.cache._index)
+        self.assertEqual(self.cache.evictions, 1)
+        # replacing an entry does not evict another one.
+        self.cache[keys[3]] = 'new'
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_stats(self):
+        key = self.key(lookup, 'foo')
+        self.assertRaises(KeyError, self.cache.__getitem__, key)
+        self.cache[key] = 'value'
+        self.assertEqual(self.cache[key], 'value')
+        self.assertEqual(self.cache[key], 'value')
+        self.assertRaises(KeyError, self.cache.__getitem__,
+                          self.key(other))
+        self.assertEqual(self.cache.stats(), {
+            'size': 1, 'maxsize': 3, 'hits': 2, 'misses': 2, 'evictions': 0,
+            'functions': {
+                '{}.lookup'.format(__name__): {'hits': 2, 'misses': 1},
+                '{}.other'.format(__name__): {'hits': 0, 'misses': 1}}})
+        json.dumps(self.cache.stats())
+
+
+@patch.dict('os.environ', {'JUJU_UNIT_NAME': 'cinder/0'})
+class TestCachedRelationGet(unittest.TestCase):
+
+    def setUp(self):
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        hookenv.clear_relation_snapshot()
+
+    @patch.object(hookenv, '_relation_set_accepts_file', return_value=False)
+    @patch.object(hookenv.subprocess, 'check_call')
+    @patch.object(hookenv.subprocess, 'check_output')
+    def test_relation_set_flushes_local_unit(self, check_output, check_call,
+                                             accepts_file):
+        check_output.side_effect = lambda cmd: json.dumps(cmd[-1]).encode()
+        for _ in range(2):
+            self.assertEqual(
+                hookenv.relation_get('foo', 'cinder/0', 'cluster:1'),
+                'cinder/0')
+            hookenv.relation_get('foo', 'cinder/1', 'cluster:1')
+        self.assertEqual(check_output.call_count, 2)
+        hookenv.relation_set(relation_id='cluster:1', foo='bar')
+        # flush(local_unit()) only drops the local unit's lookups.
+        hookenv.relation_get('foo', 'cinder/0', 'cluster:1')
+        hookenv.relation_get('foo', 'cinder/1', 'cluster:1')
+        self.assertEqual(check_output.call_count, 3)
+        self.assertEqual(check_output.call_args[0][0][-1], 'cinder/0')
+
+
+@patch.dict('os.environ', {'JUJU_UNIT_NAME': 'cinder/0',
+                           'JUJU_RELATION_ID': 'cluster:5',
+                           'JUJU_REMOTE_UNIT': 'cinder/1'})
+class TestRelationSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = hooktools.HookToolSimulator.synthetic(3)
+        self.sim.relation_data('cluster:5', 'cinder/0')['other'] = 'kept'
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(hookenv.clear_relation_snapshot)
+
+    def test_lookups_served_from_snapshot(self):
+        with self.sim.patch():
+            hookenv.prefetch_relations(['cluster', 'shared-db'])
+            calls = self.sim.calls.copy()
+            self.assertEqual(hookenv.relation_ids('cluster'), ['cluster:5'])
+            self.assertEqual(hookenv.related_units(),
+                             ['cinder/1', 'cinder/2', 'cinder/3'])
+            self.assertEqual(hookenv.relation_get('private-address'),
+                             '10.5.1.1')
+            self.assertEqual(
+                hookenv.relation_get(rid='shared-db:1', unit='mysql/0')[
+                    'db_host'], '10.5.0.2')
+            self.assertIsNone(hookenv.relation_get(
+                'missing', rid='shared-db:1', unit='mysql/0'))
+        self.assertEqual(self.sim.calls, calls)
+
+    def test_relation_set_only_invalidates_its_keys(self):
+        with self.sim.patch():
+            hookenv.prefetch_relations(['cluster'])
+            hookenv.relation_set(relation_id='cluster:5', foo='bar')
+            calls = self.sim.calls['relation-get']
+            # the remote units and other local keys are still served from
+            # the snapshot.
+            self.assertEqual(hookenv.relation_get('private-address'),
+                             '10.5.1.1')
+            self.assertEqual(hookenv.relation_get('other', 'cinder/0'),
+                             'kept')
+            self.assertEqual(self.sim.calls['relation-get'], calls)
+            self.assertEqual(
+                hookenv.relation_get('foo', 'cinder/0', 'cluster:5'), 'bar')
+            self.assertEqual(self.sim.calls['relation-get'], calls + 1)
+            # all of the local unit's data includes the written key.
+            self.assertEqual(
+                hookenv.relation_get(unit='cinder/0', rid='cluster:5')['foo'],
+                'bar')
+            self.assertEqual(self.sim.calls['relation-get'], calls + 2)
+
+
+@patch.dict('os.environ', {'JUJU_UNIT_NAME': 'cinder/0'})
+class TestPersistentRelationSnapshot(unittest.TestCase):
+
+    RELTYPES = ['cluster', 'shared-db']
+
+    def setUp(self):
+        self.sim = hooktools.HookToolSimulator.synthetic(3)
+        self.kv = FakeKV()
+        patcher = patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(hookenv.clear_relation_snapshot)
+
+    def load(self):
+        snapshot = hookenv.RelationSnapshot(persist=True)
+        with self.sim.patch():
+            snapshot.load(self.RELTYPES)
+        return snapshot
+
+    def fetched(self, snapshot_load):
+        """Return the (rid, unit) pairs read with relation-get by
+        snapshot_load."""
+        mark = len(self.sim.commands)
+        snapshot = snapshot_load()
+        return snapshot, sorted(
+            (cmd[cmd.index('-r') + 1], cmd[-1])
+            for cmd in self.sim.commands[mark:] if cmd[0] == 'relation-get')
+
+    def test_reused_when_membership_unchanged(self):
+        stored = self.load()
+        stored.save()
+        snapshot, fetched = self.fetched(self.load)
+        self.assertEqual(fetched, [])
+        self.assertEqual(snapshot.digest(), stored.digest())
+        self.assertEqual(
+            snapshot.get('db_host', 'mysql/0', 'shared-db:1'),
+            (True, '10.5.0.2'))
+
+    def test_refetches_trigger_and_changed_membership(self):
+        self.load().save()
+        with patch.dict('os.environ', {'JUJU_RELATION_ID': 'cluster:5'}):
+            snapshot, fetched = self.fetched(self.load)
+        self.assertEqual(fetched, [
+            ('cluster:5', 'cinder'), ('cluster:5', 'cinder/0'),
+            ('cluster:5', 'cinder/1'), ('cluster:5', 'cinder/2'),
+            ('cluster:5', 'cinder/3')])
+        snapshot.save()
+        self.sim._relation('shared-db:1')['units']['mysql/1'] = {
+            'db_host': '10.5.0.3'}
+        snapshot, fetched = self.fetched(self.load)
+        self.assertEqual(fetched, [
+            ('shared-db:1', 'cinder/0'), ('shared-db:1', 'mysql'),
+            ('shared-db:1', 'mysql/0'), ('shared-db:1', 'mysql/1')])
+        self.assertEqual(
+            snapshot.get('db_host', 'mysql/1', 'shared-db:1'),
+            (True, '10.5.0.3'))
+
+    def test_save_leaves_out_stale_local_unit(self):
+        snapshot = self.load()
+        snapshot.invalidate('cluster:5', 'cinder/0', ['foo'])
+        snapshot.save()
+        stored = self.kv[hookenv.RelationSnapshot.KV_KEY]
+        self.assertNotIn('cinder/0', stored['cluster:5']['data'])
+        self.assertIn('cinder/1', stored['cluster:5']['data'])
+        self.assertIn('cinder/0', stored['shared-db:1']['data'])
+        _, fetched = self.fetched(self.load)
+        self.assertEqual(fetched, [('cluster:5', 'cinder/0')])
+
+    @patch.object(hookenv, '_atstart', [])
+    @patch.object(hookenv, '_atexit', [])
+    def test_saved_only_after_successful_hook(self):
+        hooks = hookenv.Hooks()
+
+        @hooks.hook('update-status')
+        def update_status():
+            hookenv.prefetch_relations(self.RELTYPES, persist=True)
+            self.assertNotIn(hookenv.RelationSnapshot.KV_KEY, self.kv)
+
+        @hooks.hook('config-changed')
+        def config_changed():
+            hookenv.prefetch_relations(self.RELTYPES, persist=True)
+            raise ValueError('failed')
+
+        with self.sim.patch():
+            self.assertRaises(ValueError, hooks.execute,
+                              ['hooks/config-changed'])
+            self.assertNotIn(hookenv.RelationSnapshot.KV_KEY, self.kv)
+            # the failed hook's process exits without running callbacks.
+            del hookenv._atexit[:]
+            hooks.execute(['hooks/update-status'])
+        self.assertEqual(
+            sorted(self.kv[hookenv.RelationSnapshot.KV_KEY]),
+            ['cluster:5', 'shared-db:1'])
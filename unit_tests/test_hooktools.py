@@ -0,0 +1,172 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import unittest
+
+from charmhelpers.core import hookenv
+
+import benchmark_hooks
+import hooktools
+
+
+class TestHookToolSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = hooktools.HookToolSimulator.synthetic(3)
+        self.sim.env = {'JUJU_RELATION': 'cluster',
+                        'JUJU_RELATION_ID': 'cluster:5',
+                        'JUJU_REMOTE_UNIT': 'cinder/1'}
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+
+    def test_synthetic(self):
+        self.assertEqual(self.sim.relation_units('cluster:5'),
+                         ['cinder/1', 'cinder/2', 'cinder/3'])
+        self.assertEqual(
+            self.sim.relation_data('storage-backend:6',
+                                   'cinder-backend-2/0')['backend_name'],
+            'backend-2')
+
+    def test_hook_tools(self):
+        with self.sim.patch():
+            self.assertEqual(hookenv.relation_ids('cluster'), ['cluster:5'])
+            self.assertEqual(hookenv.related_units(),
+                             ['cinder/1', 'cinder/2', 'cinder/3'])
+            self.assertEqual(hookenv.relation_get('private-address'),
+                             '10.5.1.1')
+            self.assertEqual(
+                hookenv.relation_get(rid='shared-db:1', unit='mysql/0')[
+                    'db_host'], '10.5.0.2')
+            self.assertIsNone(hookenv.relation_get(
+                'missing', rid='shared-db:1', unit='mysql/0'))
+            self.assertTrue(hookenv.is_leader())
+            self.assertEqual(hookenv.storage_list('block-devices'), [])
+            hookenv.log('hello')
+        self.assertEqual(self.sim.logs, ['hello'])
+        self.assertEqual(self.sim.calls['relation-get'], 3)
+
+    def test_relation_snapshot_app_data(self):
+        self.sim._relation('identity-service:3')['app-data'] = {
+            'service_password': 'secret'}
+        with self.sim.patch(), \
+                unittest.mock.patch.dict('os.environ',
+                                         {'JUJU_UNIT_NAME': 'cinder/0'}):
+            snapshot = hookenv.prefetch_relations(['identity-service'])
+            self.addCleanup(hookenv.clear_relation_snapshot)
+            calls = self.sim.calls['relation-get']
+            self.assertEqual(
+                hookenv.relation_get('service_password',
+                                     rid='identity-service:3',
+                                     app='keystone'), 'secret')
+            self.assertEqual(self.sim.calls['relation-get'], calls)
+            digest = snapshot.digest()
+            self.sim._relation('identity-service:3')['app-data'][
+                'service_password'] = 'changed'
+            self.assertNotEqual(
+                hookenv.prefetch_relations(['identity-service']).digest(),
+                digest)
+
+    def test_status(self):
+        self.sim.dispatch(['status-set', 'active', 'Unit is ready'])
+        self.assertEqual(self.sim.status, ('active', 'Unit is ready'))
+        rc, out = self.sim.dispatch(['status-get', '--format=json'])
+        self.assertEqual(json.loads(out.decode('UTF-8'))['status'],
+                         'active')
+
+    def test_config_get(self):
+        rc, out = self.sim.dispatch(['config-get', '--all', '--format=json'])
+        self.assertEqual(rc, 0)
+        config = json.loads(out.decode('UTF-8'))
+        self.assertEqual(config['volume-group'], 'cinder-volumes')
+        self.assertEqual(config['block-device'], 'None')
+
+    def test_relation_set(self):
+        with self.sim.patch():
+            with unittest.mock.patch.dict('os.environ',
+                                          {'JUJU_UNIT_NAME': 'cinder/0'}):
+                hookenv.relation_set(relation_id='cluster:5', foo='bar')
+                self.assertEqual(
+                    hookenv.relation_get('foo', 'cinder/0', 'cluster:5'),
+                    'bar')
+                hookenv.relation_set(relation_id='cluster:5', foo=None)
+        self.assertNotIn('foo', self.sim.relation_data('cluster:5',
+                                                       'cinder/0'))
+
+    def test_commands(self):
+        self.sim.model['commands']['vgs'] = {'stdout': 'cinder-volumes\n'}
+        self.sim.model['commands']['false'] = {'rc': 1}
+        with self.sim.patch():
+            self.assertEqual(subprocess.check_output(['vgs']),
+                             b'cinder-volumes\n')
+            self.assertEqual(subprocess.check_output(
+                ['vgs'], universal_newlines=True), 'cinder-volumes\n')
+            with self.assertRaises(subprocess.CalledProcessError):
+                subprocess.check_call(['false'])
+            self.assertEqual(subprocess.call(['apt-get', 'update']), 0)
+        self.assertEqual(self.sim.calls['vgs'], 2)
+        self.assertEqual(self.sim.calls['apt-get'], 1)
+
+
+class TestHookRunner(unittest.TestCase):
+
+    def test_run_hooks(self):
+        sim = hooktools.HookToolSimulator.synthetic(2)
+        with hooktools.HookRunner(sim) as runner:
+            run = runner.run('config-changed')
+            self.assertIn('/etc/cinder/cinder.conf', sim.files)
+            self.assertEqual(run.calls['config-get'], 1)
+            self.assertTrue(run.calls['relation-set'])
+            run = runner.run('storage-backend-relation-changed',
+                             'storage-backend:6')
+            self.assertIn(b'backend-2', sim.files['/etc/cinder/cinder.conf'])
+
+    def test_run_skips_idle_hooks(self):
+        sim = hooktools.HookToolSimulator.synthetic(2)
+        sim.config['skip-idle-hooks'] = True
+        with hooktools.HookRunner(sim) as runner:
+            runner.run('update-status')
+            self.assertFalse(any('skipping update-status' in line
+                                 for line in sim.logs))
+            runner.run('update-status')
+            self.assertTrue(any('skipping update-status' in line
+                                for line in sim.logs))
+
+    def test_run_applies_config_after_other_idle_hook(self):
+        sim = hooktools.HookToolSimulator.synthetic(2)
+        sim.config['skip-idle-hooks'] = True
+        with hooktools.HookRunner(sim) as runner:
+            runner.run('config-changed')
+            sim.config['debug'] = True
+            # records its own inputs only, config-changed still runs.
+            runner.run('update-status')
+            runner.run('config-changed')
+            self.assertFalse(any('skipping config-changed' in line
+                                 for line in sim.logs))
+            self.assertIn(b'debug = True',
+                          sim.files['/etc/cinder/cinder.conf'])
+
+    def test_benchmark(self):
+        results = benchmark_hooks.benchmark(units=(1, 5), repeat=1)
+        self.assertEqual(len(results),
+                         2 * len(benchmark_hooks.BENCHMARK_HOOKS))
+        small, large = results[0], results[len(
+            benchmark_hooks.BENCHMARK_HOOKS)]
+        self.assertEqual((small['hook'], small['units']), ('install', 1))
+        self.assertEqual((large['hook'], large['units']), ('install', 5))
+        self.assertGreater(large['calls']['relation-get'],
+                           small['calls']['relation-get'])
+        self.assertIn('config-changed',
+                      benchmark_hooks.format_results(results))
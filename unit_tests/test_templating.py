@@ -0,0 +1,155 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+
+from unittest.mock import patch
+
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import hookenv
+
+
+class FakeContext(object):
+
+    interfaces = []
+
+    def __init__(self, ctxt):
+        self.ctxt = ctxt
+
+    def __call__(self):
+        return dict(self.ctxt)
+
+
+class TestOSConfigRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.templates = os.path.join(self.tmpdir, 'templates')
+        os.mkdir(self.templates)
+        with open(os.path.join(self.templates, 'test.conf'), 'w') as f:
+            f.write('value = {{ value }}\n')
+        self.config_file = os.path.join(self.tmpdir, 'test.conf')
+        self.ctxt = {'value': 1}
+        patcher = patch.object(templating, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.renderer = templating.OSConfigRenderer(self.templates, 'yoga')
+        self.renderer.register(self.config_file, [FakeContext(self.ctxt)])
+
+    def read(self):
+        with open(self.config_file) as f:
+            return f.read()
+
+    def test_write_unchanged(self):
+        self.assertTrue(self.renderer.write(self.config_file))
+        stat = os.stat(self.config_file)
+        with patch.object(self.renderer, '_replace_file') as replace_file:
+            self.assertFalse(self.renderer.write(self.config_file))
+            self.assertFalse(replace_file.called)
+        self.assertEqual(os.stat(self.config_file).st_ino, stat.st_ino)
+        self.assertEqual(self.renderer.changed_files, [self.config_file])
+
+    def test_write_changed(self):
+        self.assertTrue(self.renderer.write(self.config_file))
+        self.ctxt['value'] = 2
+        self.renderer.invalidate_contexts()
+        self.assertTrue(self.renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value = 2')
+        self.assertEqual(self.renderer.changed_files,
+                         [self.config_file, self.config_file])
+
+    def test_write_after_external_writer(self):
+        self.assertTrue(self.renderer.write(self.config_file))
+        # e.g. dpkg --force-confnew replacing the file during the hook.
+        with open(self.config_file, 'w') as f:
+            f.write('value = packaged\n')
+        self.assertTrue(self.renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value = 1')
+
+    def test_replace_file_keeps_mode_and_owner(self):
+        with open(self.config_file, 'w') as f:
+            f.write('old\n')
+        os.chmod(self.config_file, 0o640)
+        stat = os.stat(self.config_file)
+        with patch.object(templating.tempfile, 'mkstemp',
+                          side_effect=tempfile.mkstemp) as mkstemp:
+            templating.OSConfigRenderer._replace_file(self.config_file,
+                                                      b'new\n')
+        # the temporary file is renamed over the file from its directory.
+        self.assertEqual(mkstemp.call_args[1]['dir'], self.tmpdir)
+        self.assertEqual(self.read(), 'new\n')
+        new_stat = os.stat(self.config_file)
+        self.assertEqual(new_stat.st_mode & 0o7777, 0o640)
+        self.assertEqual((new_stat.st_uid, new_stat.st_gid),
+                         (stat.st_uid, stat.st_gid))
+        self.assertNotEqual(new_stat.st_ino, stat.st_ino)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['templates', 'test.conf'])
+
+    def test_replace_file_failure_removes_temporary_file(self):
+        with patch.object(templating.os, 'rename', side_effect=OSError):
+            self.assertRaises(OSError,
+                              templating.OSConfigRenderer._replace_file,
+                              self.config_file, b'new\n')
+        self.assertEqual(os.listdir(self.tmpdir), ['templates'])
+
+    @patch.object(hookenv, 'local_unit', return_value='cinder/0')
+    @patch.object(hookenv, '_relation_set_accepts_file', return_value=False)
+    @patch.object(hookenv.subprocess, 'check_call')
+    def test_relation_set_invalidates_contexts(self, check_call,
+                                               accepts_file, local_unit):
+        self.assertTrue(self.renderer.write(self.config_file))
+        self.ctxt['value'] = 2
+        # served from the context cache until the inputs change.
+        self.assertFalse(self.renderer.write(self.config_file))
+        hookenv.relation_set(relation_id='cluster:1', foo='bar')
+        self.assertTrue(self.renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value = 2')
+
+    @patch.object(hookenv.subprocess, 'check_call')
+    def test_leader_set_invalidates_contexts(self, check_call):
+        self.renderer.write(self.config_file)
+        self.ctxt['value'] = 2
+        hookenv.leader_set(foo='bar')
+        self.assertTrue(self.renderer.write(self.config_file))
+
+    @patch.object(hookenv, 'atexit')
+    @patch.object(hookenv, 'charm_dir')
+    def test_config_change_invalidates_contexts(self, charm_dir, atexit):
+        charm_dir.return_value = self.tmpdir
+        self.renderer.write(self.config_file)
+        self.ctxt['value'] = 2
+        config = hookenv.Config({'foo': 'bar'})
+        config['foo'] = 'bar'
+        self.assertFalse(self.renderer.write(self.config_file))
+        config['foo'] = 'baz'
+        self.assertTrue(self.renderer.write(self.config_file))
+
+    def test_context_cache_keyed_on_generator(self):
+        template = self.renderer.templates[self.config_file]
+        context = template.contexts[0]
+        template.context()
+        self.assertEqual(list(self.renderer._context_cache), [context])
+
+    def test_renderer_not_kept_alive_by_callback(self):
+        renderer = templating.OSConfigRenderer(self.templates, 'yoga')
+        ref = weakref.ref(renderer)
+        del renderer
+        self.assertIsNone(ref())
+        hookenv._notify_inputs_changed()